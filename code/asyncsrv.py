@@ -0,0 +1,584 @@
+
+#############################################################################
+# Classes for running the CyTrONE web servers with an asynchronous,
+# event-driven front end: a single event loop handles all connections, and
+# complete requests are passed to a bounded pool of workers
+#############################################################################
+
+# External imports
+import asyncore
+import errno
+import os
+import socket
+import ssl
+import time
+import Queue
+from StringIO import StringIO
+
+# Internal imports
+import httpsrv
+import parallel
+
+#############################################################################
+# Constants
+#############################################################################
+
+# Default number of worker threads that execute request handlers
+DEFAULT_WORKER_COUNT = 32
+
+# Default number of complete requests that can wait for a worker
+DEFAULT_QUEUE_SIZE = 64
+
+# Number of pending connections allowed by the listening socket
+LISTEN_BACKLOG = 1024
+
+# Limits for the size of a request (bytes)
+MAX_HEADER_SIZE = 65536
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+# Amount of data read at once from a connection (bytes)
+RECEIVE_SIZE = 65536
+
+# Maximum time the event loop waits for socket events (seconds)
+LOOP_TIMEOUT = 5
+
+# Default time after which idle connections are closed (seconds)
+DEFAULT_IDLE_TIMEOUT = 15
+
+# Connection states
+HANDSHAKING = "handshaking"
+READING = "reading"
+PROCESSING = "processing"
+WRITING = "writing"
+
+# Debugging constants
+DO_DEBUG = False
+
+
+#############################################################################
+# File-like object that collects the response written by a request handler;
+# closing it keeps the data, so that it can be retrieved afterwards
+#############################################################################
+class ResponseBuffer:
+
+    def __init__(self):
+
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+
+        self.chunks.append(data)
+
+    def flush(self):
+
+        pass
+
+    def close(self):
+
+        self.closed = True
+
+    def getvalue(self):
+
+        return "".join(self.chunks)
+
+
+#############################################################################
+# Stand-in for the connection socket that is given to request handlers;
+# the handler reads the complete request from memory, and writes its
+# response to memory, hence it never blocks on network I/O
+#############################################################################
+class BufferedRequest:
+
+    def __init__(self, request_data):
+
+        self.input = StringIO(request_data)
+        self.output = ResponseBuffer()
+
+    # Provide the file objects used by request handlers
+    def makefile(self, mode, bufsize=-1):
+
+        if "r" in mode:
+            return self.input
+        return self.output
+
+    # Timeouts and socket options do not apply, since no network I/O is done
+    def settimeout(self, timeout):
+
+        pass
+
+    def setsockopt(self, level, option, value):
+
+        pass
+
+
+#############################################################################
+# Wake up the event loop from other threads via a pipe
+#############################################################################
+class WakeupDispatcher(asyncore.file_dispatcher):
+
+    def __init__(self, server):
+
+        (read_fd, self.write_fd) = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, server.socket_map)
+        # The dispatcher uses a duplicate of the descriptor
+        os.close(read_fd)
+        self.server = server
+
+    def writable(self):
+
+        return False
+
+    # Make the event loop process the responses of the workers
+    def wake(self):
+
+        try:
+            os.write(self.write_fd, "x")
+        except OSError:
+            pass
+
+    def handle_read(self):
+
+        try:
+            self.recv(RECEIVE_SIZE)
+        except OSError:
+            pass
+        self.server.process_responses()
+
+    def close(self):
+
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_fd)
+
+
+#############################################################################
+# Manage one client connection: read a complete request, pass it to the
+# server for processing, and write the response
+# Note: All methods are called from the event loop
+#############################################################################
+class AsyncConnection(asyncore.dispatcher):
+
+    def __init__(self, server, sock, client_address):
+
+        asyncore.dispatcher.__init__(self, sock, server.socket_map)
+        self.server = server
+        self.client_address = client_address
+        self.in_buffer = ""
+        self.out_buffer = ""
+        self.handshake_wants_write = False
+        self.request_header = ""
+        self.keep_alive = False
+        self.last_activity_time = time.time()
+        if isinstance(sock, ssl.SSLSocket):
+            self.state = HANDSHAKING
+        else:
+            self.state = READING
+
+    def readable(self):
+
+        return self.state == READING or (self.state == HANDSHAKING and not self.handshake_wants_write)
+
+    def writable(self):
+
+        return self.state == WRITING or (self.state == HANDSHAKING and self.handshake_wants_write)
+
+    # Advance the SSL handshake as far as possible without blocking
+    def do_handshake(self):
+
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self.handshake_wants_write = False
+            return
+        except ssl.SSLWantWriteError:
+            self.handshake_wants_write = True
+            return
+        except (ssl.SSLError, socket.error) as error:
+            if DO_DEBUG:
+                print "* DEBUG: asyncsrv: SSL handshake failed: %s." % (error)
+            self.close()
+            return
+        self.state = READING
+
+    def handle_read(self):
+
+        if self.state == HANDSHAKING:
+            self.do_handshake()
+            return
+
+        # Read all available data; for SSL connections, this includes the
+        # data already decrypted by the SSL layer
+        while True:
+            try:
+                data = self.socket.recv(RECEIVE_SIZE)
+            except ssl.SSLWantReadError:
+                break
+            except socket.error as error:
+                if error.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    break
+                self.close()
+                return
+            if not data:
+                self.close()
+                return
+            self.in_buffer += data
+            self.last_activity_time = time.time()
+            if len(self.in_buffer) > MAX_HEADER_SIZE + MAX_BODY_SIZE:
+                self.close()
+                return
+
+        self.parse_request()
+
+    # Determine whether the connection remains open after the response,
+    # as indicated by the HTTP version and the Connection header of both
+    # the request and the response
+    def is_persistent(self, request_header, response_data):
+
+        response_header = response_data[:response_data.find("\r\n\r\n")].lower()
+        response_lines = response_header.split("\r\n")
+        if not response_lines[0].startswith("http/1.1") or "connection: close" in response_lines \
+           or not [line for line in response_lines if line.startswith("content-length:")]:
+            return False
+
+        request_lines = request_header.lower().split("\r\n")
+        if request_lines[0].endswith("http/1.1"):
+            return "connection: close" not in request_lines
+        return "connection: keep-alive" in request_lines
+
+    # Pass the request to the server once it was completely received
+    def parse_request(self):
+
+        header_end = self.in_buffer.find("\r\n\r\n")
+        if header_end < 0:
+            if len(self.in_buffer) > MAX_HEADER_SIZE:
+                print "* ERROR: asyncsrv: Request header too large => close connection."
+                self.close()
+            return
+
+        content_length = 0
+        for header_line in self.in_buffer[:header_end].split("\r\n")[1:]:
+            (name, separator, value) = header_line.partition(":")
+            if name.strip().lower() == "content-length":
+                try:
+                    content_length = int(value.strip())
+                except ValueError:
+                    content_length = -1
+        if content_length < 0 or content_length > MAX_BODY_SIZE:
+            print "* ERROR: asyncsrv: Invalid request content length => close connection."
+            self.close()
+            return
+
+        request_size = header_end + len("\r\n\r\n") + content_length
+        if len(self.in_buffer) < request_size:
+            return
+
+        request_data = self.in_buffer[:request_size]
+        self.request_header = self.in_buffer[:header_end]
+        self.in_buffer = self.in_buffer[request_size:]
+        self.state = PROCESSING
+        self.server.dispatch_request(self, request_data)
+
+    # Start writing the response prepared by a worker
+    def start_response(self, response_data):
+
+        if not response_data:
+            self.close()
+            return
+        self.keep_alive = self.is_persistent(self.request_header, response_data)
+        self.out_buffer = response_data
+        self.state = WRITING
+        self.handle_write()
+
+    def handle_write(self):
+
+        if self.state == HANDSHAKING:
+            self.do_handshake()
+            return
+
+        try:
+            sent_count = self.socket.send(self.out_buffer)
+        except (ssl.SSLWantWriteError, ssl.SSLWantReadError):
+            return
+        except socket.error as error:
+            if error.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            self.close()
+            return
+
+        self.out_buffer = self.out_buffer[sent_count:]
+        if not self.out_buffer:
+            if self.keep_alive:
+                # Wait for the next request, which may have been received
+                # already
+                self.state = READING
+                self.last_activity_time = time.time()
+                self.parse_request()
+            else:
+                self.close()
+
+    def handle_close(self):
+
+        self.close()
+
+    def handle_error(self):
+
+        print "* ERROR: asyncsrv: Connection from %s:%d failed => close it." % (
+            self.client_address[0], self.client_address[1])
+        self.close()
+
+
+#############################################################################
+# HTTP server that handles all connections in a single event loop, so that
+# idle connections, such as those of clients that wait for a response, do
+# not occupy threads; complete requests are handled by the same request
+# handler classes as BaseHTTPServer, via a bounded pool of workers; when
+# the requests waiting for a worker fill the queue, new requests are
+# rejected with the same overload response as PooledHTTPServer
+#############################################################################
+class AsyncHTTPServer(asyncore.dispatcher):
+
+    # Initialize object with the server address, the request handler class,
+    # the number of workers, the time after which idle connections are
+    # closed, and the number of requests that can wait for a worker
+    def __init__(self, server_address, handler_class, worker_count=DEFAULT_WORKER_COUNT,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, queue_size=DEFAULT_QUEUE_SIZE,
+                 retry_after=httpsrv.DEFAULT_RETRY_AFTER):
+
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(LISTEN_BACKLOG)
+        self.server_address = self.socket.getsockname()
+
+        self.RequestHandlerClass = handler_class
+        self.executor = parallel.Executor(worker_count, queue_size)
+        self.retry_after = retry_after
+        self.rejected_count = 0
+        self.response_queue = Queue.Queue()
+        self.wakeup = WakeupDispatcher(self)
+        self.ssl_context = None
+        self.running = False
+        self.idle_timeout = idle_timeout
+        self.sweep_time = time.time()
+
+    # Use SSL for client connections, with given key and certificate files
+    def set_ssl_files(self, keyfile, certfile, ca_certs=None):
+
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        ssl_context.load_cert_chain(certfile, keyfile)
+        if ca_certs:
+            ssl_context.load_verify_locations(ca_certs)
+        self.ssl_context = ssl_context
+
+    def handle_accept(self):
+
+        connection_info = self.accept()
+        if connection_info == None:
+            return
+        (sock, client_address) = connection_info
+        if self.ssl_context:
+            sock = self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        AsyncConnection(self, sock, client_address)
+
+    # Keep the server running when accepting a connection fails
+    def handle_error(self):
+
+        print "* ERROR: asyncsrv: Cannot accept connection."
+
+    # Execute a complete request via the workers, or reject it if too many
+    # requests are waiting for a worker
+    # Note: Called from the event loop
+    def dispatch_request(self, connection, request_data):
+
+        try:
+            self.executor.submit(self.run_handler, connection, request_data)
+        except Queue.Full:
+            self.rejected_count += 1
+            print "* WARNING: asyncsrv: Server overloaded (%d queued) => reject request from %s:%d (rejected so far: %d)." % (
+                self.executor.task_queue.qsize(), connection.client_address[0], connection.client_address[1],
+                self.rejected_count)
+            connection.start_response(httpsrv.get_overload_response(self.retry_after))
+
+    # Execute the request handler, and pass the response to the event loop
+    # Note: Called from worker threads
+    def run_handler(self, connection, request_data):
+
+        request = BufferedRequest(request_data)
+        try:
+            self.RequestHandlerClass(request, connection.client_address, self)
+        except Exception as error:
+            print "* ERROR: asyncsrv: Request handler raised exception: %s." % (error)
+        self.response_queue.put((connection, request.output.getvalue()))
+        self.wakeup.wake()
+
+    # Start writing the responses prepared by the workers
+    # Note: Called from the event loop
+    def process_responses(self):
+
+        while True:
+            try:
+                (connection, response_data) = self.response_queue.get_nowait()
+            except Queue.Empty:
+                break
+            # Clients may have closed their connection in the meantime
+            if connection.connected:
+                connection.start_response(response_data)
+
+    # Run the event loop until the server is shut down
+    def serve_forever(self):
+
+        self.running = True
+        while self.running:
+            asyncore.poll2(LOOP_TIMEOUT, self.socket_map)
+            self.close_idle_connections()
+
+    # Close the connections that wait for a request for too long
+    # Note: Called from the event loop
+    def close_idle_connections(self):
+
+        # Check at most once per loop timeout, since all connections are scanned
+        if time.time() - self.sweep_time < LOOP_TIMEOUT:
+            return
+        self.sweep_time = time.time()
+
+        expiry_time = time.time() - self.idle_timeout
+        for dispatcher in self.socket_map.values():
+            if isinstance(dispatcher, AsyncConnection) and dispatcher.state in (HANDSHAKING, READING) \
+               and dispatcher.last_activity_time < expiry_time:
+                if DO_DEBUG:
+                    print "* DEBUG: asyncsrv: Close idle connection from %s:%d." % (
+                        dispatcher.client_address[0], dispatcher.client_address[1])
+                dispatcher.close()
+
+    # Stop the event loop
+    # Note: Can be called from other threads
+    def shutdown(self):
+
+        self.running = False
+        self.wakeup.wake()
+
+    # Close all connections and stop the workers
+    def server_close(self):
+
+        asyncore.close_all(self.socket_map)
+        self.executor.shutdown()
+
+
+#############################################################################
+# Testing code for the classes in this file
+#
+# This code will be executed _only_ when this module is called as the
+# main program
+#############################################################################
+if __name__ == '__main__':
+
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    import threading
+    import time
+
+    enabled = [True, True, True]
+
+    POLLER_COUNT = 1000
+    POLL_BODY = "user=john_doe&password=john_passwd&action=get_sessions"
+    POLL_REQUEST = "POST / HTTP/1.0\r\nContent-Type: application/x-www-form-urlencoded\r\n" \
+                   "Content-Length: %d\r\n\r\n%s" % (len(POLL_BODY), POLL_BODY)
+
+    # Handler that behaves like a quick polling action
+    class PollRequestHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.getheader("content-length")))
+            time.sleep(0.002)
+            self.send_response(200)
+            self.send_header("Content-type", "text/html")
+            self.end_headers()
+            self.wfile.write('[{"status": "SUCCESS", "sessions": []}]')
+
+        def log_message(self, format, *args):
+            pass
+
+    # Client that sends one polling request without blocking, and records
+    # the response status and latency
+    class PollerClient(asyncore.dispatcher):
+
+        def __init__(self, server_address, client_map, results):
+            asyncore.dispatcher.__init__(self, map=client_map)
+            self.results = results
+            self.out_buffer = POLL_REQUEST
+            self.in_buffer = ""
+            self.start_time = time.time()
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.connect(server_address)
+
+        def writable(self):
+            return len(self.out_buffer) > 0
+
+        def handle_connect(self):
+            pass
+
+        def handle_write(self):
+            self.out_buffer = self.out_buffer[self.send(self.out_buffer):]
+
+        def handle_read(self):
+            self.in_buffer += self.recv(RECEIVE_SIZE)
+
+        def handle_close(self):
+            status_line = self.in_buffer.split("\r\n", 1)[0].split()
+            status = status_line[1] if len(status_line) > 1 else "error"
+            self.results.append((status, time.time() - self.start_time))
+            self.close()
+
+        def handle_error(self):
+            self.results.append(("error", time.time() - self.start_time))
+            self.close()
+
+    # Run POLLER_COUNT concurrent pollers against a server, and print
+    # statistics about the responses
+    def benchmark(engine_name, server):
+
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        client_map = {}
+        results = []
+        start_time = time.time()
+        for index in range(POLLER_COUNT):
+            PollerClient(("127.0.0.1", server.server_address[1]), client_map, results)
+        asyncore.loop(1, True, client_map)
+        duration = time.time() - start_time
+
+        server.shutdown()
+        server.server_close()
+
+        latencies = sorted([latency for (status, latency) in results if status == "200"])
+        statuses = {}
+        for (status, latency) in results:
+            statuses[status] = statuses.get(status, 0) + 1
+        print "%s engine: %d pollers in %.3f s => %.1f req/s; statuses: %s" % (
+            engine_name, POLLER_COUNT, duration, POLLER_COUNT / duration, statuses)
+        if latencies:
+            print "  Latency of successful requests: median %.3f s, p99 %.3f s, max %.3f s" % (
+                latencies[len(latencies) / 2], latencies[len(latencies) * 99 / 100], latencies[-1])
+
+    #########################################################################
+    # TEST #1
+    if enabled[0]:
+        print "TEST #1: Benchmark worker pool engine with %d concurrent pollers." % (POLLER_COUNT)
+        benchmark("Worker pool", httpsrv.PooledHTTPServer(("127.0.0.1", 0), PollRequestHandler))
+
+    #########################################################################
+    # TEST #2
+    if enabled[1]:
+        print "TEST #2: Benchmark asynchronous engine with %d concurrent pollers." % (POLLER_COUNT)
+        benchmark("Asynchronous", AsyncHTTPServer(("127.0.0.1", 0), PollRequestHandler))
+
+    #########################################################################
+    # TEST #3
+    if enabled[2]:
+        print "TEST #3: Benchmark asynchronous engine with %d concurrent pollers, 2 workers and a queue of 4." % (
+            POLLER_COUNT)
+        benchmark("Asynchronous (bounded)", AsyncHTTPServer(("127.0.0.1", 0), PollRequestHandler, 2,
+                                                            queue_size=4))
@@ -0,0 +1,281 @@
+
+#############################################################################
+# Classes for sending requests to other CyTrONE servers via persistent
+# HTTP/1.1 connections
+#############################################################################
+
+# External imports
+import errno
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+#############################################################################
+# Constants
+#############################################################################
+
+# Default maximum number of connections to each server
+DEFAULT_MAX_CONNECTIONS = 32
+
+# Default timeouts for establishing a connection, and for waiting for
+# the response to a request (seconds)
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 3600
+
+# Time after which idle connections are discarded instead of being reused;
+# must be shorter than the keep-alive timeout of the servers, so that they
+# do not close connections that are about to be reused (seconds)
+DEFAULT_IDLE_TIMEOUT = 1
+
+# Errors indicating that a reused connection was closed by the server
+# before it received the request, hence the request can be sent again
+STALE_CONNECTION_ERRNOS = [errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED]
+
+# Debugging constants
+DO_DEBUG = False
+
+
+#############################################################################
+# Manage a pool of persistent connections to other servers; connections are
+# reused by subsequent requests to the same server, and the number of
+# connections to each server is limited, so that requests wait for a
+# connection to become available when the limit is reached
+#############################################################################
+class ConnectionPool:
+
+    # Initialize object with the maximum number of connections per server
+    # and the connection timeouts
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+
+        # Idle connections and connection slots for each server, with
+        # the server (scheme, host, port) as key
+        self.idle_connections = {}
+        self.slots = {}
+
+        # Lock for synchronizing access to the connections and counters
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.requests = 0
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.waits = 0
+
+    # Get the semaphore that limits the connections to a server
+    def get_slots(self, server):
+
+        self.lock.acquire()
+        try:
+            if server not in self.slots:
+                self.slots[server] = threading.Semaphore(self.max_connections)
+                self.idle_connections[server] = []
+            return self.slots[server]
+        finally:
+            self.lock.release()
+
+    # Get an idle connection to a server, or create a new one
+    # Return a tuple (connection, reused flag)
+    def get_connection(self, server):
+
+        self.lock.acquire()
+        try:
+            idle_connections = self.idle_connections[server]
+            while idle_connections:
+                (connection, release_time) = idle_connections.pop()
+                if time.time() - release_time < self.idle_timeout:
+                    self.reused += 1
+                    return (connection, True)
+                connection.close()
+                self.discarded += 1
+            self.created += 1
+        finally:
+            self.lock.release()
+
+        (scheme, host, port) = server
+        if scheme == "https":
+            connection = httplib.HTTPSConnection(host, port, timeout=self.connect_timeout)
+        else:
+            connection = httplib.HTTPConnection(host, port, timeout=self.connect_timeout)
+        connection.connect()
+
+        if DO_DEBUG:
+            print "* DEBUG: connpool: Connected to %s://%s:%d." % (scheme, host, port)
+
+        return (connection, False)
+
+    # Make a connection available for subsequent requests to a server
+    def release_connection(self, server, connection):
+
+        self.lock.acquire()
+        try:
+            self.idle_connections[server].append((connection, time.time()))
+        finally:
+            self.lock.release()
+
+    # Discard a connection that cannot be reused
+    def discard_connection(self, connection):
+
+        connection.close()
+        self.lock.acquire()
+        try:
+            self.discarded += 1
+        finally:
+            self.lock.release()
+
+    # Send a POST request with a given body and additional headers to a
+    # server URL; the timeout, if provided, limits the read timeout of the
+    # pool for this request
+    # Return the response body, whatever the response status
+    # Note: IOError is raised in case of communication errors
+    def post(self, server_url, body, content_type="application/x-www-form-urlencoded",
+             headers={}, timeout=None):
+
+        url_parts = urlparse.urlsplit(server_url)
+        default_port = httplib.HTTPS_PORT if url_parts.scheme == "https" else httplib.HTTP_PORT
+        server = (url_parts.scheme, url_parts.hostname, url_parts.port or default_port)
+        path = url_parts.path or "/"
+        request_headers = dict(headers)
+        request_headers["Content-Type"] = content_type
+        read_timeout = self.read_timeout
+        if timeout != None:
+            read_timeout = min(read_timeout, timeout)
+
+        slots = self.get_slots(server)
+        if not slots.acquire(False):
+            self.lock.acquire()
+            try:
+                self.waits += 1
+            finally:
+                self.lock.release()
+            slots.acquire()
+
+        try:
+            self.lock.acquire()
+            try:
+                self.requests += 1
+            finally:
+                self.lock.release()
+
+            while True:
+                try:
+                    (connection, reused) = self.get_connection(server)
+                except (socket.error, httplib.HTTPException) as error:
+                    raise IOError("Cannot connect to %s: %s" % (server_url, error))
+                try:
+                    connection.sock.settimeout(read_timeout)
+                    connection.request("POST", path, body, request_headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                except (socket.error, httplib.HTTPException) as error:
+                    self.discard_connection(connection)
+                    # Send the request again via a new connection if the
+                    # server closed the reused one before receiving it
+                    if reused and (isinstance(error, httplib.BadStatusLine)
+                                   or getattr(error, "errno", None) in STALE_CONNECTION_ERRNOS):
+                        if DO_DEBUG:
+                            print "* DEBUG: connpool: Reused connection was closed => retry."
+                        continue
+                    raise IOError("Cannot communicate with %s: %s" % (server_url, error))
+
+                if response.will_close:
+                    self.discard_connection(connection)
+                else:
+                    self.release_connection(server, connection)
+                return data
+        finally:
+            slots.release()
+
+    # Close all idle connections
+    def close_all(self):
+
+        self.lock.acquire()
+        try:
+            for idle_connections in self.idle_connections.itervalues():
+                for (connection, release_time) in idle_connections:
+                    connection.close()
+                del idle_connections[:]
+        finally:
+            self.lock.release()
+
+    # Get the pool statistics as a dictionary
+    def get_statistics(self):
+
+        self.lock.acquire()
+        try:
+            return {"requests": self.requests, "created": self.created, "reused": self.reused,
+                    "discarded": self.discarded, "waits": self.waits,
+                    "idle": sum([len(idle_connections) for idle_connections in self.idle_connections.itervalues()])}
+        finally:
+            self.lock.release()
+
+    # Create a string representation of the pool state
+    def __str__(self):
+
+        statistics = self.get_statistics()
+        return "%d request(s), %d connection(s) created, %d reused, %d discarded, %d idle, %d wait(s)" % (
+            statistics["requests"], statistics["created"], statistics["reused"],
+            statistics["discarded"], statistics["idle"], statistics["waits"])
+
+
+#############################################################################
+# Testing code for the classes in this file
+#
+# This code will be executed _only_ when this module is called as the
+# main program
+#############################################################################
+if __name__ == '__main__':
+
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    import httpsrv
+
+    enabled = [True]
+
+    class EchoRequestHandler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.getheader("content-length")))
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    #########################################################################
+    # TEST #1
+    if enabled[0]:
+        print "TEST #1: Send 100 requests from 4 threads via a pool with 2 connections per server."
+        server = httpsrv.PooledHTTPServer(("127.0.0.1", 0), EchoRequestHandler, pool_size=4)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        url = "http://127.0.0.1:%d" % (server.server_address[1])
+
+        pool = ConnectionPool(max_connections=2)
+        def send_requests():
+            for index in range(25):
+                assert pool.post(url, "index=%d" % (index)) == "index=%d" % (index)
+
+        start_time = time.time()
+        clients = [threading.Thread(target=send_requests) for index in range(4)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        print "Connection pool: %s (%.3f s)" % (pool, time.time() - start_time)
+        assert pool.get_statistics()["created"] <= 2
+        pool.close_all()
+        server.shutdown()
@@ -8,13 +8,14 @@
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 import time
 import random
-import subprocess
 import os
 import sys
 import getopt
-from SocketServer import ThreadingMixIn
 
 # Internal imports
+import deadline
+import idempotency
+import httpsrv
 import userinfo
 import query
 from storyboard import Storyboard
@@ -37,6 +38,10 @@ RESPONSE_SUCCESS_ID_PREFIX = '[{"' + Storyboard.SERVER_STATUS_KEY + '": "' + Sto
 RESPONSE_SUCCESS_ID_SUFFIX = '"}]'
 RESPONSE_ERROR = '[{"' + Storyboard.SERVER_STATUS_KEY + '": "' + Storyboard.SERVER_STATUS_ERROR + '"}]'
 ENABLE_THREADS = True
+WORKER_POOL_SIZE = 32 # Number of worker threads in multi-threading mode
+ACCEPT_QUEUE_SIZE = 64 # Number of connections that can wait for a worker
+KEEP_ALIVE_TIMEOUT = 2 # Time after which persistent connections that wait for a request are closed (seconds)
+CONNECTION_TIMEOUT = 15 # Time after which connections that stop sending or receiving data are closed (seconds)
 
 # Names of files containing training-related information
 USERS_FILE  = "users.yml"
@@ -58,15 +63,40 @@ SIMULATION_RAND_MAX = 3 # Maximum limit for the random delay range
 DO_DEBUG = False
 USE_MOODLE = True
 
+#############################################################################
+# Shared objects
+#############################################################################
+
+# User information, which is reloaded only when the file changes
+user_info_cache = userinfo.UserInfoCache(DATABASE_DIR + USERS_FILE)
+
+# Outcomes of recent requests with an idempotency key, which are replayed
+# when the requests are retried
+outcome_cache = idempotency.OutcomeCache()
+
 #############################################################################
 # Manage the content server functionality
 #############################################################################
-class RequestHandler(BaseHTTPRequestHandler):
+class RequestHandler(httpsrv.KeepAliveMixin, BaseHTTPRequestHandler):
+
+    # Use persistent connections; idle connections are closed after
+    # KEEP_ALIVE_TIMEOUT, or as soon as other clients wait for a worker,
+    # so that they do not occupy workers
+    protocol_version = "HTTP/1.1"
+    timeout = CONNECTION_TIMEOUT
+
+    # Headers are written separately, hence small writes must not be
+    # delayed on persistent connections
+    disable_nagle_algorithm = True
 
     # List of valid actions recognized by this server
     VALID_ACTIONS = [query.Parameters.UPLOAD_CONTENT,
                      query.Parameters.REMOVE_CONTENT]
 
+    # List of actions that are executed only once for a given idempotency key
+    IDEMPOTENT_ACTIONS = [query.Parameters.UPLOAD_CONTENT,
+                          query.Parameters.REMOVE_CONTENT]
+
     #########################################################################
     # Print log messages with custom format
     # Default format is shown below:
@@ -83,10 +113,51 @@ class RequestHandler(BaseHTTPRequestHandler):
         # Get the parameters of the POST request
         params = query.Parameters(self)
 
+        # Response sent for the request, as a tuple (code, content)
+        self.response = None
+
+        # Requests with an idempotency key are executed only once, and
+        # retried requests receive the response of the original request;
+        # this applies only to the actions that modify the state
+        action = params.get(query.Parameters.ACTION)
+        idempotency_key = params.get(query.Parameters.IDEMPOTENCY_KEY)
+        if not idempotency_key or action not in self.IDEMPOTENT_ACTIONS:
+            self.handle_POST(params)
+            return
+
+        outcome_key = (action, idempotency_key)
+        (outcome, is_new) = outcome_cache.begin(outcome_key)
+        if not is_new:
+            print "* INFO: contsrv: Replay response for action %s with idempotency key %s." % (
+                action, idempotency_key)
+            self.replay_response(outcome.wait())
+            return
+
+        try:
+            self.handle_POST(params)
+        finally:
+            outcome_cache.complete(outcome_key, outcome, self.response)
+            if DO_DEBUG:
+                print "* DEBUG: contsrv: Idempotency outcome cache: %s" % (outcome_cache)
+
+    #########################################################################
+    # Handle the parameters and action of a POST message
+    def handle_POST(self, params):
+
         if DO_DEBUG:
             print SEPARATOR
             print "* INFO: contsrv: Request to content server: POST parameters: %s" % (params)
 
+        # Answer health probes right away, without verifying the user;
+        # being able to handle the request means the server is healthy
+        if params.get(query.Parameters.ACTION) == query.Parameters.HEALTH:
+            self.respond(RESPONSE_SUCCESS)
+            return
+
+        # Get the deadline of the request, if any; external programs that
+        # are still running when it expires are terminated
+        request_deadline = deadline.from_header(self.headers.getheader(deadline.DEADLINE_HEADER))
+
         # Get parameter values for given keys
         user_id = params.get(query.Parameters.USER)
         action = params.get(query.Parameters.ACTION)
@@ -108,16 +179,17 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         ## Handle user information
 
-        # Get user information from YAML file
-        # Note: Only reading data that is (potentially) modified externally =>
-        #       no need for synchronization
+        # Get user information from the cache, which reloads the YAML
+        # file only if it was modified externally
+        # Note: The cache handles synchronization internally
 
-        user_info = userinfo.UserInfo()
-        if not user_info.parse_YAML_file(DATABASE_DIR + USERS_FILE):
+        user_info = user_info_cache.get()
+        if not user_info:
             self.send_error(SERVER_ERROR, "User information issue")
             return
         if DO_DEBUG:
             user_info.pretty_print()
+            print "* DEBUG: contsrv: User information cache: %s" % (user_info_cache)
 
         # Check that user id is valid
         user_obj = user_info.get_user(user_id) 
@@ -158,31 +230,35 @@ class RequestHandler(BaseHTTPRequestHandler):
             if USE_MOODLE:
                 try:
                     # ./cylms.py --convert-content training_example.yml --config-file config_example --add-to-lms 1
-                    try:
-                        add_output = subprocess.check_output(
-                            ["python", "-u", CYLMS_PATH + "cylms.py", "--convert-content", content_file_name,
-                             "--config-file", CYLMS_CONFIG, "--add-to-lms", range_id], stderr=subprocess.STDOUT)
-                        # Find the activity id
-                        activity_id = None
-                        for output_line in add_output.splitlines():
-                            print(output_line)
-                            # Extract the course id
-                            activity_id_tag = "activity_id="
-                            if activity_id_tag in output_line:
-                                # Split line of form ...to LMS successfully => activity_id=101
-                                activity_id = output_line.split(activity_id_tag)[1]
-                                if DO_DEBUG: print("* DEBUG: contsrv: Extracted activity id from command output: {}".format(activity_id))
-                                response_content = RESPONSE_SUCCESS_ID_PREFIX + activity_id + RESPONSE_SUCCESS_ID_SUFFIX
-
-                        # Check whether the activity id was extracted
-                        if not activity_id:
-                            self.send_error(SERVER_ERROR, "LMS upload issue")
-                            return
-                    except subprocess.CalledProcessError as error:
-                        print("* ERROR: contsrv: Error message: {}".format(error.output)) 
+                    (exit_status, add_output, expired) = deadline.run_command(
+                        ["python", "-u", CYLMS_PATH + "cylms.py", "--convert-content", content_file_name,
+                         "--config-file", CYLMS_CONFIG, "--add-to-lms", range_id],
+                        request_deadline, capture_output=True)
+                    if expired:
+                        print "* ERROR: contsrv: CyLMS upload did not finish before the deadline."
+                        self.send_error(SERVER_ERROR, Storyboard.DEADLINE_EXPIRED_ERROR)
+                        return
+                    if exit_status != 0:
+                        print("* ERROR: contsrv: Error message: {}".format(add_output))
                         self.send_error(SERVER_ERROR, "CyLMS execution issue")
                         return
-                    
+                    # Find the activity id
+                    activity_id = None
+                    for output_line in add_output.splitlines():
+                        print(output_line)
+                        # Extract the course id
+                        activity_id_tag = "activity_id="
+                        if activity_id_tag in output_line:
+                            # Split line of form ...to LMS successfully => activity_id=101
+                            activity_id = output_line.split(activity_id_tag)[1]
+                            if DO_DEBUG: print("* DEBUG: contsrv: Extracted activity id from command output: {}".format(activity_id))
+                            response_content = RESPONSE_SUCCESS_ID_PREFIX + activity_id + RESPONSE_SUCCESS_ID_SUFFIX
+
+                    # Check whether the activity id was extracted
+                    if not activity_id:
+                        self.send_error(SERVER_ERROR, "LMS upload issue")
+                        return
+
                 except IOError:
                     self.send_error(SERVER_ERROR, "LMS upload I/O error")
                     return
@@ -197,7 +273,10 @@ class RequestHandler(BaseHTTPRequestHandler):
                 print Storyboard.SEPARATOR3
                 print "* INFO: contsrv: Simulate upload by sleeping %d s." % (sleep_time)
                 print Storyboard.SEPARATOR3
-                time.sleep(sleep_time)
+                if not deadline.sleep(sleep_time, request_deadline):
+                    print "* ERROR: contsrv: Simulated upload did not finish before the deadline."
+                    self.send_error(SERVER_ERROR, Storyboard.DEADLINE_EXPIRED_ERROR)
+                    return
 
                 # Simulate the success or failure of the upload
                 random_number = random.random()
@@ -230,8 +309,11 @@ class RequestHandler(BaseHTTPRequestHandler):
                     remove_arg = " --remove-from-lms {},{}".format(range_id, activity_id)
                     command = "python -u " + CYLMS_PATH + "cylms.py" + config_arg + remove_arg
                     if DO_DEBUG: print("* DEBUG: contsrv: command: " + command)
-                    return_value = os.system(command)
-                    exit_status = os.WEXITSTATUS(return_value)
+                    (exit_status, output, expired) = deadline.run_command(command, request_deadline, shell=True)
+                    if expired:
+                        print "* ERROR: contsrv: CyLMS removal did not finish before the deadline."
+                        self.send_error(SERVER_ERROR, Storyboard.DEADLINE_EXPIRED_ERROR)
+                        return
                     if exit_status == 0:
                         response_content = RESPONSE_SUCCESS
                     else:
@@ -251,7 +333,10 @@ class RequestHandler(BaseHTTPRequestHandler):
                 print Storyboard.SEPARATOR3
                 print "* INFO: contsrv: Simulate removal by sleeping %d s." % (sleep_time)
                 print Storyboard.SEPARATOR3
-                time.sleep(sleep_time)
+                if not deadline.sleep(sleep_time, request_deadline):
+                    print "* ERROR: contsrv: Simulated removal did not finish before the deadline."
+                    self.send_error(SERVER_ERROR, Storyboard.DEADLINE_EXPIRED_ERROR)
+                    return
 
                 # Simulate the success or failure of the upload
                 random_number = random.random()
@@ -264,17 +349,41 @@ class RequestHandler(BaseHTTPRequestHandler):
         else:
             print "* WARNING: contsrv: Unknown action: %s." % (action)
 
+        self.respond(response_content)
+
+        # Output server reply
+        print "* INFO: contsrv: Server response content: %s" % (response_content)
+
+    # Send the response of an earlier request with the same idempotency key
+    def replay_response(self, response):
+
+        if not response:
+            self.send_error(SERVER_ERROR, "Original request failed")
+        elif response[0] == SUCCESS_CODE:
+            self.respond(response[1])
+        else:
+            self.send_error(response[0], response[1])
+
+    # Send an error response to requester, and remember it
+    def send_error(self, code, message=None):
+
+        self.response = (code, message)
+        BaseHTTPRequestHandler.send_error(self, code, message)
+
+    # Send a successful response with the given content to requester
+    def respond(self, response_content):
+
+        self.response = (SUCCESS_CODE, response_content)
+
         # Send response header to requester (triggers log_message())
         self.send_response(SUCCESS_CODE)
         self.send_header("Content-type", "text/html")
+        self.send_header("Content-Length", str(len(response_content)))
         self.end_headers() 
 
         # Send scenario database content information to requester
         self.wfile.write(response_content)
 
-        # Output server reply
-        print "* INFO: contsrv: Server response content: %s" % (response_content)
-
 
 # Print usage information
 def usage():
@@ -284,13 +393,10 @@ def usage():
     print "-h, --help           Display help"
     print "-n, --no-lms         Disable LMS use => only simulate actions"
     print "-p, --path <PATH>    Set the location where CyLMS is installed"
-    print "-c, --config <FILE>  Set configuration file for LMS operations\n"
-
-# Use threads to handle multiple clients
-# Note: By using ForkingMixIn instead of ThreadingMixIn,
-# separate processes are used instead of threads
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread."""
+    print "-c, --config <FILE>  Set configuration file for LMS operations"
+    print "-w, --workers <NUMBER>"
+    print "                     Number of worker threads that handle requests (default: %d)" % (WORKER_POOL_SIZE)
+    print "-q, --queue <NUMBER> Number of connections that can wait for a worker (default: %d)\n" % (ACCEPT_QUEUE_SIZE)
 
 
 #############################################################################
@@ -301,10 +407,12 @@ def main(argv):
     global USE_MOODLE
     global CYLMS_PATH
     global CYLMS_CONFIG
+    global WORKER_POOL_SIZE
+    global ACCEPT_QUEUE_SIZE
 
     # Parse command line arguments
     try:
-        opts, args = getopt.getopt(argv, "hnp:c:", ["help", "no-lms", "path=", "config="])
+        opts, args = getopt.getopt(argv, "hnp:c:w:q:", ["help", "no-lms", "path=", "config=", "workers=", "queue="])
     except getopt.GetoptError as err:
         print "* ERROR: contsrv: Command-line argument error: %s" % (str(err))
         usage()
@@ -319,6 +427,24 @@ def main(argv):
             CYLMS_PATH = arg
         elif opt in ("-c", "--config"):
             CYLMS_CONFIG = arg
+        elif opt in ("-w", "--workers"):
+            try:
+                WORKER_POOL_SIZE = int(arg)
+                if WORKER_POOL_SIZE < 1:
+                    raise ValueError
+            except ValueError:
+                print "* ERROR: contsrv: Invalid number of workers: %s" % (arg)
+                usage()
+                sys.exit(1)
+        elif opt in ("-q", "--queue"):
+            try:
+                ACCEPT_QUEUE_SIZE = int(arg)
+                if ACCEPT_QUEUE_SIZE < 1:
+                    raise ValueError
+            except ValueError:
+                print "* ERROR: contsrv: Invalid queue size: %s" % (arg)
+                usage()
+                sys.exit(1)
 
     # Assign default value if necessary
     if not CYLMS_PATH:
@@ -342,9 +468,11 @@ def main(argv):
 
         multi_threading = ""
         if ENABLE_THREADS:
-            server = ThreadedHTTPServer((server_address, server_port),
-                                        RequestHandler)
-            multi_threading = " (multi-threading mode)"
+            server = httpsrv.PooledHTTPServer((server_address, server_port),
+                                              RequestHandler, WORKER_POOL_SIZE, ACCEPT_QUEUE_SIZE,
+                                              idle_timeout=KEEP_ALIVE_TIMEOUT)
+            multi_threading = " (multi-threading mode: %d workers, queue size %d)" % (
+                WORKER_POOL_SIZE, ACCEPT_QUEUE_SIZE)
         else:
             server = HTTPServer((server_address, server_port), RequestHandler)
 
@@ -0,0 +1,184 @@
+
+#############################################################################
+# Classes and functions for enforcing deadlines on the work done by
+# CyTrONE servers, including the external programs they execute
+#############################################################################
+
+# External imports
+import os
+import signal
+import subprocess
+import threading
+import time
+
+#############################################################################
+# Constants
+#############################################################################
+
+# Request header that carries the time remaining until the deadline of a
+# request (seconds); a relative value is used so that the servers do not
+# need synchronized clocks
+DEADLINE_HEADER = "X-Deadline-Remaining"
+
+# Time given to the work that releases resources after an action failed,
+# for instance because its deadline expired (seconds)
+CLEANUP_TIMEOUT = 600
+
+# Time between asking a process group to terminate, and killing it (seconds)
+TERMINATION_GRACE_TIME = 5
+
+# Interval for checking whether a process finished (seconds)
+POLL_INTERVAL = 0.1
+
+# Debugging constants
+DO_DEBUG = False
+
+
+#############################################################################
+# Manage the deadline of a piece of work
+#############################################################################
+class Deadline:
+
+    # Initialize object with the time available from now (seconds)
+    def __init__(self, timeout):
+
+        self.expiry_time = time.time() + timeout
+
+    # Get the time remaining until the deadline (seconds, at least 0)
+    def get_remaining(self):
+
+        return max(0, self.expiry_time - time.time())
+
+    # Determine whether the deadline expired
+    def is_expired(self):
+
+        return time.time() >= self.expiry_time
+
+    # Get the value of the deadline header for a downstream request
+    def get_header_value(self):
+
+        return "%.3f" % (self.get_remaining())
+
+    # Create a string representation of the deadline
+    def __str__(self):
+
+        return "%.3f s remaining" % (self.get_remaining())
+
+
+# Create a deadline from the value of the deadline header of a request; the
+# time remaining is limited to a maximum timeout, if provided
+# Return a Deadline object, or None if there is no deadline
+def from_header(header_value, max_timeout=None):
+
+    timeout = max_timeout
+    if header_value:
+        try:
+            timeout = float(header_value)
+        except ValueError:
+            print "* WARNING: deadline: Invalid deadline header value: %s." % (header_value)
+        else:
+            if max_timeout != None:
+                timeout = min(timeout, max_timeout)
+
+    if timeout == None:
+        return None
+    return Deadline(timeout)
+
+# Wait for a given duration, or until the deadline (if any) expires
+# Return True if the full duration elapsed before the deadline
+def sleep(duration, deadline=None):
+
+    if deadline and deadline.get_remaining() < duration:
+        time.sleep(deadline.get_remaining())
+        return False
+
+    time.sleep(duration)
+    return True
+
+# Terminate a process and all the processes it started, by signaling its
+# process group; processes that do not terminate within
+# TERMINATION_GRACE_TIME are killed
+def terminate_process_group(process):
+
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        return
+
+    grace_expiry_time = time.time() + TERMINATION_GRACE_TIME
+    while process.poll() == None and time.time() < grace_expiry_time:
+        time.sleep(POLL_INTERVAL)
+
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+# Execute a command in a new process group, which is terminated if the
+# deadline (if any) expires; if requested, the output of the command
+# (including errors) is captured, otherwise it goes to the server output
+# Return a tuple (exit status, output, expired flag); the exit status is
+# negative if the command was terminated by a signal
+def run_command(command, deadline=None, shell=False, capture_output=False):
+
+    output_chunks = []
+    process = subprocess.Popen(command, shell=shell, preexec_fn=os.setsid, close_fds=True,
+                               stdout=subprocess.PIPE if capture_output else None,
+                               stderr=subprocess.STDOUT if capture_output else None)
+
+    # Read the output in a separate thread, so that the command never
+    # blocks on a full pipe
+    reader = None
+    if capture_output:
+        reader = threading.Thread(target=lambda: output_chunks.append(process.stdout.read()))
+        reader.daemon = True
+        reader.start()
+
+    expired = False
+    while process.poll() == None:
+        if deadline and deadline.is_expired():
+            print "* WARNING: deadline: Deadline expired => terminate process %d." % (process.pid)
+            terminate_process_group(process)
+            expired = True
+            break
+        time.sleep(POLL_INTERVAL)
+
+    exit_status = process.wait()
+    if reader:
+        reader.join()
+
+    if DO_DEBUG:
+        print "* DEBUG: deadline: Command exited with status %d (expired: %s)." % (exit_status, expired)
+
+    return (exit_status, "".join(output_chunks), expired)
+
+
+#############################################################################
+# Testing code for the classes in this file
+#
+# This code will be executed _only_ when this module is called as the
+# main program
+#############################################################################
+if __name__ == '__main__':
+
+    enabled = [True, True]
+
+    #########################################################################
+    # TEST #1
+    if enabled[0]:
+        print "TEST #1: Run a command that finishes before the deadline."
+        (exit_status, output, expired) = run_command(["echo", "done"], Deadline(5), capture_output=True)
+        print "Exit status: %d, output: %s, expired: %s" % (exit_status, output.strip(), expired)
+        assert exit_status == 0 and not expired
+
+    #########################################################################
+    # TEST #2
+    if enabled[1]:
+        print "TEST #2: Terminate a command and its children when the deadline expires."
+        start_time = time.time()
+        (exit_status, output, expired) = run_command("sleep 30 | cat", Deadline(1), shell=True)
+        print "Exit status: %d, expired: %s (%.3f s)" % (exit_status, expired, time.time() - start_time)
+        assert expired and time.time() - start_time < 5
+        assert from_header("2.5", 1).get_remaining() <= 1
+        assert from_header(None) == None
+        assert not sleep(2, Deadline(0.1)) and sleep(0.1)
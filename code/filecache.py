@@ -0,0 +1,104 @@
+
+#############################################################################
+# Classes to cache information that is loaded from database files
+#############################################################################
+
+# External imports
+import os
+import threading
+
+# Debugging constants
+DO_DEBUG = False
+
+
+#############################################################################
+# Manage an object loaded from a file, which is kept in memory and
+# reloaded only when the file changes (as indicated by its modification
+# time, size and inode number)
+#############################################################################
+class FileCache:
+
+    # Initialize object for a given file; the load function receives
+    # the file name as argument, and must return the loaded object or
+    # None in case of error
+    def __init__(self, file_name, load_function):
+
+        self.file_name = file_name
+        self.load_function = load_function
+
+        # Lock for synchronizing access to the cached object and counters
+        self.lock = threading.Lock()
+
+        # Last successfully loaded object and the signature of the file
+        # it was loaded from
+        self.value = None
+        self.signature = None
+
+        # Signature of the last file version that could not be loaded
+        self.failed_signature = None
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    # Get the signature of the file, or None if the file cannot be accessed
+    def get_file_signature(self):
+
+        try:
+            file_stat = os.stat(self.file_name)
+        except OSError:
+            return None
+
+        return (file_stat.st_mtime, file_stat.st_size, file_stat.st_ino)
+
+    # Get the cached object, reloading it first if the file changed;
+    # if the new file version cannot be loaded, the last successfully
+    # loaded object is returned (None if there is no such object)
+    def get(self):
+
+        signature = self.get_file_signature()
+
+        self.lock.acquire()
+        try:
+            # Use the cached object if the file didn't change, or if
+            # the current file version is known to be invalid
+            if signature != None and (signature == self.signature
+                                      or signature == self.failed_signature):
+                self.hits += 1
+                return self.value
+
+            self.misses += 1
+            if DO_DEBUG:
+                print "* DEBUG: filecache: Load file '%s'." % (self.file_name)
+
+            value = self.load_function(self.file_name)
+            if value != None:
+                self.value = value
+                self.signature = signature
+                self.failed_signature = None
+            else:
+                self.errors += 1
+                self.failed_signature = signature
+                if self.value != None:
+                    print "* WARNING: filecache: Cannot load file '%s' => use previous version." % (self.file_name)
+
+            return self.value
+        finally:
+            self.lock.release()
+
+    # Get the cache statistics as a dictionary
+    def get_statistics(self):
+
+        self.lock.acquire()
+        try:
+            return {"hits": self.hits, "misses": self.misses, "errors": self.errors}
+        finally:
+            self.lock.release()
+
+    # Create a string representation of the cache state
+    def __str__(self):
+
+        statistics = self.get_statistics()
+        return "%s: %d hit(s), %d miss(es), %d error(s)" % (
+            self.file_name, statistics["hits"], statistics["misses"], statistics["errors"])
@@ -0,0 +1,350 @@
+
+#############################################################################
+# Classes for tracking the health of the servers that CyTrONE depends on,
+# so that requests fail fast while a server is unavailable
+#############################################################################
+
+# External imports
+import random
+import threading
+import time
+import urllib
+
+# Internal imports
+import connpool
+import query
+from storyboard import Storyboard
+
+#############################################################################
+# Constants
+#############################################################################
+
+# Circuit breaker states
+CLOSED = "closed"       # Requests are sent to the server
+OPEN = "open"           # Requests fail right away
+HALF_OPEN = "half-open" # A single trial request is sent to the server
+
+# Default number of consecutive failures after which a breaker opens
+DEFAULT_FAILURE_THRESHOLD = 3
+
+# Default time after which an open breaker lets a trial request through,
+# in case no probe succeeded meanwhile (seconds)
+DEFAULT_RESET_TIMEOUT = 30
+
+# Default interval between health probes, and time within which a probe
+# must be answered (seconds)
+DEFAULT_PROBE_INTERVAL = 5
+DEFAULT_PROBE_TIMEOUT = 2
+
+# Default number of times a request that failed because of a transient
+# error is retried, upper limit of the delay before the first retry, which
+# is doubled for each retry, and maximum upper limit (seconds)
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_BASE_DELAY = 0.5
+DEFAULT_RETRY_MAX_DELAY = 8
+
+# Debugging constants
+DO_DEBUG = False
+
+
+#############################################################################
+# Error raised when a server rejects a request because it is overloaded;
+# since the server works properly, such errors are not counted as failures
+# by circuit breakers
+#############################################################################
+class ServerOverloadError(IOError):
+    pass
+
+
+#############################################################################
+# Circuit breaker for the requests sent to a server: after a number of
+# consecutive failures the breaker opens, and requests fail right away
+# instead of waiting for the server; the breaker closes again when a
+# health probe or a trial request succeeds
+#############################################################################
+class CircuitBreaker:
+
+    # Initialize object with the server name and the breaker settings
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.open_time = None
+        self.last_error = None
+
+        # Statistics
+        self.rejected = 0
+        self.trips = 0
+
+        # Lock for synchronizing access to the breaker state
+        self.lock = threading.Lock()
+
+    # Change the breaker state; the lock must be held by the caller
+    def set_state(self, state):
+
+        if state == self.state:
+            return
+        print "* INFO: health: Circuit breaker for %s: %s -> %s." % (self.name, self.state, state)
+        self.state = state
+        if state == OPEN:
+            self.open_time = time.time()
+            self.trips += 1
+
+    # Determine whether a request may be sent to the server; in the
+    # half-open state only one trial request is allowed
+    def allow_request(self):
+
+        self.lock.acquire()
+        try:
+            if self.state == OPEN and time.time() - self.open_time >= self.reset_timeout:
+                self.set_state(HALF_OPEN)
+                return True
+            if self.state == CLOSED:
+                return True
+            self.rejected += 1
+            return False
+        finally:
+            self.lock.release()
+
+    # Determine whether the breaker lets requests through, without
+    # starting a trial request
+    def is_available(self):
+
+        self.lock.acquire()
+        try:
+            return self.state != OPEN or time.time() - self.open_time >= self.reset_timeout
+        finally:
+            self.lock.release()
+
+    # Record that a request or probe succeeded
+    def record_success(self):
+
+        self.lock.acquire()
+        try:
+            self.consecutive_failures = 0
+            self.last_error = None
+            self.set_state(CLOSED)
+        finally:
+            self.lock.release()
+
+    # Record that a request or probe failed, with a description of the error
+    def record_failure(self, error):
+
+        self.lock.acquire()
+        try:
+            self.consecutive_failures += 1
+            self.last_error = error
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.set_state(OPEN)
+        finally:
+            self.lock.release()
+
+    # Get the breaker state as a dictionary, for status output
+    def get_representation(self):
+
+        self.lock.acquire()
+        try:
+            return {"name": self.name, "state": self.state,
+                    "consecutive_failures": self.consecutive_failures,
+                    "last_error": self.last_error, "trips": self.trips, "rejected": self.rejected}
+        finally:
+            self.lock.release()
+
+    # Create a string representation of the breaker state
+    def __str__(self):
+
+        return "%s: %s (%d consecutive failure(s))" % (self.name, self.state, self.consecutive_failures)
+
+
+# Get the delay before a given retry of a request (seconds); the delay is
+# chosen randomly up to an exponentially increasing limit, so that the
+# retries of concurrent requests are spread out
+def get_retry_delay(retry_count, base_delay=DEFAULT_RETRY_BASE_DELAY, max_delay=DEFAULT_RETRY_MAX_DELAY):
+
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (retry_count - 1)))
+
+# Send a request to a server with a given name via the function send, which
+# returns the response or raises IOError, and retry it up to a given number
+# of times with jittered exponential backoff, but only if the delay leaves
+# time before the deadline (if any); the circuit breaker of the server (if
+# any) is checked once, and a single failure is recorded if the request is
+# given up, so that the retries of one request cannot open the breaker
+# Return the response
+# Note: IOError is raised if the request is given up, and right away if the
+# circuit breaker is open
+def send_with_retries(name, send, breaker=None, request_deadline=None, retries=DEFAULT_RETRIES,
+                      base_delay=DEFAULT_RETRY_BASE_DELAY, max_delay=DEFAULT_RETRY_MAX_DELAY):
+
+    if breaker and not breaker.allow_request():
+        raise IOError("Request not sent, since the %s is unavailable" % (breaker.name))
+
+    retry_count = 0
+    while True:
+        try:
+            response = send()
+        except IOError as error:
+            # Failures caused by the expiry of the deadline are not counted
+            # nor retried, since the server may have been working properly
+            if request_deadline and request_deadline.is_expired():
+                raise
+
+            # Overloaded servers answer, hence they are available
+            is_overload = isinstance(error, ServerOverloadError)
+            if breaker and is_overload:
+                breaker.record_success()
+
+            retry_count += 1
+            retry_delay = get_retry_delay(retry_count, base_delay, max_delay)
+            if retry_count > retries or (request_deadline and retry_delay >= request_deadline.get_remaining()):
+                if breaker and not is_overload:
+                    breaker.record_failure(str(error))
+                raise
+            print "* WARNING: health: Request to %s failed: %s => retry #%d in %.3f s." % (
+                name, error, retry_count, retry_delay)
+            time.sleep(retry_delay)
+            continue
+
+        if breaker:
+            breaker.record_success()
+        return response
+
+
+#############################################################################
+# Probe the health of servers periodically via their health action, and
+# record the results in the circuit breakers of the servers
+#############################################################################
+class HealthMonitor:
+
+    # Initialize object with a dictionary of circuit breakers that has the
+    # server URLs as keys, the interval between probes and the probe timeout
+    def __init__(self, breakers, probe_interval=DEFAULT_PROBE_INTERVAL, probe_timeout=DEFAULT_PROBE_TIMEOUT):
+
+        self.breakers = breakers
+        self.probe_interval = probe_interval
+
+        # Probes use their own connections, so that they are not delayed
+        # by the requests that occupy the connections to a server
+        self.pool = connpool.ConnectionPool(1, probe_timeout, probe_timeout)
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    # Probe a server, and return an error description, or None if the
+    # server is healthy
+    def probe(self, server_url):
+
+        try:
+            data = self.pool.post(server_url, urllib.urlencode({query.Parameters.ACTION: query.Parameters.HEALTH}))
+        except IOError as error:
+            return str(error)
+
+        (status, message) = query.Response.parse_server_response(data)
+        if status != Storyboard.SERVER_STATUS_SUCCESS:
+            return message or "Server reported an unhealthy status"
+        return None
+
+    # Probe all servers once
+    def probe_all(self):
+
+        for (server_url, breaker) in self.breakers.items():
+            error = self.probe(server_url)
+            if error:
+                if DO_DEBUG or breaker.state == CLOSED:
+                    print "* WARNING: health: Probe of %s failed: %s." % (breaker.name, error)
+                breaker.record_failure(error)
+            else:
+                breaker.record_success()
+
+    # Probe the servers until the monitor is stopped
+    def run(self):
+
+        while not self.stop_event.is_set():
+            self.probe_all()
+            self.stop_event.wait(self.probe_interval)
+
+    # Start probing in a background thread
+    def start(self):
+
+        self.thread = threading.Thread(target=self.run, name="health-monitor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Stop probing
+    def stop(self):
+
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.pool.close_all()
+
+
+#############################################################################
+# Testing code for the classes in this file
+#
+# This code will be executed _only_ when this module is called as the
+# main program
+#############################################################################
+if __name__ == '__main__':
+
+    enabled = [True, True, True]
+
+    #########################################################################
+    # TEST #1
+    if enabled[0]:
+        print "TEST #1: Open a circuit breaker after consecutive failures, and close it after a trial request."
+        breaker = CircuitBreaker("test server", failure_threshold=2, reset_timeout=0.2)
+        breaker.record_failure("error 1")
+        assert breaker.allow_request()
+        breaker.record_failure("error 2")
+        assert not breaker.allow_request() and not breaker.is_available()
+        time.sleep(0.2)
+        assert breaker.allow_request() and breaker.state == HALF_OPEN
+        assert not breaker.allow_request()
+        breaker.record_success()
+        assert breaker.allow_request()
+        print "Breaker: %s" % (breaker.get_representation())
+
+    #########################################################################
+    # TEST #2
+    if enabled[1]:
+        print "TEST #2: Probe a server that does not respond."
+        breaker = CircuitBreaker("unreachable server", failure_threshold=1)
+        monitor = HealthMonitor({"http://127.0.0.1:9": breaker}, probe_timeout=0.5)
+        start_time = time.time()
+        monitor.probe_all()
+        print "Breaker: %s (%.3f s)" % (breaker, time.time() - start_time)
+        assert breaker.state == OPEN
+        monitor.stop()
+
+    #########################################################################
+    # TEST #3
+    if enabled[2]:
+        print "TEST #3: Retry requests without opening the circuit breaker of the server."
+        breaker = CircuitBreaker("flaky server", failure_threshold=3)
+        attempts = []
+
+        def send_flaky_request():
+            attempts.append(1)
+            if len(attempts) <= DEFAULT_RETRIES:
+                raise IOError("transient error #%d" % (len(attempts)))
+            return "response"
+
+        assert send_with_retries("flaky server", send_flaky_request, breaker, base_delay=0.01) == "response"
+        assert len(attempts) == DEFAULT_RETRIES + 1 and breaker.state == CLOSED
+
+        def send_overloaded_request():
+            raise ServerOverloadError("overloaded")
+
+        breaker = CircuitBreaker("overloaded server", failure_threshold=1)
+        try:
+            send_with_retries("overloaded server", send_overloaded_request, breaker, base_delay=0.01)
+            assert False
+        except ServerOverloadError:
+            pass
+        print "Breaker: %s" % (breaker)
+        assert breaker.state == CLOSED
@@ -0,0 +1,374 @@
+
+#############################################################################
+# Classes for queuing the jobs that run on hosts, so that only a limited
+# number of jobs are executed at the same time on each host, and jobs with
+# a higher priority are executed first
+#############################################################################
+
+# External imports
+from collections import deque
+import threading
+import time
+
+# Internal imports
+import query
+from storyboard import Storyboard
+
+#############################################################################
+# Constants
+#############################################################################
+
+# Default maximum number of jobs executed at the same time on a host
+DEFAULT_MAX_RUNNING = 2
+
+# Default number of additional jobs that can be executed at the same time
+# on a host, but only by interactive jobs
+DEFAULT_RESERVED_RUNNING = 1
+
+# Default maximum number of jobs that wait for execution
+DEFAULT_MAX_WAITING = 16
+
+# Priorities of jobs, from the highest to the lowest
+PRIORITIES = query.Parameters.PRIORITIES
+INTERACTIVE_PRIORITY = query.Parameters.INTERACTIVE
+NORMAL_PRIORITY = query.Parameters.NORMAL
+
+# Number of recent waiting times used for computing percentiles
+WAIT_SAMPLE_COUNT = 1000
+
+# Debugging constants
+DO_DEBUG = False
+
+
+#############################################################################
+# Manage the information about a queued job
+#############################################################################
+class Ticket:
+
+    # Initialize object with the job name, the hosts the job runs on, and
+    # the job priority
+    def __init__(self, name, hosts, priority=NORMAL_PRIORITY):
+
+        self.name = name
+        self.hosts = list(hosts)
+        self.priority = priority
+        self.rank = PRIORITIES.index(priority)
+        self.enqueue_time = time.time()
+        self.start_time = None
+
+    # Determine whether the job runs on some of the hosts of another job
+    def shares_host(self, ticket):
+
+        for host in self.hosts:
+            if host in ticket.hosts:
+                return True
+        return False
+
+    # Create a string representation of the ticket
+    def __str__(self):
+
+        return "%s (hosts: %s, priority: %s)" % (self.name, ", ".join(self.hosts), self.priority)
+
+
+#############################################################################
+# Collect statistics about the jobs of a given priority
+#############################################################################
+class PriorityStatistics:
+
+    # Initialize object
+    def __init__(self):
+
+        self.started = 0
+        self.rejected = 0
+        self.expired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        # Recent waiting times (seconds), for computing percentiles
+        self.recent_waits = deque(maxlen=WAIT_SAMPLE_COUNT)
+
+    # Record that a job started after waiting a given time (seconds)
+    def record_start(self, wait_time):
+
+        self.started += 1
+        self.total_wait += wait_time
+        self.max_wait = max(self.max_wait, wait_time)
+        self.recent_waits.append(wait_time)
+
+    # Get a percentile of the recent waiting times (seconds)
+    def get_wait_percentile(self, percentile):
+
+        if not self.recent_waits:
+            return 0.0
+        waits = sorted(self.recent_waits)
+        return waits[min(len(waits) - 1, int(len(waits) * percentile / 100.0))]
+
+    # Get the statistics as a dictionary, with times in seconds
+    def get_representation(self):
+
+        mean_wait = 0.0
+        if self.started:
+            mean_wait = self.total_wait / self.started
+        return {"started": self.started, "rejected": self.rejected, "expired": self.expired,
+                "mean_wait": round(mean_wait, 3), "p50_wait": round(self.get_wait_percentile(50), 3),
+                "p95_wait": round(self.get_wait_percentile(95), 3), "max_wait": round(self.max_wait, 3)}
+
+
+#############################################################################
+# Execute jobs in priority order, and in arrival order for jobs with the same
+# priority, with at most a given number of jobs running at the same time on
+# each host; a job starts when all its hosts have a free slot, and no waiting
+# job before it needs one of its hosts; interactive jobs can also use a
+# number of reserved slots, so that they do not wait for other jobs to end
+#############################################################################
+class HostQueue:
+
+    # Initialize object with the maximum number of jobs running on a host,
+    # the maximum number of waiting jobs, and the number of slots reserved
+    # for interactive jobs on each host
+    def __init__(self, max_running=DEFAULT_MAX_RUNNING, max_waiting=DEFAULT_MAX_WAITING,
+                 reserved_running=DEFAULT_RESERVED_RUNNING):
+
+        self.max_running = max_running
+        self.max_waiting = max_waiting
+        self.reserved_running = reserved_running
+
+        # Number of running jobs, with the host as key
+        self.running = {}
+
+        # Waiting jobs (as Ticket objects), in execution order
+        self.waiting = []
+
+        # Condition for synchronizing access to the queue, and for waking
+        # up the waiting jobs when a job ends
+        self.condition = threading.Condition()
+
+        # Statistics for each priority
+        self.statistics = dict([(priority, PriorityStatistics()) for priority in PRIORITIES])
+
+    # Get the position of a waiting job, that is, the number of jobs that
+    # must start before it, plus one; the lock must be held by the caller
+    def get_ticket_position(self, ticket):
+
+        position = 1
+        for earlier_ticket in self.waiting:
+            if earlier_ticket is ticket:
+                break
+            if earlier_ticket.shares_host(ticket):
+                position += 1
+        return position
+
+    # Determine whether a waiting job can start; the lock must be held by
+    # the caller
+    def can_start(self, ticket):
+
+        max_running = self.max_running
+        if ticket.priority == INTERACTIVE_PRIORITY:
+            max_running += self.reserved_running
+        for host in ticket.hosts:
+            if self.running.get(host, 0) >= max_running:
+                return False
+        return self.get_ticket_position(ticket) == 1
+
+    # Wait until a job with a given name and priority that runs on the
+    # given hosts can start, but not beyond the deadline (if any)
+    # Return a tuple (ticket, error message); on success the error message
+    # is None, and the ticket must be passed to leave() when the job ends
+    def enter(self, name, hosts, deadline=None, priority=NORMAL_PRIORITY):
+
+        self.condition.acquire()
+        try:
+            ticket = Ticket(name, hosts, priority)
+            statistics = self.statistics[priority]
+
+            # Only the waiting jobs that are executed before the new job
+            # count towards the limit, so that jobs with a lower priority
+            # cannot cause the rejection of jobs with a higher one
+            insert_index = len(self.waiting)
+            for (index, waiting_ticket) in enumerate(self.waiting):
+                if waiting_ticket.rank > ticket.rank:
+                    insert_index = index
+                    break
+            if insert_index >= self.max_waiting:
+                print "* WARNING: hostqueue: Queue is full => reject job %s." % (ticket)
+                statistics.rejected += 1
+                return (None, Storyboard.SERVER_OVERLOAD_ERROR)
+
+            self.waiting.insert(insert_index, ticket)
+            position = None
+            while not self.can_start(ticket):
+                # Report the position of the job whenever it changes
+                if position != self.get_ticket_position(ticket):
+                    position = self.get_ticket_position(ticket)
+                    print "* INFO: hostqueue: Job %s waits at position %d." % (ticket, position)
+                if deadline and deadline.is_expired():
+                    print "* WARNING: hostqueue: Deadline expired while job %s was waiting." % (name)
+                    self.waiting.remove(ticket)
+                    statistics.expired += 1
+                    # Later jobs may be able to start now
+                    self.condition.notify_all()
+                    return (None, Storyboard.DEADLINE_EXPIRED_ERROR)
+                self.condition.wait(deadline.get_remaining() if deadline else None)
+
+            self.waiting.remove(ticket)
+            for host in ticket.hosts:
+                self.running[host] = self.running.get(host, 0) + 1
+            ticket.start_time = time.time()
+            statistics.record_start(ticket.start_time - ticket.enqueue_time)
+            if position or DO_DEBUG:
+                print "* INFO: hostqueue: Job %s starts after waiting %.3f s." % (
+                    ticket, ticket.start_time - ticket.enqueue_time)
+            # Later jobs that use other hosts may be able to start too
+            self.condition.notify_all()
+            return (ticket, None)
+        finally:
+            self.condition.release()
+
+    # Record that the job with a given ticket ended
+    def leave(self, ticket):
+
+        self.condition.acquire()
+        try:
+            for host in ticket.hosts:
+                self.running[host] -= 1
+                if not self.running[host]:
+                    del self.running[host]
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    # Get the position of the waiting job with a given name
+    # Return the position, or None if no such job is waiting
+    def get_position(self, name):
+
+        self.condition.acquire()
+        try:
+            for ticket in self.waiting:
+                if ticket.name == name:
+                    return self.get_ticket_position(ticket)
+            return None
+        finally:
+            self.condition.release()
+
+    # Get the number of waiting jobs
+    def get_waiting_count(self):
+
+        self.condition.acquire()
+        try:
+            return len(self.waiting)
+        finally:
+            self.condition.release()
+
+    # Get the queue state and the statistics for each priority as a
+    # dictionary, for status output
+    def get_representation(self):
+
+        self.condition.acquire()
+        try:
+            priorities = {}
+            for priority in PRIORITIES:
+                priorities[priority] = self.statistics[priority].get_representation()
+                priorities[priority]["waiting"] = len([ticket for ticket in self.waiting
+                                                       if ticket.priority == priority])
+            return {"max_running": self.max_running, "reserved_running": self.reserved_running,
+                    "max_waiting": self.max_waiting, "running": dict(self.running), "priorities": priorities}
+        finally:
+            self.condition.release()
+
+    # Create a string representation of the queue state
+    def __str__(self):
+
+        representation = self.get_representation()
+        running = ", ".join(["%s: %d" % (host, count) for (host, count) in sorted(representation["running"].items())])
+        priorities = ", ".join(["%s: %d waiting, %d started" % (priority, representation["priorities"][priority]["waiting"],
+                                                               representation["priorities"][priority]["started"])
+                                for priority in PRIORITIES])
+        return "running {%s}, %s" % (running, priorities)
+
+
+#############################################################################
+# Testing code for the classes in this file
+#
+# This code will be executed _only_ when this module is called as the
+# main program
+#############################################################################
+if __name__ == '__main__':
+
+    import deadline
+
+    enabled = [True, True, True]
+
+    #########################################################################
+    # TEST #1
+    if enabled[0]:
+        print "TEST #1: Limit the number of jobs running at the same time on each host."
+        queue = HostQueue(max_running=2)
+        lock = threading.Lock()
+        running = {"host1": 0, "host2": 0}
+        maximum = {"host1": 0, "host2": 0}
+
+        def run_job(name, host):
+            (ticket, error_message) = queue.enter(name, [host])
+            with lock:
+                running[host] += 1
+                maximum[host] = max(maximum[host], running[host])
+            time.sleep(0.1)
+            with lock:
+                running[host] -= 1
+            queue.leave(ticket)
+
+        jobs = [threading.Thread(target=run_job, args=("job%d" % (index), "host%d" % (index % 2 + 1)))
+                for index in range(10)]
+        start_time = time.time()
+        for job in jobs:
+            job.start()
+        for job in jobs:
+            job.join()
+        print "Queue: %s (%.3f s)" % (queue, time.time() - start_time)
+        assert maximum == {"host1": 2, "host2": 2} and queue.statistics["normal"].started == 10
+
+    #########################################################################
+    # TEST #2
+    if enabled[1]:
+        print "TEST #2: Report positions, and reject jobs when the queue is full or the deadline expires."
+        queue = HostQueue(max_running=1, max_waiting=2)
+        (first_ticket, error_message) = queue.enter("first", ["host1"])
+        waiting_job = threading.Thread(target=queue.enter, args=("second", ["host1"]))
+        waiting_job.start()
+        time.sleep(0.1)
+        assert queue.get_position("second") == 1
+        assert queue.enter("third", ["host1"], deadline.Deadline(0.2)) == (None, Storyboard.DEADLINE_EXPIRED_ERROR)
+        queue.waiting.append(Ticket("filler", ["host2"]))
+        assert queue.enter("fourth", ["host1"]) == (None, Storyboard.SERVER_OVERLOAD_ERROR)
+        queue.waiting.pop()
+        queue.leave(first_ticket)
+        waiting_job.join()
+        print "Queue: %s" % (queue)
+        assert queue.get_position("second") == None and queue.running == {"host1": 1}
+
+    #########################################################################
+    # TEST #3
+    if enabled[2]:
+        print "TEST #3: Start jobs in priority order, and interactive jobs in reserved slots."
+        queue = HostQueue(max_running=1, reserved_running=1)
+        order = []
+
+        def run_job(name, priority):
+            (ticket, error_message) = queue.enter(name, ["host1"], priority=priority)
+            order.append(name)
+            time.sleep(0.1)
+            queue.leave(ticket)
+
+        (first_ticket, error_message) = queue.enter("first", ["host1"])
+        jobs = []
+        for (name, priority) in [("batch", "batch"), ("normal", "normal"), ("interactive", "interactive")]:
+            jobs.append(threading.Thread(target=run_job, args=(name, priority)))
+            jobs[-1].start()
+            time.sleep(0.05)
+        time.sleep(0.05)
+        queue.leave(first_ticket)
+        for job in jobs:
+            job.join()
+        print "Start order: %s => %s" % (order, queue)
+        assert order == ["interactive", "normal", "batch"]
+        assert queue.get_representation()["priorities"]["interactive"]["max_wait"] < 0.05
@@ -0,0 +1,415 @@
+
+#############################################################################
+# Classes for running the CyTrONE web servers with a bounded pool of
+# worker threads
+#############################################################################
+
+# External imports
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import select
+import socket
+import sys
+import threading
+import time
+import Queue
+
+# Internal imports
+from storyboard import Storyboard
+
+#############################################################################
+# Constants
+#############################################################################
+
+# Default number of worker threads that handle requests
+DEFAULT_POOL_SIZE = 32
+
+# Default number of accepted connections that can wait for a worker
+DEFAULT_QUEUE_SIZE = 64
+
+# Default time after which persistent connections that wait for their next
+# request are closed, so that idle clients release their worker (seconds)
+DEFAULT_IDLE_TIMEOUT = 2
+
+# Delay that clients are advised to wait before retrying a request that
+# was rejected because the server is overloaded (seconds)
+DEFAULT_RETRY_AFTER = 1
+
+# HTTP status used for rejected connections
+SERVICE_UNAVAILABLE = 503
+
+# Maximum time during which the request data of a rejected connection is
+# discarded before closing it, so that clients receive the response instead
+# of a connection reset (seconds)
+REJECT_LINGER_TIME = 1
+
+# Amount of request data discarded at once from a rejected connection (bytes)
+RECEIVE_SIZE = 65536
+
+# Debugging constants
+DO_DEBUG = False
+
+
+#############################################################################
+# Functions
+#############################################################################
+
+# Get the response sent to clients when the server is overloaded, which
+# advises them to retry the request after a given delay (seconds)
+def get_overload_response(retry_after=DEFAULT_RETRY_AFTER):
+
+    response_body = '[{{"{0}": "{1}", "{2}": "{3}"}}]'.format(
+        Storyboard.SERVER_STATUS_KEY, Storyboard.SERVER_STATUS_ERROR,
+        Storyboard.SERVER_MESSAGE_KEY, Storyboard.SERVER_OVERLOAD_ERROR)
+    return ("HTTP/1.0 %d Service Unavailable\r\n"
+            "Retry-After: %d\r\n"
+            "Content-Type: text/html\r\n"
+            "Content-Length: %d\r\n"
+            "Connection: close\r\n"
+            "\r\n%s") % (SERVICE_UNAVAILABLE, retry_after, len(response_body), response_body)
+
+
+#############################################################################
+# HTTP server that handles requests via a fixed number of worker threads;
+# accepted connections wait in a bounded queue until a worker is available,
+# and when the queue is full, connections are rejected with an explicit
+# overload response that includes a Retry-After header; request handlers
+# that support persistent connections should derive from KeepAliveMixin,
+# so that idle connections do not hold workers
+#############################################################################
+class PooledHTTPServer(HTTPServer):
+
+    # Initialize object with the server address, the request handler class,
+    # the number of worker threads, the size of the accept queue, and the
+    # time after which idle persistent connections are closed
+    def __init__(self, server_address, handler_class, pool_size=DEFAULT_POOL_SIZE,
+                 queue_size=DEFAULT_QUEUE_SIZE, retry_after=DEFAULT_RETRY_AFTER,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+
+        # The listen backlog of the socket matches the accept queue
+        self.request_queue_size = queue_size
+        HTTPServer.__init__(self, server_address, handler_class)
+
+        self.pool_size = pool_size
+        self.retry_after = retry_after
+        self.idle_timeout = idle_timeout
+        self.request_queue = Queue.Queue(queue_size)
+        self.rejected_count = 0
+
+        # Rejected connections are closed by a separate thread, so that the
+        # thread that accepts connections never waits for clients
+        self.closing_queue = Queue.Queue()
+        self.closer = threading.Thread(target=self.run_closer, name="closer")
+        self.closer.daemon = True
+        self.closer.start()
+
+        self.workers = []
+        for index in range(pool_size):
+            worker = threading.Thread(target=self.run_worker, name="worker-%d" % (index + 1))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    # Queue a connection for the workers, or reject it if the queue is full
+    # Note: Called from the thread that accepts connections
+    def process_request(self, request, client_address):
+
+        try:
+            self.request_queue.put_nowait((request, client_address))
+        except Queue.Full:
+            self.reject_request(request, client_address)
+
+    # Determine whether accepted connections wait for a worker
+    def has_waiting_connections(self):
+
+        return not self.request_queue.empty()
+
+    # Handle the queued connections until the server is closed
+    def run_worker(self):
+
+        while True:
+            item = self.request_queue.get()
+            if item == None:
+                break
+            (request, client_address) = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    # Report errors raised while handling a connection; communication
+    # errors, such as those caused by clients that close persistent
+    # connections abruptly, are not reported
+    def handle_error(self, request, client_address):
+
+        error = sys.exc_info()[1]
+        if isinstance(error, socket.error):
+            if DO_DEBUG:
+                print "* DEBUG: httpsrv: Connection from %s:%d failed: %s." % (
+                    client_address[0], client_address[1], error)
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+    # Respond to a connection that cannot be handled because the server is
+    # overloaded, and pass it to the closer thread
+    def reject_request(self, request, client_address):
+
+        self.rejected_count += 1
+        print "* WARNING: httpsrv: Server overloaded (%d queued) => reject request from %s:%d (rejected so far: %d)." % (
+            self.request_queue.qsize(), client_address[0], client_address[1], self.rejected_count)
+
+        response = get_overload_response(self.retry_after)
+
+        # Note: The socket is non-blocking, so that the thread that accepts
+        # connections never waits for clients; the response is small enough
+        # to fit in the socket buffer
+        try:
+            request.setblocking(0)
+            request.send(response)
+            request.shutdown(socket.SHUT_WR)
+        except socket.error as error:
+            if DO_DEBUG:
+                print "* DEBUG: httpsrv: Cannot send overload response: %s." % (error)
+        self.closing_queue.put((request, time.time() + REJECT_LINGER_TIME))
+
+    # Close the rejected connections once their clients close them or the
+    # linger time expires, meanwhile discarding the request data they send
+    def run_closer(self):
+
+        poller = select.poll()
+        pending = {}
+        while True:
+            # Wait for rejected connections only when none are pending
+            items = []
+            if not pending:
+                items.append(self.closing_queue.get())
+            try:
+                while True:
+                    items.append(self.closing_queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            for item in items:
+                if item == None:
+                    for (request, expiry_time) in pending.values():
+                        request.close()
+                    return
+                (request, expiry_time) = item
+                pending[request.fileno()] = item
+                poller.register(request, select.POLLIN)
+
+            ready_fds = [fd for (fd, event) in poller.poll(100)]
+            current_time = time.time()
+            for (fd, (request, expiry_time)) in pending.items():
+                if current_time < expiry_time:
+                    if fd not in ready_fds:
+                        continue
+                    try:
+                        if request.recv(RECEIVE_SIZE):
+                            continue
+                    except socket.error:
+                        pass
+                poller.unregister(fd)
+                del pending[fd]
+                request.close()
+
+    # Stop the worker threads after the queued connections are handled,
+    # close the rejected connections, and close the server socket
+    def server_close(self):
+
+        HTTPServer.server_close(self)
+        for worker in self.workers:
+            self.request_queue.put(None)
+        self.workers = []
+        self.closing_queue.put(None)
+
+
+#############################################################################
+# Request handler mixin for persistent connections served by
+# PooledHTTPServer: once a response is sent, the connection is closed if
+# other connections wait for a worker, and otherwise the next request must
+# start within the idle timeout of the server; the request handler timeout
+# still applies to reading the rest of the request and to the response
+# Note: Must be listed before BaseHTTPRequestHandler in the base classes
+#############################################################################
+class KeepAliveMixin:
+
+    # Number of requests received on the connection
+    request_count = 0
+
+    # Whether the handler waits for the next request of the connection
+    waiting_for_request = False
+
+    def handle_one_request(self):
+
+        if self.request_count > 0 and isinstance(self.server, PooledHTTPServer):
+            if self.server.has_waiting_connections():
+                self.close_connection = 1
+                return
+            self.waiting_for_request = True
+            self.connection.settimeout(self.server.idle_timeout)
+        BaseHTTPRequestHandler.handle_one_request(self)
+
+    # Restore the request handler timeout once a request starts
+    def parse_request(self):
+
+        self.request_count += 1
+        if self.waiting_for_request:
+            self.waiting_for_request = False
+            self.connection.settimeout(self.timeout)
+        return BaseHTTPRequestHandler.parse_request(self)
+
+    # Idle connections that time out are closed without reporting an error
+    def log_error(self, format, *args):
+
+        if not self.waiting_for_request:
+            BaseHTTPRequestHandler.log_error(self, format, *args)
+
+
+#############################################################################
+# Testing code for the classes in this file
+#
+# This code will be executed _only_ when this module is called as the
+# main program
+#############################################################################
+if __name__ == '__main__':
+
+    import time
+    import urllib2
+    import connpool
+
+    enabled = [True, True, True]
+
+    class SlowRequestHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            time.sleep(0.5)
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write("OK")
+
+        def log_message(self, format, *args):
+            pass
+
+    #########################################################################
+    # TEST #1
+    if enabled[0]:
+        print "TEST #1: Send 16 concurrent requests to a server with 2 workers and a queue of 4."
+        server = PooledHTTPServer(("127.0.0.1", 0), SlowRequestHandler, pool_size=2, queue_size=4)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        url = "http://127.0.0.1:%d/" % (server.server_address[1])
+
+        results = []
+        def send_request():
+            try:
+                results.append(urllib2.urlopen(url).getcode())
+            except urllib2.HTTPError as error:
+                results.append((error.code, error.info().getheader("Retry-After")))
+
+        start_time = time.time()
+        clients = [threading.Thread(target=send_request) for index in range(16)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        print "Results: %s (%.3f s)" % (sorted(results), time.time() - start_time)
+        assert len(results) == 16 and 200 in results
+        server.shutdown()
+        workers = server.workers
+        server.server_close()
+        for worker in workers:
+            worker.join()
+
+    #########################################################################
+    # TEST #2
+    if enabled[1]:
+        print "\nTEST #2: Send 100 requests to a busy server with 1 worker and a queue of 1."
+        handler_event = threading.Event()
+        class BlockedRequestHandler(SlowRequestHandler):
+            def do_GET(self):
+                handler_event.wait()
+                SlowRequestHandler.do_GET(self)
+        server = PooledHTTPServer(("127.0.0.1", 0), BlockedRequestHandler, pool_size=1, queue_size=1)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        url = "http://127.0.0.1:%d/" % (server.server_address[1])
+
+        # Occupy the worker and the queue
+        busy_clients = [threading.Thread(target=send_request) for index in range(2)]
+        for client in busy_clients:
+            client.start()
+            time.sleep(0.2)
+
+        results = []
+        start_time = time.time()
+        for index in range(100):
+            send_request()
+        duration = time.time() - start_time
+        print "Rejected: %d of 100 (%.3f s)" % (results.count((SERVICE_UNAVAILABLE, "1")), duration)
+        assert results.count((SERVICE_UNAVAILABLE, "1")) == 100 and duration < 2
+        handler_event.set()
+        for client in busy_clients:
+            client.join()
+        server.shutdown()
+        workers = server.workers
+        server.server_close()
+        for worker in workers:
+            worker.join()
+
+    #########################################################################
+    # TEST #3
+    if enabled[2]:
+        print "\nTEST #3: Send requests from 3 keep-alive polling clients to a server with 2 workers."
+        class PollRequestHandler(KeepAliveMixin, BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+            timeout = 15
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.getheader("content-length")))
+                time.sleep(0.1)
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write("OK")
+
+            def log_message(self, format, *args):
+                pass
+
+        server = PooledHTTPServer(("127.0.0.1", 0), PollRequestHandler, pool_size=2, queue_size=4)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        url = "http://127.0.0.1:%d/" % (server.server_address[1])
+
+        # Each client polls via its own persistent connection, which it
+        # keeps open until all clients are done
+        results = []
+        pools = [connpool.ConnectionPool(max_connections=1, idle_timeout=15) for index in range(3)]
+        def poll_server(pool):
+            for index in range(5):
+                start_time = time.time()
+                results.append((pool.post(url, "action=get_sessions"), time.time() - start_time))
+                time.sleep(0.1)
+
+        start_time = time.time()
+        clients = [threading.Thread(target=poll_server, args=(pool,)) for pool in pools]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        for pool in pools:
+            pool.close_all()
+        latencies = sorted([latency for (response, latency) in results])
+        print "Responses: %d (%.3f s); maximum latency: %.3f s" % (
+            [response for (response, latency) in results].count("OK"), time.time() - start_time, latencies[-1])
+        assert len(results) == 15 and latencies[-1] < DEFAULT_IDLE_TIMEOUT
+        server.shutdown()
+        workers = server.workers
+        server.server_close()
+        for worker in workers:
+            worker.join()
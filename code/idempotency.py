@@ -0,0 +1,193 @@
+
+#############################################################################
+# Classes for making the actions of CyTrONE servers idempotent, so that
+# requests can be retried safely after communication errors
+#############################################################################
+
+# External imports
+from collections import OrderedDict
+import threading
+import time
+import uuid
+
+#############################################################################
+# Constants
+#############################################################################
+
+# Default maximum number of outcomes that are remembered
+DEFAULT_MAX_SIZE = 4096
+
+# Default time during which the outcome of a request is remembered (seconds)
+DEFAULT_LIFETIME = 3600
+
+# Debugging constants
+DO_DEBUG = False
+
+
+# Generate a new idempotency key, which must be sent with all the attempts
+# of the same request
+def generate_key():
+
+    return uuid.uuid4().hex
+
+
+#############################################################################
+# Outcome of a request with an idempotency key; requests with the same key
+# that arrive while the first one is executed wait for its outcome
+#############################################################################
+class Outcome:
+
+    # Initialize object
+    def __init__(self):
+
+        self.response = None
+        self.expiry_time = None
+        self.completed = threading.Event()
+
+    # Wait until the outcome is available, at most for a given timeout
+    # (seconds), or indefinitely if no timeout is provided
+    # Return the response, or None if it is not available
+    def wait(self, timeout=None):
+
+        self.completed.wait(timeout)
+        return self.response
+
+
+#############################################################################
+# Remember the outcomes of recent requests by their idempotency keys, so
+# that a retried request receives the original response instead of
+# executing the action again
+#############################################################################
+class OutcomeCache:
+
+    # Initialize object with a given maximum size and outcome lifetime
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, lifetime=DEFAULT_LIFETIME):
+
+        self.max_size = max_size
+        self.lifetime = lifetime
+
+        # Outcomes in order of arrival, with the idempotency key as key
+        self.outcomes = OrderedDict()
+
+        # Lock for synchronizing access to the outcomes and counters
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.executed = 0
+        self.replayed = 0
+
+    # Remove expired outcomes, and the oldest completed ones if the cache
+    # is full, so that there is room for a new outcome; the lock must be
+    # held by the caller
+    def remove_old_outcomes(self):
+
+        current_time = time.time()
+        for (key, outcome) in self.outcomes.items():
+            if len(self.outcomes) < self.max_size and outcome.expiry_time > current_time:
+                break
+            if outcome.completed.is_set():
+                del self.outcomes[key]
+
+    # Start handling a request with a given idempotency key
+    # Return a tuple (outcome, new flag); if the flag is true, the caller
+    # must execute the action and complete the outcome, otherwise it must
+    # wait for the outcome of the earlier request
+    def begin(self, key):
+
+        self.lock.acquire()
+        try:
+            self.remove_old_outcomes()
+            outcome = self.outcomes.get(key)
+            if outcome:
+                self.replayed += 1
+                return (outcome, False)
+            outcome = Outcome()
+            outcome.expiry_time = time.time() + self.lifetime
+            self.outcomes[key] = outcome
+            self.executed += 1
+            return (outcome, True)
+        finally:
+            self.lock.release()
+
+    # Complete the outcome of a request with the response that was sent;
+    # if there is no response, the outcome is forgotten, so that a retried
+    # request executes the action again
+    def complete(self, key, outcome, response):
+
+        self.lock.acquire()
+        try:
+            outcome.response = response
+            outcome.expiry_time = time.time() + self.lifetime
+            if response == None and self.outcomes.get(key) is outcome:
+                del self.outcomes[key]
+        finally:
+            self.lock.release()
+        outcome.completed.set()
+
+    # Get the cache statistics as a dictionary
+    def get_statistics(self):
+
+        self.lock.acquire()
+        try:
+            return {"size": len(self.outcomes), "executed": self.executed, "replayed": self.replayed}
+        finally:
+            self.lock.release()
+
+    # Create a string representation of the cache state
+    def __str__(self):
+
+        statistics = self.get_statistics()
+        return "%d outcome(s), %d executed, %d replayed" % (
+            statistics["size"], statistics["executed"], statistics["replayed"])
+
+
+#############################################################################
+# Testing code for the classes in this file
+#
+# This code will be executed _only_ when this module is called as the
+# main program
+#############################################################################
+if __name__ == '__main__':
+
+    enabled = [True, True]
+
+    #########################################################################
+    # TEST #1
+    if enabled[0]:
+        print "TEST #1: Execute concurrent requests with the same idempotency key only once."
+        cache = OutcomeCache()
+        key = generate_key()
+        executions = []
+        responses = []
+
+        def handle_request():
+            (outcome, is_new) = cache.begin(key)
+            if is_new:
+                time.sleep(0.2)
+                executions.append(1)
+                cache.complete(key, outcome, (200, "response"))
+            responses.append(outcome.wait())
+
+        requests = [threading.Thread(target=handle_request) for index in range(8)]
+        for request in requests:
+            request.start()
+        for request in requests:
+            request.join()
+        print "Outcome cache: %s" % (cache)
+        assert len(executions) == 1 and responses == [(200, "response")] * 8
+
+    #########################################################################
+    # TEST #2
+    if enabled[1]:
+        print "TEST #2: Forget outcomes without response, and old outcomes."
+        cache = OutcomeCache(max_size=2)
+        (outcome, is_new) = cache.begin("failed")
+        cache.complete("failed", outcome, None)
+        (outcome, is_new) = cache.begin("failed")
+        assert is_new
+        cache.complete("failed", outcome, (500, "failed"))
+        for key in ["a", "b", "c"]:
+            (outcome, is_new) = cache.begin(key)
+            cache.complete(key, outcome, (200, key))
+        print "Outcome cache: %s" % (cache)
+        assert cache.get_statistics()["size"] <= 2 and not cache.begin("c")[1]
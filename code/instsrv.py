@@ -11,12 +11,18 @@ import random
 import os
 import sys
 import getopt
-from SocketServer import ThreadingMixIn
+import json
 import urllib
+import yaml
 
 # Internal imports
+import deadline
+import hostqueue
+import idempotency
+import httpsrv
 import userinfo
 import query
+import warmpool
 from storyboard import Storyboard
 
 #############################################################################
@@ -32,9 +38,20 @@ SERVER_ERROR  = 500
 LOCAL_SERVER  = True
 SERVE_FOREVER = True # Use serve count if not using local server?!
 ENABLE_THREADS = True
+WORKER_POOL_SIZE = 32 # Number of worker threads in multi-threading mode
+ACCEPT_QUEUE_SIZE = 64 # Number of connections that can wait for a worker
+KEEP_ALIVE_TIMEOUT = 2 # Time after which persistent connections that wait for a request are closed (seconds)
+CONNECTION_TIMEOUT = 15 # Time after which connections that stop sending or receiving data are closed (seconds)
+MAX_CYRIS_RUNS = 2 # Maximum number of instantiations executed at the same time on a host
+RESERVED_CYRIS_RUNS = 1 # Additional instantiations that can be executed on a host, only with interactive priority
+MAX_QUEUED_INSTANTIATIONS = 16 # Maximum number of instantiations that wait for execution
+WARM_RANGE_TIMEOUT = 3600 # Time within which a warm range must be instantiated, including queuing (seconds)
 
 # Names of files containing training-related information
 USERS_FILE  = "users.yml"
+WARM_POOL_FILE = "" # Templates of the warm pool; the pool is used only if provided
+WARM_POOL_STATE_FILE = "warm_pool_state.yml"
+FIRST_WARM_RANGE_ID = warmpool.DEFAULT_FIRST_RANGE_ID # Must be larger than the training server maximum number of sessions
 
 # Internal constants
 SEPARATOR = "-----------------------------------------------------------------"
@@ -56,6 +73,8 @@ CYRIS_CREATION_LOG_TEMPLATE = "creation.log"
 #CYRIS_DESTRUCTION_SCRIPT = "whole-controlled-destruction.sh"
 CYRIS_DESTRUCTION_SCRIPT = "main/range_cleanup.py"
 CYRIS_CONFIG_FILENAME = "CONFIG"
+CYRIS_HOST_SETTINGS_KEY = "host_settings"
+CYRIS_MGMT_ADDR_KEY = "mgmt_addr"
 
 # CyPROM related constants
 DEFAULT_CYPROM_PATH = "/home/cyuser/cyprom/"
@@ -78,11 +97,202 @@ CYRIS_MASTER_HOST = "172.16.1.7"
 CYRIS_MASTER_ACCOUNT = "cyuser"
 CNT2LMS_PATH = "/home/cyuser/cylms/"
 
+#############################################################################
+# Shared objects
+#############################################################################
+
+# User information, which is reloaded only when the file changes
+user_info_cache = userinfo.UserInfoCache(DATABASE_DIR + USERS_FILE)
+
+# Outcomes of recent requests with an idempotency key, which are replayed
+# when the requests are retried
+outcome_cache = idempotency.OutcomeCache()
+
+# Queue of the instantiations, which limits the number of CyRIS runs
+# executed at the same time on each host
+instantiation_queue = hostqueue.HostQueue(MAX_CYRIS_RUNS, MAX_QUEUED_INSTANTIATIONS, RESERVED_CYRIS_RUNS)
+
+# Pool of the cyber ranges instantiated in advance, if enabled
+warm_pool = None
+
+
+# Get the management addresses of the hosts used by a range description;
+# descriptions that cannot be parsed are considered to use the local host
+def get_range_hosts(description_file):
+
+    hosts = []
+    try:
+        for section in yaml.load(description_file):
+            for host_settings in section.get(CYRIS_HOST_SETTINGS_KEY, []):
+                hosts.append(str(host_settings[CYRIS_MGMT_ADDR_KEY]))
+    except (yaml.YAMLError, AttributeError, KeyError, TypeError) as error:
+        print "* WARNING: instsrv: Cannot determine the hosts of the range: %s." % (error)
+
+    return hosts or [LOCAL_ADDRESS]
+
+# Clean up a cyber range with a given id after a CyRIS error
+def handle_cyris_error(range_id):
+    print "* INFO: Error occurred in CyRIS => perform cyber range cleanup."
+    destruction_filename = CYRIS_PATH + CYRIS_DESTRUCTION_SCRIPT
+    destruction_command = "{0} {1} {2}".format(destruction_filename, range_id, CYRIS_PATH + CYRIS_CONFIG_FILENAME)
+    print "* DEBUG: instrv: destruction_command: " + destruction_command
+    # The cleanup has its own deadline, since the deadline of the
+    # request may already have expired
+    (exit_status, output, expired) = deadline.run_command(destruction_command,
+                                                          deadline.Deadline(deadline.CLEANUP_TIMEOUT), shell=True)
+    if exit_status != 0:
+        print "* ERROR: instrv: Range cleanup failed."
+
+# Instantiate a cyber range with a given id and description via CyRIS, or
+# simulate the instantiation; the range is cleaned up in case of error
+# Return a tuple (HTTP code, error message); the error message is None on
+# success, and the code is HTTP_OK_CODE for errors that are reported in the
+# response content instead of as HTTP errors
+def create_range(range_id, description_file, request_deadline):
+
+    # Save the description received as a file
+    try:
+        range_file_name = RANGE_DESCRIPTION_TEMPLATE.format(range_id)
+        range_file = open(range_file_name, "w")
+        range_file.write(description_file)
+        range_file.close()
+        print "* INFO: instsrv: Saved POSTed cyber range description to file '%s'." % (range_file_name)
+    except IOError:
+        print "* ERROR: instsrv: Could not write to file %s." % (range_file_name)
+
+    print "* INFO: instsrv: Start cyber range instantiation."
+
+    # Use CyRIS to really do cyber range instantiation
+    if USE_CYRIS:
+        try:
+            command = "python -u " + CYRIS_PATH + "main/cyris.py " + range_file_name + " " + CYRIS_PATH + CYRIS_CONFIG_FILENAME
+            (exit_status, output, expired) = deadline.run_command(command, request_deadline, shell=True)
+            if expired:
+                print "* ERROR: instsrv: CyRIS instantiation did not finish before the deadline."
+                handle_cyris_error(range_id)
+                return (SERVER_ERROR, Storyboard.DEADLINE_EXPIRED_ERROR)
+            if exit_status != 0:
+                handle_cyris_error(range_id)
+                return (SERVER_ERROR, "CyRIS execution issue")
+
+            status_filename = CYRIS_PATH + CYRIS_RANGE_DIRECTORY + str(range_id) + "/" + CYRIS_STATUS_FILENAME
+            with open(status_filename, 'r') as status_file:
+                status_file_content = status_file.read()
+                if DEBUG:
+                    print "* DEBUG: instsrv: Status file content=", status_file_content
+                if Storyboard.SERVER_STATUS_SUCCESS not in status_file_content:
+                    # Even though CyRIS is now destroying automatically the cyber range
+                    # in case of error, as this may fail, we still try to clean up here
+                    handle_cyris_error(range_id)
+                    return (HTTP_OK_CODE, Storyboard.INSTANTIATION_STATUS_FILE_NOT_FOUND)
+
+        except IOError:
+            handle_cyris_error(range_id)
+            return (SERVER_ERROR, Storyboard.INSTANTIATION_CYRIS_IO_ERROR)
+
+    # Don't use CyRIS, just simulate the instantiation
+    else:
+        # Simulate time needed to instantiate the cyber range
+        if SIMULATION_DURATION == -1:
+            sleep_time = random.randint(SIMULATION_RAND_MIN, SIMULATION_RAND_MAX)
+        else:
+            sleep_time = SIMULATION_DURATION
+        print Storyboard.SEPARATOR3
+        print "* INFO: instsrv: Simulate instantiation by sleeping %d s." % (sleep_time)
+        print Storyboard.SEPARATOR3
+        if not deadline.sleep(sleep_time, request_deadline):
+            print "* ERROR: instsrv: Simulated instantiation did not finish before the deadline."
+            return (HTTP_OK_CODE, Storyboard.DEADLINE_EXPIRED_ERROR)
+
+        # Simulate the success or failure of the instantiation
+        if random.random() <= 0.0:
+            return (HTTP_OK_CODE, Storyboard.INSTANTIATION_SIMULATED_ERROR)
+
+    return (HTTP_OK_CODE, None)
+
+# Destroy a cyber range with a given id via CyRIS, or simulate the destruction
+# Return an error message, or None on success
+def destroy_range(range_id, request_deadline):
+
+    # Use CyRIS to really do cyber range destruction
+    if USE_CYRIS:
+        destruction_filename = CYRIS_PATH + CYRIS_DESTRUCTION_SCRIPT
+        destruction_command = "{0} {1} {2}".format(destruction_filename, range_id, CYRIS_PATH + CYRIS_CONFIG_FILENAME)
+        print "* DEBUG: instrv: destruction_command: " + destruction_command
+        (exit_status, output, expired) = deadline.run_command(destruction_command, request_deadline, shell=True)
+        if expired:
+            print "* ERROR: instsrv: CyRIS destruction did not finish before the deadline."
+            return Storyboard.DEADLINE_EXPIRED_ERROR
+        elif exit_status != 0:
+            return "CyRIS destruction issue"
+
+    # Don't use CyRIS, just simulate the destruction
+    else:
+        # Simulate time needed to destroy the cyber range
+        if SIMULATION_DURATION == -1:
+            sleep_time = random.randint(SIMULATION_RAND_MIN, SIMULATION_RAND_MAX)
+        else:
+            sleep_time = SIMULATION_DURATION
+        print Storyboard.SEPARATOR3
+        print "* INFO: instsrv: Simulate destruction by sleeping %d s." % (sleep_time)
+        print Storyboard.SEPARATOR3
+        if not deadline.sleep(sleep_time, request_deadline):
+            print "* ERROR: instsrv: Simulated destruction did not finish before the deadline."
+            return Storyboard.DEADLINE_EXPIRED_ERROR
+
+        # Simulate the success or failure of the destruction
+        if random.random() <= 0.0:
+            return Storyboard.DESTRUCTION_SIMULATED_ERROR
+
+    return None
+
+# Instantiate a warm range with a given id for a warm pool template; the
+# instantiation is queued with batch priority, so that it runs after the
+# instantiations requested by users
+# Return True on success, False otherwise
+def instantiate_warm_range(template, range_id):
+
+    range_deadline = deadline.Deadline(WARM_RANGE_TIMEOUT)
+    description_file = template.get_description(range_id)
+    (ticket, error_message) = instantiation_queue.enter("warm-%d" % (range_id), get_range_hosts(description_file),
+                                                        range_deadline, query.Parameters.BATCH)
+    if not error_message:
+        try:
+            (code, error_message) = create_range(str(range_id), description_file, range_deadline)
+        finally:
+            instantiation_queue.leave(ticket)
+    if error_message:
+        print "* ERROR: instsrv: Instantiation of warm range %d failed: %s." % (range_id, error_message)
+        return False
+
+    return True
+
+# Destroy a warm range with a given id
+# Return True on success, False otherwise
+def destroy_warm_range(range_id):
+
+    error_message = destroy_range(str(range_id), deadline.Deadline(deadline.CLEANUP_TIMEOUT))
+    if error_message:
+        print "* ERROR: instsrv: Destruction of warm range %d failed: %s." % (range_id, error_message)
+        return False
+
+    return True
+
 
 #############################################################################
 # Manage the instantiation server functionality
 #############################################################################
-class RequestHandler(BaseHTTPRequestHandler):
+class RequestHandler(httpsrv.KeepAliveMixin, BaseHTTPRequestHandler):
+
+    # Use persistent connections; idle connections are closed after
+    # KEEP_ALIVE_TIMEOUT, or as soon as other clients wait for a worker,
+    # so that they do not occupy workers
+    protocol_version = "HTTP/1.1"
+    timeout = CONNECTION_TIMEOUT
+
+    # Headers are written separately, hence small writes must not be
+    # delayed on persistent connections
+    disable_nagle_algorithm = True
 
     # List of valid actions recognized by this server
     VALID_ACTIONS = [query.Parameters.INSTANTIATE_RANGE,
@@ -92,7 +302,12 @@ class RequestHandler(BaseHTTPRequestHandler):
                      query.Parameters.GET_CR_ENTRY_POINT,
                      query.Parameters.GET_CR_CREATION_STATUS,
                      query.Parameters.GET_CR_INITIF,
-                     query.Parameters.GET_CR_CREATION_LOG]
+                     query.Parameters.GET_CR_CREATION_LOG,
+                     query.Parameters.GET_SERVER_STATUS]
+
+    # List of actions that are executed only once for a given idempotency key
+    IDEMPOTENT_ACTIONS = [query.Parameters.INSTANTIATE_RANGE,
+                          query.Parameters.DESTROY_RANGE]
 
     #########################################################################
     # Print log messages with custom format
@@ -118,15 +333,57 @@ class RequestHandler(BaseHTTPRequestHandler):
         # Get the parameters of the POST request
         params = query.Parameters(self)
 
+        # Response sent for the request, as a tuple (code, content)
+        self.response = None
+
+        # Requests with an idempotency key are executed only once, and
+        # retried requests receive the response of the original request;
+        # this applies only to the actions that modify the state
+        action = params.get(query.Parameters.ACTION)
+        idempotency_key = params.get(query.Parameters.IDEMPOTENCY_KEY)
+        if not idempotency_key or action not in self.IDEMPOTENT_ACTIONS:
+            self.handle_POST(params)
+            return
+
+        outcome_key = (action, idempotency_key)
+        (outcome, is_new) = outcome_cache.begin(outcome_key)
+        if not is_new:
+            print "* INFO: instsrv: Replay response for action %s with idempotency key %s." % (
+                action, idempotency_key)
+            self.replay_response(outcome.wait())
+            return
+
+        try:
+            self.handle_POST(params)
+        finally:
+            outcome_cache.complete(outcome_key, outcome, self.response)
+            if DEBUG:
+                print "* DEBUG: instsrv: Idempotency outcome cache: %s" % (outcome_cache)
+
+    #########################################################################
+    # Handle the parameters and action of a POST message
+    def handle_POST(self, params):
+
         if DEBUG:
             print SEPARATOR
             print "* DEBUG: instsrv: Client POST request: POST parameters: %s" % (params)
 
+        # Answer health probes right away, without verifying the user;
+        # being able to handle the request means the server is healthy
+        if params.get(query.Parameters.ACTION) == query.Parameters.HEALTH:
+            self.respond(self.build_response(Storyboard.SERVER_STATUS_SUCCESS))
+            return
+
+        # Get the deadline of the request, if any; external programs that
+        # are still running when it expires are terminated
+        request_deadline = deadline.from_header(self.headers.getheader(deadline.DEADLINE_HEADER))
+
         # Get parameter values for given keys
         user_id = params.get(query.Parameters.USER)
         action = params.get(query.Parameters.ACTION)
         description_file = params.get(query.Parameters.DESCRIPTION_FILE)
         progression_scenario = params.get(query.Parameters.PROGRESSION_SCENARIO)
+        priority = params.get(query.Parameters.PRIORITY)
         range_id = params.get(query.Parameters.RANGE_ID)
 
         if DEBUG:
@@ -137,20 +394,28 @@ class RequestHandler(BaseHTTPRequestHandler):
             print "ACTION: %s" % (action)
             print "DESCRIPTION FILE:\n%s" % (description_file) 
             print "PROGRESSION_SCENARIO: %s" % (progression_scenario)
+            print "PRIORITY: %s" % (priority)
             print "RANGE_ID: %s" % (range_id)
             print SEPARATOR
 
+        # Ranges taken from the warm pool are known to CyRIS by the id of
+        # the warm range
+        cyris_range_id = range_id
+        if warm_pool and range_id and action != query.Parameters.INSTANTIATE_RANGE:
+            cyris_range_id = warm_pool.resolve(range_id)
+
         ## Handle user information
 
-        # Get user information from YAML file
-        # Note: Only reading data that is (potentially) modified externally =>
-        #       no need for synchronization
-        user_info = userinfo.UserInfo()
-        if not user_info.parse_YAML_file(DATABASE_DIR + USERS_FILE):
+        # Get user information from the cache, which reloads the YAML
+        # file only if it was modified externally
+        # Note: The cache handles synchronization internally
+        user_info = user_info_cache.get()
+        if not user_info:
             self.send_error(SERVER_ERROR, "User information issue")
             return
         if DEBUG:
             user_info.pretty_print()
+            print "* DEBUG: instsrv: User information cache: %s" % (user_info_cache)
 
         # Check that user id is valid
         user_obj = user_info.get_user(user_id) 
@@ -165,6 +430,15 @@ class RequestHandler(BaseHTTPRequestHandler):
             self.send_error(REQUEST_ERROR, "Invalid action")
             return
 
+        # Check that the range id does not collide with the ids of the warm
+        # ranges, which happens if the training server may use more ids
+        if warm_pool and range_id and warm_pool.is_reserved_id(range_id):
+            print "* ERROR: instsrv: Range id %s is reserved for warm ranges (first id: %d) => " \
+                  "the maximum number of sessions of the training server must be lower." % (
+                      range_id, FIRST_WARM_RANGE_ID)
+            self.send_error(REQUEST_ERROR, "Range id reserved for warm ranges")
+            return
+
         # If we reached this point, it means processing was successful
         # => act according to each action
 
@@ -182,142 +456,46 @@ class RequestHandler(BaseHTTPRequestHandler):
                 self.send_error(REQUEST_ERROR, "Invalid range id")
                 return
 
-            # Save the description received as a file
-            try:
-                range_file_name = RANGE_DESCRIPTION_TEMPLATE.format(range_id)
-                range_file = open(range_file_name, "w")
-                range_file.write(description_file)
-                range_file.close()
-                print "* INFO: instsrv: Saved POSTed cyber range description to file '%s'." % (range_file_name)
-            except IOError:
-                print "* ERROR: instsrv: Could not write to file %s." % (range_file_name)
-
-            print "* INFO: instsrv: Start cyber range instantiation."
-
-            # Use CyRIS to really do cyber range instantiation
-            if USE_CYRIS:
-                try:
-                    command = "python -u " + CYRIS_PATH + "main/cyris.py " + range_file_name + " " + CYRIS_PATH + CYRIS_CONFIG_FILENAME
-                    return_value = os.system(command)
-                    exit_status = os.WEXITSTATUS(return_value)
-                    if exit_status != 0:
-                        self.handle_cyris_error(range_id)
-                        self.send_error(SERVER_ERROR, "CyRIS execution issue")
-                        return
-
-                    status_filename = CYRIS_PATH + CYRIS_RANGE_DIRECTORY + str(range_id) + "/" + CYRIS_STATUS_FILENAME
-                    with open(status_filename, 'r') as status_file:
-                        status_file_content = status_file.read()
-                        if DEBUG:
-                            print "* DEBUG: instsrv: Status file content=", status_file_content
-                        if Storyboard.SERVER_STATUS_SUCCESS in status_file_content:
-
-                            # Get notification text
-                            notification_filename_short = CYRIS_NOTIFICATION_TEMPLATE.format(range_id) 
-                            notification_filename = "{0}{1}{2}/{3}".format(CYRIS_PATH,
-                                                                           CYRIS_RANGE_DIRECTORY,
-                                                                           range_id,
-                                                                           notification_filename_short)
-                            if DEBUG:
-                                print "* DEBUG: instsrv: Notification file name=", notification_filename
-
-                            message = None
-                            with open(notification_filename, 'r') as notification_file:
-                                notification_file_content = notification_file.read()
-                                message = urllib.quote(notification_file_content)
-
-                            response_content = self.build_response(Storyboard.SERVER_STATUS_SUCCESS, message)
-
-                            # We try to prepare the terminal for Moodle, but
-                            # errors are only considered as warnings for the
-                            # moment, since this functionality is not publicly
-                            # released yet in cnt2lms
-                            try:
-                                if USE_CNT2LMS_SCRIPT_GENERATION:
-                                    ssh_command = "ssh -tt -o 'ProxyCommand ssh cyuser@172.16.1.3 -W %h:%p' root@moodle"
-                                    python_command = "python -u " + CNT2LMS_PATH + "get_cyris_result.py " + CYRIS_MASTER_HOST + " " + CYRIS_MASTER_ACCOUNT + " " + CYRIS_PATH + CYRIS_RANGE_DIRECTORY + " " + range_id + " 1"
-                                    command = ssh_command + " \"" + python_command + "\""
-                                    print "* DEBUG: instsrv: get_cyris_result command: " + command
-                                    return_value = os.system(command)
-                                    exit_status = os.WEXITSTATUS(return_value)
-                                    if exit_status == 0:
-                                        #response_content = RESPONSE_SUCCESS
-                                        pass
-                                    else:
-                                        #self.send_error(SERVER_ERROR, "LMS terminal preparation issue")
-                                        #return
-                                        print "* DEBUG: instsrv: LMS terminal preparation issue"
-                            except IOError:
-                                #self.send_error(SERVER_ERROR, "LMS terminal preparation I/O error)
-                                #return
-                                print "* DEBUG: instsrv: LMS terminal preparation I/O error"
-
-                            # CyPROM related functionality
-                            if progression_scenario:
-
-                                print "* INFO: instsrv: Run CyPROM using scenario '{}'".format(progression_scenario)
-
-                                # Build CyRIS details file name
-                                details_filename_short = CYRIS_DETAILS_TEMPLATE.format(range_id)
-                                details_filename = "{0}{1}{2}/{3}".format(CYRIS_PATH,
-                                                                          CYRIS_RANGE_DIRECTORY,
-                                                                          range_id,
-                                                                          details_filename_short)
-                                # Build CyPROM command (note the background execution!)
-                                cyprom_command = "python -u {0}main/cyprom.py --scenario {1} --cyris {2} &".format(CYPROM_PATH, progression_scenario, details_filename)
-
-                                # Execute the command and handle the exit status
-                                return_value = os.system(cyprom_command)
-                                exit_status = os.WEXITSTATUS(return_value)
-                                if exit_status != 0:
-                                    self.handle_cyris_error(range_id)
-                                    self.send_error(SERVER_ERROR, "CyPROM execution issue")
-                                    return
-                        else:
-                            # Even though CyRIS is now destroying automatically the cyber range
-                            # in case of error, as this may fail, we still try to clean up here
-                            self.handle_cyris_error(range_id)
-                            response_content = self.build_response(Storyboard.SERVER_STATUS_ERROR,
-                                                                   Storyboard.INSTANTIATION_STATUS_FILE_NOT_FOUND)
+            # Check that the priority is valid
+            if priority not in query.Parameters.PRIORITIES:
+                self.send_error(REQUEST_ERROR, "Invalid priority")
+                return
 
-                except IOError:
-                    self.handle_cyris_error(range_id)
-                    self.send_error(SERVER_ERROR, Storyboard.INSTANTIATION_CYRIS_IO_ERROR)
+            # Use a warm range with the same description, if available
+            warm_range_id = None
+            if warm_pool:
+                warm_range_id = warm_pool.claim(range_id, description_file)
+            if warm_range_id:
+                print "* INFO: instsrv: Use warm range %s for cyber range with id %s." % (warm_range_id, range_id)
+                response_content = self.complete_instantiation(warm_range_id, progression_scenario,
+                                                               request_deadline)
+                if not response_content:
+                    # The warm range was cleaned up, hence it is no longer used
+                    warm_pool.release(range_id)
                     return
 
-            # Don't use CyRIS, just simulate the instantiation
+            # Otherwise wait until CyRIS can run on the hosts of the range,
+            # after the instantiations with a higher priority; requests that
+            # cannot be queued are rejected, so that they are retried
             else:
-                # Simulate time needed to instantiate the cyber range
-                if SIMULATION_DURATION == -1:
-                    sleep_time = random.randint(SIMULATION_RAND_MIN, SIMULATION_RAND_MAX)
-                else:
-                    sleep_time = SIMULATION_DURATION
-                print Storyboard.SEPARATOR3
-                print "* INFO: instsrv: Simulate instantiation by sleeping %d s." % (sleep_time)
-                print Storyboard.SEPARATOR3
-                time.sleep(sleep_time)
-
-                # Simulate the success or failure of the instantiation
-                if random.random() > 0.0:
-                    # Get sample notification text
-                    notification_filename = "{0}/{1}".format(DATABASE_DIR,
-                                                             CYRIS_NOTIFICATION_SIMULATED)
-                    if DEBUG:
-                        print "* DEBUG: instsrv: Simulated notification file name=", notification_filename
-
-                    message = None
-                    with open(notification_filename, 'r') as notification_file:
-                        notification_file_content = notification_file.read()
-                        message = urllib.quote(notification_file_content)
-                    response_content = self.build_response(Storyboard.SERVER_STATUS_SUCCESS, message)
-
-                    # CyPROM related functionality
-                    if progression_scenario:
-                        print "* INFO: instsrv: Simulated CyPROM execution using scenario '{}'.".format(progression_scenario)
-
+                (ticket, error_message) = instantiation_queue.enter(range_id, get_range_hosts(description_file),
+                                                                    request_deadline, priority)
+                if error_message == Storyboard.SERVER_OVERLOAD_ERROR:
+                    self.respond(self.build_response(Storyboard.SERVER_STATUS_ERROR, error_message))
+                    # The instantiation was not executed, hence its outcome must
+                    # not be replayed to a retried request
+                    self.response = None
+                    return
+                elif error_message:
+                    response_content = self.build_response(Storyboard.SERVER_STATUS_ERROR, error_message)
                 else:
-                    response_content = self.build_response(Storyboard.SERVER_STATUS_ERROR,
-                                                           Storyboard.INSTANTIATION_SIMULATED_ERROR)
+                    try:
+                        response_content = self.instantiate_range(range_id, description_file, progression_scenario,
+                                                                  request_deadline)
+                    finally:
+                        instantiation_queue.leave(ticket)
+                    if not response_content:
+                        return
 
         #############################################################################
         # Destroy the cyber range action
@@ -330,37 +508,14 @@ class RequestHandler(BaseHTTPRequestHandler):
 
             print "* INFO: instsrv: Start destruction of cyber range with id %s." % (range_id)
 
-            # Use CyRIS to really do cyber range destruction
-            if USE_CYRIS:
-                destruction_filename = CYRIS_PATH + CYRIS_DESTRUCTION_SCRIPT
-                destruction_command = "{0} {1} {2}".format(destruction_filename, range_id, CYRIS_PATH + CYRIS_CONFIG_FILENAME)
-                print "* DEBUG: instrv: destruction_command: " + destruction_command
-                return_value = os.system(destruction_command)
-                exit_status = os.WEXITSTATUS(return_value)
-                if exit_status == 0:
-                    response_content = self.build_response(Storyboard.SERVER_STATUS_SUCCESS)
-                else:
-                    response_content = self.build_response(Storyboard.SERVER_STATUS_ERROR,
-                                                           "CyRIS destruction issue")
-
-            # Don't use CyRIS, just simulate the destruction
+            error_message = destroy_range(cyris_range_id, request_deadline)
+            if error_message:
+                response_content = self.build_response(Storyboard.SERVER_STATUS_ERROR, error_message)
             else:
-                # Simulate time needed to destroy the cyber range
-                if SIMULATION_DURATION == -1:
-                    sleep_time = random.randint(SIMULATION_RAND_MIN, SIMULATION_RAND_MAX)
-                else:
-                    sleep_time = SIMULATION_DURATION
-                print Storyboard.SEPARATOR3
-                print "* INFO: instsrv: Simulate destruction by sleeping %d s." % (sleep_time)
-                print Storyboard.SEPARATOR3
-                time.sleep(sleep_time)
-
-                # Simulate the success or failure of the destruction
-                if random.random() > 0.0:
-                    response_content = self.build_response(Storyboard.SERVER_STATUS_SUCCESS)
-                else:
-                    response_content = self.build_response(Storyboard.SERVER_STATUS_ERROR,
-                                                           Storyboard.DESTRUCTION_SIMULATED_ERROR)
+                # The id of a warm range can be reused once it is destroyed
+                if warm_pool:
+                    warm_pool.release(range_id)
+                response_content = self.build_response(Storyboard.SERVER_STATUS_SUCCESS)
 
         elif action == query.Parameters.GET_CR_NOTIFICATION:
             # Check that the range id is valid
@@ -368,10 +523,10 @@ class RequestHandler(BaseHTTPRequestHandler):
                 self.send_error(REQUEST_ERROR, "Invalid range id")
                 return
             # Get notification text
-            notification_filename_short = CYRIS_NOTIFICATION_TEMPLATE.format(range_id)
+            notification_filename_short = CYRIS_NOTIFICATION_TEMPLATE.format(cyris_range_id)
             notification_filename = "{0}{1}{2}/{3}".format(CYRIS_PATH,
                                                            CYRIS_RANGE_DIRECTORY,
-                                                           range_id,
+                                                           cyris_range_id,
                                                            notification_filename_short)
             if DEBUG:
                 print "* DEBUG: instsrv: Notification file name=", notification_filename
@@ -391,10 +546,10 @@ class RequestHandler(BaseHTTPRequestHandler):
                 self.send_error(REQUEST_ERROR, "Invalid range id")
                 return
             # Get range_details yml
-            range_details_filename_short = CYRIS_DETAILS_TEMPLATE.format(range_id)
+            range_details_filename_short = CYRIS_DETAILS_TEMPLATE.format(cyris_range_id)
             range_details_filename = "{0}{1}{2}/{3}".format(CYRIS_PATH,
                                                             CYRIS_RANGE_DIRECTORY,
-                                                            range_id,
+                                                            cyris_range_id,
                                                             range_details_filename_short)
             if DEBUG:
                 print "* DEBUG: instsrv: Notification file name=", range_details_filename
@@ -414,10 +569,10 @@ class RequestHandler(BaseHTTPRequestHandler):
                 self.send_error(REQUEST_ERROR, "Invalid range id")
                 return
             # Get entry_points txt
-            entry_points_filename_short = CYRIS_ENTRY_POINT_TEMPLATE.format(range_id)
+            entry_points_filename_short = CYRIS_ENTRY_POINT_TEMPLATE.format(cyris_range_id)
             entry_points_filename = "{0}{1}{2}/{3}".format(CYRIS_PATH,
                                                            CYRIS_RANGE_DIRECTORY,
-                                                           range_id,
+                                                           cyris_range_id,
                                                            entry_points_filename_short)
             if DEBUG:
                 print "* DEBUG: instsrv: Entry_point file name=", entry_points_filename
@@ -436,11 +591,17 @@ class RequestHandler(BaseHTTPRequestHandler):
             if not range_id:
                 self.send_error(REQUEST_ERROR, "Invalid range id")
                 return
+            # Report the position of instantiations that are still queued
+            position = instantiation_queue.get_position(range_id)
+            if position:
+                message = urllib.quote("%s (position: %d)" % (Storyboard.INSTANTIATION_QUEUED_STATUS, position))
+                self.respond(self.build_response(Storyboard.SERVER_STATUS_SUCCESS, message))
+                return
             # Get entry_points txt
-            cr_creation_status_filename_short = CYRIS_CREATION_STATUS_TEMPLATE.format(range_id)
+            cr_creation_status_filename_short = CYRIS_CREATION_STATUS_TEMPLATE.format(cyris_range_id)
             cr_creation_status_filename = "{0}{1}{2}/{3}".format(CYRIS_PATH,
                                                                  CYRIS_RANGE_DIRECTORY,
-                                                                 range_id,
+                                                                 cyris_range_id,
                                                                  cr_creation_status_filename_short)
             if DEBUG:
                 print "* DEBUG: instsrv: Cr_creation_status file name=", cr_creation_status_filename
@@ -460,10 +621,10 @@ class RequestHandler(BaseHTTPRequestHandler):
                 self.send_error(REQUEST_ERROR, "Invalid range id")
                 return
             # Get entry_points txt
-            initif_filename_short = CYRIS_INITIF_TEMPLATE.format(range_id)
+            initif_filename_short = CYRIS_INITIF_TEMPLATE.format(cyris_range_id)
             initif_filename = "{0}{1}{2}/{3}".format(CYRIS_PATH,
                                                      CYRIS_RANGE_DIRECTORY,
-                                                     range_id,
+                                                     cyris_range_id,
                                                      initif_filename_short)
             if DEBUG:
                 print "* DEBUG: instsrv: Initif file name=", initif_filename
@@ -483,10 +644,10 @@ class RequestHandler(BaseHTTPRequestHandler):
                 self.send_error(REQUEST_ERROR, "Invalid range id")
                 return
             # Get entry_points txt
-            creation_log_filename_short = CYRIS_CREATION_LOG_TEMPLATE.format(range_id)
+            creation_log_filename_short = CYRIS_CREATION_LOG_TEMPLATE.format(cyris_range_id)
             creation_log_filename = "{0}{1}{2}/{3}".format(CYRIS_PATH,
                                                            CYRIS_RANGE_DIRECTORY,
-                                                           range_id,
+                                                           cyris_range_id,
                                                            creation_log_filename_short)
             if DEBUG:
                 print "* DEBUG: instsrv: CREATION_LOG file name=", creation_log_filename
@@ -499,22 +660,163 @@ class RequestHandler(BaseHTTPRequestHandler):
             except:
                 response_content = self.build_response(Storyboard.SERVER_STATUS_ERROR,
                                                        "CyRIS creation_log issue")
+
+        elif action == query.Parameters.GET_SERVER_STATUS:
+            # Report the state of the instantiation queue, including the
+            # waiting times for each priority, and of the warm pool
+            response_content = json.dumps([{Storyboard.SERVER_STATUS_KEY: Storyboard.SERVER_STATUS_SUCCESS,
+                                            "instantiation_queue": instantiation_queue.get_representation(),
+                                            "warm_pool": warm_pool.get_representation() if warm_pool else None}])
+
         # Catch potential unimplemented actions (if any)
         else:
             print "* WARNING: instsrv: Unknown action: %s." % (action)
 
+        self.respond(response_content)
+
+        # Output server reply
+        if DEBUG:
+            print "* DEBUG: instsrv: Server response content: %s" % (response_content)
+
+    # Instantiate a cyber range with a given description, via CyRIS or by
+    # simulating the instantiation
+    # Return the response content, or None if an error response was sent
+    def instantiate_range(self, range_id, description_file, progression_scenario, request_deadline):
+
+        (code, error_message) = create_range(range_id, description_file, request_deadline)
+        if code != HTTP_OK_CODE:
+            self.send_error(code, error_message)
+            return None
+        if error_message:
+            return self.build_response(Storyboard.SERVER_STATUS_ERROR, error_message)
+
+        return self.complete_instantiation(range_id, progression_scenario, request_deadline)
+
+    # Prepare the response for a cyber range with a given id that was
+    # instantiated successfully, and run CyPROM for the progression
+    # scenario, if any
+    # Return the response content, or None if an error response was sent
+    def complete_instantiation(self, range_id, progression_scenario, request_deadline):
+
+        # Use CyRIS to really do cyber range instantiation
+        if USE_CYRIS:
+            try:
+                # Get notification text
+                notification_filename_short = CYRIS_NOTIFICATION_TEMPLATE.format(range_id) 
+                notification_filename = "{0}{1}{2}/{3}".format(CYRIS_PATH,
+                                                               CYRIS_RANGE_DIRECTORY,
+                                                               range_id,
+                                                               notification_filename_short)
+                if DEBUG:
+                    print "* DEBUG: instsrv: Notification file name=", notification_filename
+
+                message = None
+                with open(notification_filename, 'r') as notification_file:
+                    notification_file_content = notification_file.read()
+                    message = urllib.quote(notification_file_content)
+
+                response_content = self.build_response(Storyboard.SERVER_STATUS_SUCCESS, message)
+
+                # We try to prepare the terminal for Moodle, but
+                # errors are only considered as warnings for the
+                # moment, since this functionality is not publicly
+                # released yet in cnt2lms
+                try:
+                    if USE_CNT2LMS_SCRIPT_GENERATION:
+                        ssh_command = "ssh -tt -o 'ProxyCommand ssh cyuser@172.16.1.3 -W %h:%p' root@moodle"
+                        python_command = "python -u " + CNT2LMS_PATH + "get_cyris_result.py " + CYRIS_MASTER_HOST + " " + CYRIS_MASTER_ACCOUNT + " " + CYRIS_PATH + CYRIS_RANGE_DIRECTORY + " " + range_id + " 1"
+                        command = ssh_command + " \"" + python_command + "\""
+                        print "* DEBUG: instsrv: get_cyris_result command: " + command
+                        (exit_status, output, expired) = deadline.run_command(command, request_deadline, shell=True)
+                        if exit_status == 0:
+                            #response_content = RESPONSE_SUCCESS
+                            pass
+                        else:
+                            #self.send_error(SERVER_ERROR, "LMS terminal preparation issue")
+                            #return
+                            print "* DEBUG: instsrv: LMS terminal preparation issue"
+                except IOError:
+                    #self.send_error(SERVER_ERROR, "LMS terminal preparation I/O error)
+                    #return
+                    print "* DEBUG: instsrv: LMS terminal preparation I/O error"
+
+                # CyPROM related functionality
+                if progression_scenario:
+
+                    print "* INFO: instsrv: Run CyPROM using scenario '{}'".format(progression_scenario)
+
+                    # Build CyRIS details file name
+                    details_filename_short = CYRIS_DETAILS_TEMPLATE.format(range_id)
+                    details_filename = "{0}{1}{2}/{3}".format(CYRIS_PATH,
+                                                              CYRIS_RANGE_DIRECTORY,
+                                                              range_id,
+                                                              details_filename_short)
+                    # Build CyPROM command (note the background execution!)
+                    cyprom_command = "python -u {0}main/cyprom.py --scenario {1} --cyris {2} &".format(CYPROM_PATH, progression_scenario, details_filename)
+
+                    # Execute the command and handle the exit status
+                    return_value = os.system(cyprom_command)
+                    exit_status = os.WEXITSTATUS(return_value)
+                    if exit_status != 0:
+                        handle_cyris_error(range_id)
+                        self.send_error(SERVER_ERROR, "CyPROM execution issue")
+                        return
+
+            except IOError:
+                handle_cyris_error(range_id)
+                self.send_error(SERVER_ERROR, Storyboard.INSTANTIATION_CYRIS_IO_ERROR)
+                return
+
+        # Don't use CyRIS, just simulate the instantiation
+        else:
+            # Get sample notification text
+            notification_filename = "{0}/{1}".format(DATABASE_DIR,
+                                                     CYRIS_NOTIFICATION_SIMULATED)
+            if DEBUG:
+                print "* DEBUG: instsrv: Simulated notification file name=", notification_filename
+
+            message = None
+            with open(notification_filename, 'r') as notification_file:
+                notification_file_content = notification_file.read()
+                message = urllib.quote(notification_file_content)
+            response_content = self.build_response(Storyboard.SERVER_STATUS_SUCCESS, message)
+
+            # CyPROM related functionality
+            if progression_scenario:
+                print "* INFO: instsrv: Simulated CyPROM execution using scenario '{}'.".format(progression_scenario)
+
+        return response_content
+
+    # Send the response of an earlier request with the same idempotency key
+    def replay_response(self, response):
+
+        if not response:
+            self.send_error(SERVER_ERROR, "Original request failed")
+        elif response[0] == HTTP_OK_CODE:
+            self.respond(response[1])
+        else:
+            self.send_error(response[0], response[1])
+
+    # Send an error response to requester, and remember it
+    def send_error(self, code, message=None):
+
+        self.response = (code, message)
+        BaseHTTPRequestHandler.send_error(self, code, message)
+
+    # Send a successful response with the given content to requester
+    def respond(self, response_content):
+
+        self.response = (HTTP_OK_CODE, response_content)
+
         # Send response header to requester (triggers log_message())
         self.send_response(HTTP_OK_CODE)
         self.send_header("Content-type", "text/html")
+        self.send_header("Content-Length", str(len(response_content)))
         self.end_headers() 
 
         # Send scenario database content information to requester
         self.wfile.write(response_content)
 
-        # Output server reply
-        if DEBUG:
-            print "* DEBUG: instsrv: Server response content: %s" % (response_content)
-
     def build_response(self, status, message=None):
 
         # Prepare status
@@ -530,32 +832,33 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         return response_body
 
-    def handle_cyris_error(self, range_id):
-        print "* INFO: Error occurred in CyRIS => perform cyber range cleanup."
-        destruction_filename = CYRIS_PATH + CYRIS_DESTRUCTION_SCRIPT
-        destruction_command = "{0} {1} {2}".format(destruction_filename, range_id, CYRIS_PATH + CYRIS_CONFIG_FILENAME)
-        print "* DEBUG: instrv: destruction_command: " + destruction_command
-        return_value = os.system(destruction_command)
-        exit_status = os.WEXITSTATUS(return_value)
-        if exit_status != 0:
-            print "* ERROR: instrv: Range cleanup failed."
-
 # Print usage information
 def usage():
     print "OVERVIEW: CyTrONE instantiation server that manages the CyRIS cyber range instantiation system.\n"
     print "USAGE: instsrv.py [options]\n"
     print "OPTIONS:"
     print "-h, --help           Display help"
+    print "-b, --backlog <NUMBER>"
+    print "                     Maximum number of instantiations waiting for execution (default: %d)" % (
+        MAX_QUEUED_INSTANTIATIONS)
+    print "-c, --cyris-runs <NUMBER>"
+    print "                     Maximum number of instantiations executed at the same time on a host (default: %d)" % (
+        MAX_CYRIS_RUNS)
+    print "-r, --reserved-runs <NUMBER>"
+    print "                     Additional instantiations executed on a host, only with interactive priority (default: %d)" % (
+        RESERVED_CYRIS_RUNS)
+    print "-k, --warm-pool <FILE>"
+    print "                     Keep warm ranges for the templates in the given file (default: no warm pool)"
+    print "-f, --first-warm-id <ID>"
+    print "                     Id of the first warm range; must be larger than the maximum number of sessions"
+    print "                     of the training server (default: %d)" % (FIRST_WARM_RANGE_ID)
     print "-n, --no-inst        Disable instantiation => only simulate actions"
     print "-p, --path <PATH>    Set the location where CyRIS is installed"
-    print "-m, --cyprom <PATH>  Set the location where CyPROM is installed\n"
-
+    print "-m, --cyprom <PATH>  Set the location where CyPROM is installed"
+    print "-w, --workers <NUMBER>"
+    print "                     Number of worker threads that handle requests (default: %d)" % (WORKER_POOL_SIZE)
+    print "-q, --queue <NUMBER> Number of connections that can wait for a worker (default: %d)\n" % (ACCEPT_QUEUE_SIZE)
 
-# Use threads to handle multiple clients
-# Note: By using ForkingMixIn instead of ThreadingMixIn,
-# separate processes are used instead of threads
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread."""
 
 
 #############################################################################
@@ -566,10 +869,20 @@ def main(argv):
     global USE_CYRIS
     global CYRIS_PATH
     global CYPROM_PATH
+    global WORKER_POOL_SIZE
+    global ACCEPT_QUEUE_SIZE
+    global MAX_CYRIS_RUNS
+    global MAX_QUEUED_INSTANTIATIONS
+    global RESERVED_CYRIS_RUNS
+    global WARM_POOL_FILE
+    global FIRST_WARM_RANGE_ID
+    global warm_pool
 
     # Parse command line arguments
     try:
-        opts, args = getopt.getopt(argv, "hnp:m:", ["help", "no-inst", "path=", "cyprom="])
+        opts, args = getopt.getopt(argv, "hb:c:f:k:np:m:r:w:q:", ["help", "backlog=", "cyris-runs=", "first-warm-id=", "warm-pool=", "no-inst",
+                                                               "path=", "cyprom=", "reserved-runs=", "workers=",
+                                                               "queue="])
     except getopt.GetoptError as err:
         print "* ERROR: instsrv: Command-line argument error: %s" % (str(err))
         usage()
@@ -578,12 +891,68 @@ def main(argv):
         if opt in ("-h", "--help"):
             usage()
             sys.exit()
+        elif opt in ("-b", "--backlog"):
+            try:
+                MAX_QUEUED_INSTANTIATIONS = int(arg)
+                if MAX_QUEUED_INSTANTIATIONS < 1:
+                    raise ValueError
+            except ValueError:
+                print "* ERROR: instsrv: Invalid number of waiting instantiations: %s" % (arg)
+                usage()
+                sys.exit(1)
+        elif opt in ("-c", "--cyris-runs"):
+            try:
+                MAX_CYRIS_RUNS = int(arg)
+                if MAX_CYRIS_RUNS < 1:
+                    raise ValueError
+            except ValueError:
+                print "* ERROR: instsrv: Invalid number of CyRIS runs: %s" % (arg)
+                usage()
+                sys.exit(1)
+        elif opt in ("-r", "--reserved-runs"):
+            try:
+                RESERVED_CYRIS_RUNS = int(arg)
+                if RESERVED_CYRIS_RUNS < 0:
+                    raise ValueError
+            except ValueError:
+                print "* ERROR: instsrv: Invalid number of reserved CyRIS runs: %s" % (arg)
+                usage()
+                sys.exit(1)
+        elif opt in ("-f", "--first-warm-id"):
+            try:
+                FIRST_WARM_RANGE_ID = int(arg)
+                if FIRST_WARM_RANGE_ID < 1:
+                    raise ValueError
+            except ValueError:
+                print "* ERROR: instsrv: Invalid first warm range id: %s" % (arg)
+                usage()
+                sys.exit(1)
+        elif opt in ("-k", "--warm-pool"):
+            WARM_POOL_FILE = arg
         elif opt in ("-n", "--no-inst"):
             USE_CYRIS = False
         elif opt in ("-p", "--path"):
             CYRIS_PATH = arg
         elif opt in ("-m", "--cyprom"):
             CYPROM_PATH = arg
+        elif opt in ("-w", "--workers"):
+            try:
+                WORKER_POOL_SIZE = int(arg)
+                if WORKER_POOL_SIZE < 1:
+                    raise ValueError
+            except ValueError:
+                print "* ERROR: instsrv: Invalid number of workers: %s" % (arg)
+                usage()
+                sys.exit(1)
+        elif opt in ("-q", "--queue"):
+            try:
+                ACCEPT_QUEUE_SIZE = int(arg)
+                if ACCEPT_QUEUE_SIZE < 1:
+                    raise ValueError
+            except ValueError:
+                print "* ERROR: instsrv: Invalid queue size: %s" % (arg)
+                usage()
+                sys.exit(1)
 
     # Assign default values to CYRIS_PATH and CYPROM_PATH if necessary
     if not CYRIS_PATH:
@@ -596,6 +965,23 @@ def main(argv):
     if not CYPROM_PATH.endswith("/"):
         CYPROM_PATH += "/"
 
+    # Apply the instantiation queue settings
+    instantiation_queue.max_running = MAX_CYRIS_RUNS
+    instantiation_queue.max_waiting = MAX_QUEUED_INSTANTIATIONS
+    instantiation_queue.reserved_running = RESERVED_CYRIS_RUNS
+
+    # Create the warm pool, which is refilled while no instantiations wait
+    if WARM_POOL_FILE:
+        user_info = user_info_cache.get()
+        templates = None
+        if user_info:
+            templates = warmpool.load_templates(WARM_POOL_FILE, user_info, DATABASE_DIR)
+        if templates == None:
+            print "* ERROR: instsrv: Cannot create the warm pool => abort execution."
+            sys.exit(1)
+        warm_pool = warmpool.WarmPool(templates, WARM_POOL_STATE_FILE, instantiate_warm_range, destroy_warm_range,
+                                      lambda: instantiation_queue.get_waiting_count() == 0, FIRST_WARM_RANGE_ID)
+
     try:
 
         # Configure the web server
@@ -607,9 +993,11 @@ def main(argv):
 
         multi_threading = ""
         if ENABLE_THREADS:
-            server = ThreadedHTTPServer((server_address, server_port),
-                                        RequestHandler)
-            multi_threading = " (multi-threading mode)"
+            server = httpsrv.PooledHTTPServer((server_address, server_port),
+                                              RequestHandler, WORKER_POOL_SIZE, ACCEPT_QUEUE_SIZE,
+                                              idle_timeout=KEEP_ALIVE_TIMEOUT)
+            multi_threading = " (multi-threading mode: %d workers, queue size %d)" % (
+                WORKER_POOL_SIZE, ACCEPT_QUEUE_SIZE)
         else:
             server = HTTPServer((server_address, server_port), RequestHandler)
 
@@ -621,6 +1009,12 @@ def main(argv):
         else:
             print "* INFO: instsrv: Using CyRIS software installed in %s." % (CYRIS_PATH)
             print "* INFO: instsrv: Using CyPROM software installed in %s." % (CYPROM_PATH)
+        print "* INFO: instsrv: Instantiation queue: %d run(s) per host (+%d interactive), %d waiting instantiation(s)." % (
+            MAX_CYRIS_RUNS, RESERVED_CYRIS_RUNS, MAX_QUEUED_INSTANTIATIONS)
+        if warm_pool:
+            print "* INFO: instsrv: Warm pool: %s (range ids from %d)." % (
+                ", ".join([str(template) for template in warm_pool.templates]), FIRST_WARM_RANGE_ID)
+            warm_pool.start()
 
         if SERVE_FOREVER:
             server.serve_forever()
@@ -0,0 +1,173 @@
+
+#############################################################################
+# Classes related to the jobs executed in the background by CyTrONE servers
+#############################################################################
+
+# External imports
+import threading
+import time
+import uuid
+
+#############################################################################
+# Constants
+#############################################################################
+
+# Various constants
+SEPARATOR = "-----------------------------------------------------------------"
+
+# Time after which finished jobs are forgotten (seconds)
+JOB_RETENTION_TIME = 3600
+
+# Debugging constants
+DO_DEBUG = False
+
+
+#############################################################################
+# Phases of a job, in the order in which they are reached
+#############################################################################
+class Phases:
+
+    ALLOCATED = "allocated"
+    CONTENT_UPLOADED = "content_uploaded"
+    INSTANTIATING = "instantiating"
+    READY = "ready"
+    FAILED = "failed"
+
+    ORDER = [ALLOCATED, CONTENT_UPLOADED, INSTANTIATING, READY, FAILED]
+
+    FINAL_PHASES = [READY, FAILED]
+
+
+#############################################################################
+# Manage the information about one job
+#############################################################################
+class Job:
+
+    # Initialize object for a given user and cyber range id
+    def __init__(self, user_id, range_id):
+
+        self.job_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.range_id = range_id
+        self.phase = Phases.ALLOCATED
+        # Notification message when ready, or error message when failed
+        self.message = None
+        self.update_time = time.time()
+
+    # Determine whether the job finished
+    def is_finished(self):
+
+        return self.phase in Phases.FINAL_PHASES
+
+    # Create a string representation of the job
+    def __str__(self):
+
+        return "Job %s (user: %s, range: %s): %s" % (self.job_id, self.user_id,
+                                                     self.range_id, self.phase)
+
+    # Create a representation of the job as a dictionary, which can be
+    # converted to JSON format
+    def get_representation(self):
+
+        return {"job_id": self.job_id, "range_id": self.range_id,
+                "phase": self.phase, "message": self.message}
+
+
+#############################################################################
+# Manage the jobs of a server process; finished jobs are kept for a limited
+# time, so that their outcome can be retrieved
+#############################################################################
+class JobTable:
+
+    def __init__(self):
+
+        self.jobs = {}
+
+        # Lock for synchronizing access to the jobs
+        self.lock = threading.Lock()
+
+    # Create a job for a given user and cyber range id
+    # Return the Job object
+    def create_job(self, user_id, range_id):
+
+        job = Job(user_id, range_id)
+
+        self.lock.acquire()
+        try:
+            self.remove_expired_jobs()
+            self.jobs[job.job_id] = job
+        finally:
+            self.lock.release()
+
+        if DO_DEBUG:
+            print "* DEBUG: jobinfo: Created %s." % (job)
+
+        return job
+
+    # Remove the jobs that finished more than JOB_RETENTION_TIME ago
+    # Note: Requires synchronization
+    def remove_expired_jobs(self):
+
+        expiry_time = time.time() - JOB_RETENTION_TIME
+        for job_id in [job.job_id for job in self.jobs.itervalues()
+                       if job.is_finished() and job.update_time < expiry_time]:
+            del self.jobs[job_id]
+
+    # Get the representation of the job with given id that belongs to a
+    # specified user, or None if there is no such job
+    def get_job_representation(self, job_id, user_id):
+
+        self.lock.acquire()
+        try:
+            job = self.jobs.get(job_id, None)
+            if job and job.user_id == user_id:
+                return job.get_representation()
+            return None
+        finally:
+            self.lock.release()
+
+    # Advance a job to a given phase, optionally setting its message;
+    # phases only advance, hence a request to go back to an earlier
+    # phase, or to leave a final phase, is ignored
+    # Return True if the phase was changed
+    def set_phase(self, job, phase, message=None):
+
+        self.lock.acquire()
+        try:
+            if job.is_finished() or Phases.ORDER.index(phase) < Phases.ORDER.index(job.phase):
+                return False
+            job.phase = phase
+            if message != None:
+                job.message = message
+            job.update_time = time.time()
+        finally:
+            self.lock.release()
+
+        print "* INFO: jobinfo: %s." % (job)
+        return True
+
+
+#############################################################################
+# Testing code for the classes in this file
+#
+# This code will be executed _only_ when this module is called as the
+# main program
+#############################################################################
+if __name__ == '__main__':
+
+    enabled = [True]
+
+    #########################################################################
+    # TEST #1
+    if enabled[0]:
+        print SEPARATOR
+        print "TEST #1: Advance job through its phases."
+        print SEPARATOR
+        job_table = JobTable()
+        job = job_table.create_job("john_doe", "1")
+        job_table.set_phase(job, Phases.INSTANTIATING)
+        assert not job_table.set_phase(job, Phases.CONTENT_UPLOADED)
+        job_table.set_phase(job, Phases.READY, "Training session is ready")
+        assert not job_table.set_phase(job, Phases.FAILED)
+        assert job_table.get_job_representation(job.job_id, "jane_doe") == None
+        print "Job representation: %s" % (job_table.get_job_representation(job.job_id, "john_doe"))
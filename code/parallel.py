@@ -0,0 +1,254 @@
+
+#############################################################################
+# Classes for running functions concurrently in separate threads
+#############################################################################
+
+# External imports
+import itertools
+import sys
+import threading
+import Queue
+
+# Priority of the functions submitted without a priority; functions with a
+# lower value are executed first
+DEFAULT_PRIORITY = 0
+
+# Debugging constants
+DO_DEBUG = False
+
+
+#############################################################################
+# Manage the result of a function that is executed in a separate thread;
+# exceptions raised by the function are kept, and raised again when the
+# result is retrieved
+#############################################################################
+class Future:
+
+    # Initialize object for a function to be called with given arguments
+    def __init__(self, function, args):
+
+        self.function = function
+        self.args = args
+
+        # Event that is set when the function returns
+        self.done_event = threading.Event()
+
+        # Return value of the function, or information about the
+        # exception it raised
+        self.value = None
+        self.exc_info = None
+
+    # Call the function and store its outcome
+    def run(self):
+
+        try:
+            self.value = self.function(*self.args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+            print "* ERROR: parallel: Function '%s' raised exception: %s." % (
+                self.function.__name__, self.exc_info[1])
+        finally:
+            self.done_event.set()
+
+    # Determine whether the function returned
+    def done(self):
+
+        return self.done_event.is_set()
+
+    # Wait until the function returns
+    def wait(self):
+
+        # Note: Waiting with a timeout keeps the main thread responsive to ^C
+        while not self.done_event.wait(1):
+            pass
+
+    # Wait until the function returns, and get its return value; if the
+    # function raised an exception, it is raised again
+    def result(self):
+
+        self.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+# Start executing a function with given arguments in a new thread
+# Return a Future object for retrieving the result
+def submit(function, *args):
+
+    future = Future(function, args)
+    thread = threading.Thread(target=future.run)
+    thread.daemon = True
+    thread.start()
+
+    if DO_DEBUG:
+        print "* DEBUG: parallel: Started function '%s' in thread %s." % (function.__name__, thread.name)
+
+    return future
+
+# Wait until the functions corresponding to a list of Future objects return
+def wait_all(futures):
+
+    for future in futures:
+        future.wait()
+
+
+#############################################################################
+# Execute functions via a bounded pool of worker threads; functions that
+# are submitted while all workers are busy wait in a queue, so that at most
+# a given number of functions are executed at the same time; queued
+# functions are executed in priority order, and in submission order for
+# functions with the same priority; the number of queued functions can be
+# bounded, in which case submitting functions while the queue is full fails
+#############################################################################
+class Executor:
+
+    # Initialize object for a given maximum number of worker threads, and
+    # a given maximum number of queued functions (0 means no limit);
+    # workers are only started when functions are submitted
+    def __init__(self, max_workers, max_queued=0):
+
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.task_queue = Queue.PriorityQueue()
+        self.workers = []
+
+        # Submission counter, which orders functions with the same priority
+        self.sequence = itertools.count()
+
+        # Lock for synchronizing access to the worker list
+        self.lock = threading.Lock()
+
+    # Submit a function to be executed with given arguments
+    # Return a Future object for retrieving the result
+    def submit(self, function, *args):
+
+        return self.submit_with_priority(DEFAULT_PRIORITY, function, *args)
+
+    # Submit a function to be executed with given arguments and a given
+    # priority (a number, with lower values executed first)
+    # Return a Future object for retrieving the result, or raise Queue.Full
+    # if the maximum number of functions are already queued
+    def submit_with_priority(self, priority, function, *args):
+
+        future = Future(function, args)
+
+        self.lock.acquire()
+        try:
+            # Note: Idle workers remove functions from the queue immediately,
+            # hence only the functions that wait for a worker are counted
+            if self.max_queued and self.task_queue.qsize() >= self.max_queued:
+                raise Queue.Full
+            self.task_queue.put((priority, next(self.sequence), future))
+            if len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self.run_worker)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        finally:
+            self.lock.release()
+
+        return future
+
+    # Submit a function to be executed for each argument in a list
+    # Return the list of Future objects, in the same order as the arguments
+    def map(self, function, args_list):
+
+        return [self.submit(function, *args) for args in args_list]
+
+    # Execute the functions in the queue until the executor is shut down
+    def run_worker(self):
+
+        while True:
+            (priority, sequence, future) = self.task_queue.get()
+            if future == None:
+                break
+            future.run()
+
+    # Stop the worker threads after the queued functions are executed
+    def shutdown(self):
+
+        self.lock.acquire()
+        try:
+            for worker in self.workers:
+                self.task_queue.put((sys.maxint, next(self.sequence), None))
+            self.workers = []
+        finally:
+            self.lock.release()
+
+
+#############################################################################
+# Testing code for the classes in this file
+#
+# This code will be executed _only_ when this module is called as the
+# main program
+#############################################################################
+if __name__ == '__main__':
+
+    import time
+
+    enabled = [True, True, True, True]
+
+    #########################################################################
+    # TEST #1
+    if enabled[0]:
+        print "TEST #1: Run two functions concurrently."
+        start_time = time.time()
+        futures = [submit(time.sleep, 1), submit(time.sleep, 1)]
+        wait_all(futures)
+        print "Results: %s (%.3f s)" % ([future.result() for future in futures], time.time() - start_time)
+
+        future = submit(int, "invalid")
+        try:
+            future.result()
+        except ValueError as error:
+            print "Exception raised again: %s" % (error)
+
+    #########################################################################
+    # TEST #2
+    if enabled[1]:
+        print "TEST #2: Run 8 functions via an executor with 4 workers."
+        executor = Executor(4)
+        start_time = time.time()
+        futures = executor.map(time.sleep, [(0.5,)] * 8)
+        wait_all(futures)
+        print "Executed %d functions (%.3f s)" % (len(futures), time.time() - start_time)
+        executor.shutdown()
+
+    #########################################################################
+    # TEST #3
+    if enabled[2]:
+        print "TEST #3: Execute queued functions in priority order."
+        executor = Executor(1)
+        order = []
+        blocker = executor.submit(time.sleep, 0.2)
+        futures = [executor.submit_with_priority(priority, order.append, priority) for priority in [2, 1, 2, 0]]
+        wait_all(futures)
+        print "Execution order: %s" % (order)
+        assert order == [0, 1, 2, 2]
+        workers = executor.workers
+        executor.shutdown()
+        for worker in workers:
+            worker.join()
+
+    #########################################################################
+    # TEST #4
+    if enabled[3]:
+        print "TEST #4: Reject functions when the queue of an executor is full."
+        executor = Executor(1, 2)
+        blocker = executor.submit(time.sleep, 0.2)
+        time.sleep(0.1)
+        futures = [executor.submit(time.sleep, 0), executor.submit(time.sleep, 0)]
+        try:
+            executor.submit(time.sleep, 0)
+            assert False
+        except Queue.Full:
+            print "Queue full: function rejected"
+        wait_all(futures)
+        futures = [executor.submit(time.sleep, 0)]
+        wait_all(futures)
+        print "Queue available again: function executed"
+        workers = executor.workers
+        executor.shutdown()
+        for worker in workers:
+            worker.join()
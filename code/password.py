@@ -14,6 +14,24 @@ from passlib.hash import pbkdf2_sha256
 import hashlib
 import random
 
+# Used by the session tokens and the verification cache
+import hmac
+import os
+import time
+import base64
+import threading
+from collections import OrderedDict
+
+# Lifetime of session tokens (seconds)
+TOKEN_LIFETIME = 900
+
+# Maximum number of entries in the verification cache, and their lifetime (seconds)
+VERIFICATION_CACHE_SIZE = 1000
+VERIFICATION_CACHE_LIFETIME = 300
+
+# Length of the random keys used for signing tokens and cache entries (bytes)
+SECRET_KEY_LENGTH = 32
+
 class Password:
 
     # Use this field to control whether passlib is used or not
@@ -53,6 +71,140 @@ class Password:
                 print("* ERROR: password.py: Unsupported hashing algorithm: {}".format(algorithm))
                 return False
 
+
+#############################################################################
+# Manage short-lived session tokens, which are signed via HMAC-SHA256 and
+# can be verified without hashing the user password again; tokens include
+# a fingerprint of the encrypted password, hence they become invalid when
+# the password in the user database changes
+#############################################################################
+class TokenManager:
+
+    # Token field separator
+    SEPARATOR = ":"
+
+    # Initialize object; if no secret key is provided, a random one is
+    # generated, hence tokens are only valid for the current server process
+    def __init__(self, lifetime=TOKEN_LIFETIME, secret_key=None):
+
+        self.lifetime = lifetime
+        if secret_key:
+            self.secret_key = secret_key
+        else:
+            self.secret_key = os.urandom(SECRET_KEY_LENGTH)
+
+    # Compute the signature of a given string
+    def sign(self, data):
+
+        return hmac.new(self.secret_key, data, hashlib.sha256).hexdigest()
+
+    # Compute the fingerprint of an encrypted password
+    def get_fingerprint(self, enc_password):
+
+        return self.sign("password" + self.SEPARATOR + (enc_password or ""))[:16]
+
+    # Create a token for a given user and encrypted password
+    # Return the token as a string
+    def create_token(self, user_id, enc_password):
+
+        expiry_time = int(time.time()) + self.lifetime
+        payload = self.SEPARATOR.join([base64.urlsafe_b64encode(user_id), str(expiry_time),
+                                       self.get_fingerprint(enc_password)])
+        return payload + self.SEPARATOR + self.sign(payload)
+
+    # Verify a given token for a user and its current encrypted password
+    # Return true if the token is valid
+    def verify_token(self, token, user_id, enc_password):
+
+        try:
+            (encoded_user_id, expiry_time, fingerprint, signature) = token.split(self.SEPARATOR)
+            payload = self.SEPARATOR.join([encoded_user_id, expiry_time, fingerprint])
+            if not hmac.compare_digest(signature, self.sign(payload)):
+                return False
+            if base64.urlsafe_b64decode(encoded_user_id) != user_id:
+                return False
+            if int(expiry_time) < time.time():
+                return False
+            return hmac.compare_digest(fingerprint, self.get_fingerprint(enc_password))
+        except (ValueError, TypeError):
+            return False
+
+
+#############################################################################
+# Cache the successful password verifications for a limited time, so that
+# the password is not hashed again for each request of a user; entries are
+# keyed by a keyed hash of the user id, raw password and encrypted password,
+# hence raw passwords are not kept in memory, and entries are not used
+# anymore when the password in the user database changes
+#############################################################################
+class VerificationCache:
+
+    # Initialize object with a given maximum size and entry lifetime
+    def __init__(self, max_size=VERIFICATION_CACHE_SIZE, lifetime=VERIFICATION_CACHE_LIFETIME):
+
+        self.max_size = max_size
+        self.lifetime = lifetime
+        self.secret_key = os.urandom(SECRET_KEY_LENGTH)
+
+        # Expiry times of the entries, in least recently used order
+        self.entries = OrderedDict()
+
+        # Lock for synchronizing access to the entries and counters
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    # Compute the cache key for a given verification
+    def get_key(self, user_id, raw_password, enc_password):
+
+        return hmac.new(self.secret_key, "\0".join([user_id, raw_password, enc_password]),
+                        hashlib.sha256).digest()
+
+    # Verify a given raw password of a user against an encrypted one,
+    # using the cached result if available
+    # Return true if passwords match
+    def verify(self, user_id, raw_password, enc_password):
+
+        key = self.get_key(user_id, raw_password, enc_password)
+
+        self.lock.acquire()
+        try:
+            expiry_time = self.entries.pop(key, None)
+            if expiry_time != None and expiry_time >= time.time():
+                # Reinsert entry so that it becomes the most recently used one
+                self.entries[key] = expiry_time
+                self.hits += 1
+                return True
+            self.misses += 1
+        finally:
+            self.lock.release()
+
+        # Verify outside the lock, since it is a slow operation
+        if not Password.verify(raw_password, enc_password):
+            return False
+
+        self.lock.acquire()
+        try:
+            self.entries[key] = time.time() + self.lifetime
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+        return True
+
+    # Get the cache statistics as a dictionary
+    def get_statistics(self):
+
+        self.lock.acquire()
+        try:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+        finally:
+            self.lock.release()
+
+
 def main():
     
     # Set to True for a basic test, or to False in order to enable the password encoding functionality
@@ -67,6 +219,20 @@ def main():
 
         result = Password.verify(raw_password, enc_password)
         print("* TEST: Verify password '{}' vs. '{}' => {}".format(raw_password, enc_password, result))
+
+        token_manager = TokenManager()
+        token = token_manager.create_token("sample_user", enc_password)
+        result = token_manager.verify_token(token, "sample_user", enc_password)
+        print("* TEST: Verify token '{}' => {}".format(token, result))
+        result = token_manager.verify_token(token, "sample_user", Password.encode(raw_password))
+        print("* TEST: Verify token after password change => {}".format(result))
+
+        verification_cache = VerificationCache()
+        for i in range(3):
+            start_time = time.time()
+            result = verification_cache.verify("sample_user", raw_password, enc_password)
+            print("* TEST: Verify password via cache => {} ({:.3f} s)".format(result, time.time() - start_time))
+        print("* TEST: Verification cache statistics: {}".format(verification_cache.get_statistics()))
     else:
         print("* INFO: Password manager for CyTrONE: Please follow the instructions below.")
         raw_password = getpass.getpass("* INFO: Enter the password to be encoded: ")
@@ -0,0 +1,204 @@
+
+#############################################################################
+# Classes for executing actions as pipelines of steps with dependencies
+#############################################################################
+
+# External imports
+import time
+import Queue
+from collections import OrderedDict
+
+# Internal imports
+import deadline
+import parallel
+from storyboard import Storyboard
+
+# Debugging constants
+DO_DEBUG = False
+
+
+#############################################################################
+# Manage one step of a pipeline; the step function receives the pipeline
+# context (a dictionary that steps use to share data), and must return an
+# error message, or None on success; the compensation function, if any,
+# receives the context as well, and is called to undo the effects of the
+# step when a later step fails
+#############################################################################
+class Step:
+
+    # Initialize object with a name, a function, the names of the steps
+    # that must succeed before this step starts, and a compensation
+    def __init__(self, name, function, requires=[], compensation=None):
+
+        self.name = name
+        self.function = function
+        self.requires = list(requires)
+        self.compensation = compensation
+
+
+#############################################################################
+# Manage a pipeline of steps; each step starts as soon as the steps it
+# requires have succeeded, hence independent steps are executed
+# concurrently; when a step fails, no further steps are started, and the
+# compensations of the steps that succeeded are executed in reverse order
+#
+# If the context contains a Deadline object with key "deadline", no steps
+# are started after it expired, and the compensations receive a new
+# deadline, so that they can release resources even then
+#############################################################################
+class Pipeline:
+
+    # Initialize object with a name and a list of steps; steps can only
+    # require steps that appear before them in the list
+    def __init__(self, name, steps):
+
+        self.name = name
+        self.steps = steps
+
+        step_names = []
+        for step in steps:
+            for required_name in step.requires:
+                assert required_name in step_names, "Step '%s' requires unknown step '%s'" % (
+                    step.name, required_name)
+            step_names.append(step.name)
+
+    # Execute a step and report its outcome via a queue
+    def run_step(self, step, context, done_queue):
+
+        start_time = time.time()
+        try:
+            error_message = step.function(context)
+        except Exception as error:
+            print "* ERROR: pipeline: Step '%s' raised exception: %s." % (step.name, error)
+            error_message = Storyboard.PIPELINE_STEP_ERROR
+        done_queue.put((step, error_message, time.time() - start_time))
+
+    # Execute the pipeline for a given context; the duration of each step
+    # is stored in the context as a dictionary with key "timings"
+    # Return an error message, or None on success
+    def run(self, context):
+
+        start_time = time.time()
+        timings = OrderedDict()
+        context["timings"] = timings
+
+        pending_steps = list(self.steps)
+        running_count = 0
+        succeeded_steps = []
+        succeeded_names = set()
+        error_message = None
+        done_queue = Queue.Queue()
+
+        action_deadline = context.get("deadline", None)
+
+        while True:
+            # Start the steps whose requirements are met, unless a step failed
+            # or the deadline expired
+            if not error_message and pending_steps and action_deadline and action_deadline.is_expired():
+                print "* ERROR: pipeline: %s: Deadline expired." % (self.name)
+                error_message = Storyboard.DEADLINE_EXPIRED_ERROR
+            if not error_message:
+                for step in list(pending_steps):
+                    if succeeded_names.issuperset(step.requires):
+                        if DO_DEBUG:
+                            print "* DEBUG: pipeline: %s: Start step '%s'." % (self.name, step.name)
+                        pending_steps.remove(step)
+                        parallel.submit(self.run_step, step, context, done_queue)
+                        running_count += 1
+
+            if running_count == 0:
+                break
+
+            # Wait for a running step to finish
+            # Note: Waiting with a timeout keeps the main thread responsive to ^C
+            while True:
+                try:
+                    (step, step_error, duration) = done_queue.get(True, 1)
+                    break
+                except Queue.Empty:
+                    pass
+            running_count -= 1
+            timings[step.name] = duration
+
+            if step_error:
+                print "* ERROR: pipeline: %s: Step '%s' failed: %s." % (self.name, step.name, step_error)
+                # Steps usually fail because of the deadline when it expired
+                if action_deadline and action_deadline.is_expired():
+                    step_error = Storyboard.DEADLINE_EXPIRED_ERROR
+                # Keep the error of the first step that failed
+                if not error_message:
+                    error_message = step_error
+            else:
+                succeeded_steps.append(step)
+                succeeded_names.add(step.name)
+
+        # Undo the effects of the steps that succeeded
+        if error_message:
+            if action_deadline:
+                context["deadline"] = deadline.Deadline(deadline.CLEANUP_TIMEOUT)
+            for step in reversed(succeeded_steps):
+                if step.compensation:
+                    print "* INFO: pipeline: %s: Compensate step '%s'." % (self.name, step.name)
+                    compensation_start_time = time.time()
+                    try:
+                        step.compensation(context)
+                    except Exception as error:
+                        print "* ERROR: pipeline: Compensation of step '%s' raised exception: %s." % (
+                            step.name, error)
+                    timings["undo_" + step.name] = time.time() - compensation_start_time
+
+        print "* INFO: pipeline: %s: %s in %.3f s (%s)." % (
+            self.name, "Failed" if error_message else "Succeeded", time.time() - start_time,
+            ", ".join(["%s: %.3f s" % (name, duration) for (name, duration) in timings.iteritems()]))
+
+        return error_message
+
+
+#############################################################################
+# Testing code for the classes in this file
+#
+# This code will be executed _only_ when this module is called as the
+# main program
+#############################################################################
+if __name__ == '__main__':
+
+    enabled = [True, True, True]
+
+    def sleep_step(context):
+        time.sleep(0.5)
+
+    def fail_step(context):
+        return "Simulated failure"
+
+    def undo_step(context):
+        context["undone"] = True
+
+    #########################################################################
+    # TEST #1
+    if enabled[0]:
+        print "TEST #1: Run two independent steps concurrently, followed by a dependent one."
+        test_pipeline = Pipeline("test", [Step("first", sleep_step),
+                                          Step("second", sleep_step),
+                                          Step("third", sleep_step, requires=["first", "second"])])
+        assert test_pipeline.run({}) == None
+
+    #########################################################################
+    # TEST #2
+    if enabled[1]:
+        print "TEST #2: Compensate a step that succeeded when another one fails."
+        context = {}
+        test_pipeline = Pipeline("test", [Step("first", sleep_step, compensation=undo_step),
+                                          Step("second", fail_step),
+                                          Step("third", sleep_step, requires=["first", "second"])])
+        assert test_pipeline.run(context) == "Simulated failure"
+        assert context["undone"]
+
+    #########################################################################
+    # TEST #3
+    if enabled[2]:
+        print "TEST #3: Stop starting steps when the deadline expires."
+        context = {"deadline": deadline.Deadline(0.2)}
+        test_pipeline = Pipeline("test", [Step("first", sleep_step, compensation=undo_step),
+                                          Step("second", sleep_step, requires=["first"])])
+        assert test_pipeline.run(context) == Storyboard.DEADLINE_EXPIRED_ERROR
+        assert context["undone"] and not context["deadline"].is_expired()
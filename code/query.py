@@ -31,17 +31,21 @@ class Parameters:
     # User information
     USER = "user"
     PASSWORD = "password"
+    TOKEN = "token"
 
     # Action specification
     ACTION = "action"
 
-    FETCH_CONTENT = "fetch_content"         # Training server
+    LOGIN = "login"                         # Training server
+    FETCH_CONTENT = "fetch_content"
     CREATE_TRAINING = "create_training"
     CREATE_TRAINING_Variation = "create_training_variation"
     END_TRAINING_Variation = "end_training_variation"
     GET_CONFIGURATIONS = "get_configurations"
     GET_SESSIONS = "get_sessions"
     END_TRAINING = "end_training"
+    GET_JOB_STATUS = "get_job_status"
+    GET_SERVER_STATUS = "get_server_status"
 
     INSTANTIATE_RANGE = "instantiate_range" # Instantiation server
     DESTROY_RANGE = "destroy_range"
@@ -55,6 +59,8 @@ class Parameters:
     UPLOAD_CONTENT = "upload_content"       # Content server
     REMOVE_CONTENT = "remove_content"
 
+    HEALTH = "health"                       # Instantiation and content servers
+
     # Language settings
     LANG = "lang"
     EN = "en"
@@ -70,6 +76,21 @@ class Parameters:
     RANGE_ID = "range_id"
     ACTIVITY_ID = "activity_id"
 
+    # Retry settings
+    IDEMPOTENCY_KEY = "idempotency_key"
+
+    # Background execution settings
+    ASYNC = "async"
+    JOB_ID = "job_id"
+    TRUE_VALUES = ["true", "yes", "1"]
+
+    # Priority settings, from the highest priority to the lowest
+    PRIORITY = "priority"
+    INTERACTIVE = "interactive"
+    NORMAL = "normal"
+    BATCH = "batch"
+    PRIORITIES = [INTERACTIVE, NORMAL, BATCH]
+
     #########################################################################
     # Initialize object with parameters from POST message
     def __init__(self, request_handler = None):
@@ -106,6 +127,7 @@ class Parameters:
         default_values = {
             self.USER: None,
             self.PASSWORD: None,
+            self.TOKEN: None,
             self.ACTION: None,
             self.LANG: [self.EN],
             self.TYPE: None,
@@ -115,7 +137,11 @@ class Parameters:
             self.DESCRIPTION_FILE: None,
             self.PROGRESSION_SCENARIO: None,
             self.RANGE_ID: None,
-	    self.ACTIVITY_ID: None
+	    self.ACTIVITY_ID: None,
+            self.ASYNC: None,
+            self.JOB_ID: None,
+            self.PRIORITY: [self.NORMAL],
+            self.IDEMPOTENCY_KEY: None
         }
 
         # Get values associated to the key
@@ -151,11 +177,13 @@ class Response:
                 # Get status value
                 status = item.get(Storyboard.SERVER_STATUS_KEY, None)
 
-                # Get activity_id or message
+                # Get activity_id, message or token
                 if item.has_key(Storyboard.SERVER_ACTIVITY_ID_KEY):
                     additional_info = item.get(Storyboard.SERVER_ACTIVITY_ID_KEY)
                 elif item.has_key(Storyboard.SERVER_MESSAGE_KEY):
                     additional_info = item.get(Storyboard.SERVER_MESSAGE_KEY)
+                elif item.has_key(Storyboard.SERVER_TOKEN_KEY):
+                    additional_info = item.get(Storyboard.SERVER_TOKEN_KEY)
 
             return (status, additional_info)
 
@@ -6,12 +6,23 @@
 # External imports
 import yaml
 import json
+import os
+import threading
+import time
+import heapq
+from collections import OrderedDict
 #import types
 
 # Various constants
 SEPARATOR = "-----------------------------------------------------------------"
 SEPARATO2 = "================================================================="
 
+# Session journal constants
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_SEQUENCE_KEY = "journal_sequence"
+JOURNAL_COMPACTION_THRESHOLD = 100 # Number of records that triggers a compaction
+JOURNAL_COMPACTION_INTERVAL = 60 # Maximum time between compactions (seconds)
+
 # Debugging constants
 DO_DEBUG = False
 
@@ -34,6 +45,7 @@ class Keys:
     LANGUAGE = "language"
     COUNT = "count"
     ACTIVITY_ID = "activity_id"
+    SHARDS = "shards"
 
 
 #############################################################################
@@ -78,9 +90,14 @@ class Session:
 
             self.activity_id = session_info.get(Keys.ACTIVITY_ID, None)
 
+            # URLs of the instantiation servers that manage the parts of
+            # the range; not defined for sessions created before sharding
+            # was used
+            self.shards = session_info.get(Keys.SHARDS, None)
+
     # Set fields for Session object
     def set_fields(self, name, sess_id, user_id, time, ttype,
-                   scenarios, levels, language, count, activity_id):
+                   scenarios, levels, language, count, activity_id, shards=None):
         self.name = name
         self.sess_id = sess_id
         self.user_id = user_id
@@ -92,6 +109,7 @@ class Session:
         self.language = language
         self.count = count
         self.activity_id = activity_id
+        self.shards = shards
         
     # Create a string representation of the session
     def __str__(self):
@@ -106,6 +124,8 @@ class Session:
                  + Keys.LANGUAGE + ": " + self.language + "\n    " \
                  + Keys.COUNT + ": " + self.count + "\n    " \
                  + Keys.ACTIVITY_ID + ": " + self.activity_id
+        if self.shards:
+            string += "\n    " + Keys.SHARDS + ": " + str(self.shards)
 
         return string
     
@@ -128,6 +148,8 @@ class Session:
         session_repr[Keys.USER] = self.user_id
         session_repr[Keys.TIME] = self.time
         session_repr[Keys.ACTIVITY_ID] = self.activity_id
+        if self.shards:
+            session_repr[Keys.SHARDS] = self.shards
 
         # Content-related info
         session_repr[Keys.TYPE] = self.ttype
@@ -143,15 +165,34 @@ class Session:
 #############################################################################
 class SessionInfo:
 
-    # List of sessions (as Session objects)
-    sessions = []
+    # Initialize object
+    def __init__(self):
+
+        self.clear()
+
+    # Initialize the sessions and the indexes
+    def clear(self):
+
+        # Ordered dictionary of sessions (as Session objects), with
+        # internal keys that are assigned when sessions are added
+        self.sessions = OrderedDict()
+        self.next_key = 0
+
+        # Indexes of sessions; each index maps an index key to an ordered
+        # dictionary of the matching sessions (by internal key):
+        # - range_index: range id
+        # - range_user_index: (range id, user id)
+        # - activity_index: activity id, then (range id, user id)
+        self.range_index = {}
+        self.range_user_index = {}
+        self.activity_index = {}
 
     # Parse YAML information in a file and store values into the
     # object fields
     def parse_YAML_file(self, yaml_file_name):
 
         # Initialize the sessions list
-        self.sessions = []
+        self.clear()
         
         # Open the YAML file
         try:
@@ -198,7 +239,7 @@ class SessionInfo:
     def parse_info(self, info):
 
         # Initialize the sessions list
-        self.sessions = []
+        self.clear()
         
         # Get data for all training sessions from info
         for data in info:
@@ -222,7 +263,7 @@ class SessionInfo:
         for session_info in sessions_info:
 
             session = Session(session_info)
-            self.sessions.append(session)
+            self.append_session(session)
 
             if DO_DEBUG:
                 print "* DEBUG: sessinfo: SESSION:\n%s" % (session)
@@ -235,82 +276,111 @@ class SessionInfo:
     
     # Add a session with the corresponding parameters
     def add_session(self, session_name, cyber_range_id, user_id, crt_time,
-                    ttype, scenarios, levels, language, count, activity_id):
+                    ttype, scenarios, levels, language, count, activity_id, shards=None):
 
         session = Session(None)
         session.set_fields(session_name, cyber_range_id, user_id, crt_time,
-                           ttype, scenarios, levels, language, count, activity_id)
-        self.sessions.append(session)
+                           ttype, scenarios, levels, language, count, activity_id, shards)
+        self.append_session(session)
 
         #if DO_DEBUG:   
         #self.pretty_print()
 
+        return session
+
+
+    # Append a Session object to the sessions list, and add it to indexes
+    def append_session(self, session):
+
+        session.key = self.next_key
+        self.next_key += 1
+        self.sessions[session.key] = session
+
+        range_user = (session.sess_id, session.user_id)
+        self.range_index.setdefault(session.sess_id, OrderedDict())[session.key] = session
+        self.range_user_index.setdefault(range_user, OrderedDict())[session.key] = session
+        self.activity_index.setdefault(session.activity_id, {}).setdefault(
+            range_user, OrderedDict())[session.key] = session
+
+    # Remove a Session object from the sessions list and indexes
+    def unlink_session(self, session):
+
+        range_user = (session.sess_id, session.user_id)
+        del self.sessions[session.key]
+        remove_index_entry(self.range_index, session.sess_id, session.key)
+        remove_index_entry(self.range_user_index, range_user, session.key)
+        activity_sessions = self.activity_index[session.activity_id]
+        remove_index_entry(activity_sessions, range_user, session.key)
+        if not activity_sessions:
+            del self.activity_index[session.activity_id]
 
     # Remove a session with the corresponding parameters
     def remove_session(self, cyber_range_id, user_id):
 
-        for session in self.sessions:
-            if session.sess_id == cyber_range_id and session.user_id == user_id:
-                self.sessions.remove(session)
-                return True
+        session = get_first_entry(self.range_user_index, (cyber_range_id, user_id))
+        if session:
+            self.unlink_session(session)
+            return True
 
         return False
+
     # Remove a session with the corresponding parameters
     def remove_session_variation(self, cyber_range_id, user_id,activity_id):
-        for session in self.sessions:
-            if session.sess_id == cyber_range_id and session.user_id == user_id and session.activity_id == activity_id:
-                self.sessions.remove(session)
-                return True
+
+        session = get_first_entry(self.activity_index.get(activity_id, {}),
+                                  (cyber_range_id, user_id))
+        if session:
+            self.unlink_session(session)
+            return True
 
         return False
 
     # Build a list of active session ids
     def get_id_list_int(self):
 
-        id_list = []
-        for session in self.sessions:
-            id_list.append(int(session.sess_id))
-
-        return id_list
+        return map(int, self.range_index)
 
     # Determine whether a session with the given id exists
     def is_session_id(self, cyber_range_id):
 
-        for session in self.sessions:
-            if session.sess_id == cyber_range_id:
-                return True
-
-        return False
+        return cyber_range_id in self.range_index
 
     # Determine whether a session with the given id exists for the
     # specified user
     def is_session_id_user(self, cyber_range_id, user_id):
 
-        for session in self.sessions:
-            if session.sess_id == cyber_range_id and session.user_id == user_id:
-                return True
-
-        return False
+        return (cyber_range_id, user_id) in self.range_user_index
 
     # Get the activity id for a session with given id and a specified user
     def get_activity_id(self, cyber_range_id, user_id):
 
-        for session in self.sessions:
-            if session.sess_id == cyber_range_id and session.user_id == user_id:
-                return session.activity_id
+        session = get_first_entry(self.range_user_index, (cyber_range_id, user_id))
+        if session:
+            return session.activity_id
 
         return None
 
     # Get the activity id for a session with given id and a specified user
     def get_activity_id_list(self, cyber_range_id, user_id):
-        activity_list=[]
-        for session in self.sessions:
-            if session.sess_id == cyber_range_id and session.user_id == user_id:
-                activity_list.append(session.activity_id)
-        if activity_list is None:
-            return None
-        else:
-            return activity_list
+
+        sessions = self.range_user_index.get((cyber_range_id, user_id), {})
+        return [session.activity_id for session in sessions.itervalues()]
+
+    # Get the shards for a session with given id and a specified user
+    def get_shards(self, cyber_range_id, user_id):
+
+        session = get_first_entry(self.range_user_index, (cyber_range_id, user_id))
+        if session:
+            return session.shards
+
+        return None
+
+    # Build a dictionary of the shards of the active ranges, with the
+    # range id as key
+    def get_range_shards(self):
+
+        return dict([(cyber_range_id, next(sessions.itervalues()).shards)
+                     for (cyber_range_id, sessions) in self.range_index.iteritems()])
 
     # Store session information in a YAML file
     def write_YAML_file(self, yaml_file_name):
@@ -319,13 +389,6 @@ class SessionInfo:
 
         info = self.get_JSON_representation_all()
 
-        # Open the YAML file
-        try:
-            yaml_file = open(yaml_file_name, "w")
-        except IOError:
-            print "* ERROR: sessinfo: Cannot open file '%s' for write." % (yaml_file_name)
-            return False
-
         if DO_DEBUG:
             print SEPARATOR
             print "* DEBUG: sessinfo: Current session info:"
@@ -336,12 +399,14 @@ class SessionInfo:
 #            print yaml.dump(info, default_flow_style = True)
             print SEPARATOR
 
-        yaml_file.write(info)
+        # Write the file atomically, so that a crash cannot truncate it
+        if not write_file_atomically(yaml_file_name, info):
+            print "* ERROR: sessinfo: Cannot open file '%s' for write." % (yaml_file_name)
+            return False
         
         #yaml.dump(info, yaml_file)
-        
-        # Close the file
-        yaml_file.close()
+
+        return True
        
     # Pretty-print info about the scenarios
     def pretty_print(self):
@@ -349,7 +414,7 @@ class SessionInfo:
         print "SESSION INFO: %d session(s)" % (len(self.sessions))
         print SEPARATOR
         index = 1;
-        for session in self.sessions:
+        for session in self.sessions.itervalues():
             #print "SESSION %d:" % (index)
             print "SESSION:"
             print session.__str__()
@@ -365,7 +430,7 @@ class SessionInfo:
         # Build sessions representation
         sessions_repr = {}
         sessions_repr_array = []
-        for session in self.sessions:
+        for session in self.sessions.itervalues():
             session_repr = session.get_JSON_representation(user_id)
 
             # Only add representation to array if it is not empty
@@ -381,12 +446,18 @@ class SessionInfo:
     # Create an external JSON representation that includes
     # information for all users
     def get_JSON_representation_all(self):
+
+        return json.dumps(self.get_representation_all())
+
+    # Create a representation that includes information for all users,
+    # which can be converted to JSON
+    def get_representation_all(self):
         representation = []
 
         # Build sessions representation
         sessions_repr = {}
         sessions_repr_array = []
-        for session in self.sessions:
+        for session in self.sessions.itervalues():
             session_repr = session.get_JSON_representation_all()
 
             # Only add representation to array if it is not empty
@@ -397,7 +468,634 @@ class SessionInfo:
         # Combine representations
         representation.append(sessions_repr)
 
-        return json.dumps(representation)
+        return representation
+
+
+#############################################################################
+# Get the first session in an index entry, or None if there is no entry
+#############################################################################
+def get_first_entry(index, index_key):
+
+    sessions = index.get(index_key, None)
+    if sessions:
+        return next(sessions.itervalues())
+
+    return None
+
+#############################################################################
+# Remove a session from an index entry, and the entry itself if it becomes
+# empty
+#############################################################################
+def remove_index_entry(index, index_key, session_key):
+
+    sessions = index[index_key]
+    del sessions[session_key]
+    if not sessions:
+        del index[index_key]
+
+
+#############################################################################
+# Write content to a file atomically: the content is first written to a
+# temporary file, which then replaces the original one, so that a crash
+# while writing cannot leave a truncated file behind
+#############################################################################
+def write_file_atomically(file_name, content):
+
+    temp_file_name = file_name + ".tmp"
+    try:
+        temp_file = open(temp_file_name, "w")
+        try:
+            temp_file.write(content)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        finally:
+            temp_file.close()
+        os.rename(temp_file_name, file_name)
+    except (IOError, OSError) as error:
+        print "* ERROR: sessinfo: Cannot write file '%s': %s." % (file_name, error)
+        return False
+
+    return True
+
+
+#############################################################################
+# Manage the active training sessions of a server process; sessions are
+# kept in memory, which is the authoritative copy, and the file is only
+# read at startup, then written whenever sessions change
+#############################################################################
+class SessionStore:
+
+    # Initialize object for a given session file; if the journal is used,
+    # each change is appended to a journal file, which is periodically
+    # folded into the session file (snapshot) by a background thread
+    def __init__(self, yaml_file_name, use_journal=False):
+
+        self.yaml_file_name = yaml_file_name
+        self.session_info = SessionInfo()
+
+        # Lock for synchronizing access to the sessions
+        self.lock = threading.RLock()
+
+        # Journal-related variables
+        self.use_journal = use_journal
+        self.journal_file_name = yaml_file_name + JOURNAL_SUFFIX
+        self.journal_file = None
+        self.journal_records = 0 # Number of records in the journal file
+        self.sequence = 0 # Sequence number of the last change
+        self.compaction_event = threading.Event()
+        self.compaction_thread = None
+
+    # Load the sessions from file (to be called at startup); the journal
+    # is replayed on top of the session file if it exists
+    def load(self):
+
+        self.lock.acquire()
+        try:
+            session_info = SessionInfo()
+            sequence = 0
+            if not os.path.isfile(self.yaml_file_name):
+                print "* INFO: sessinfo: No session file '%s' => start without sessions." % (self.yaml_file_name)
+            else:
+                sequence = self.read_snapshot(session_info)
+                if sequence == None:
+                    print "* ERROR: sessinfo: Cannot load sessions from file '%s'." % (self.yaml_file_name)
+                    return False
+
+            journal_exists = os.path.isfile(self.journal_file_name)
+            if journal_exists:
+                sequence = self.replay_journal(session_info, sequence)
+                if sequence == None:
+                    return False
+
+            self.session_info = session_info
+            self.sequence = sequence
+            print "* INFO: sessinfo: Loaded %d session(s) from file '%s'." % (
+                len(self.session_info.sessions), self.yaml_file_name)
+
+            # Fold the replayed journal records into a new snapshot
+            if self.use_journal:
+                if not self.compact():
+                    return False
+                self.start_compaction_thread()
+            elif journal_exists:
+                if not self.save():
+                    return False
+                os.remove(self.journal_file_name)
+
+            return True
+        finally:
+            self.lock.release()
+
+    # Read the sessions from the session file into a SessionInfo object
+    # Return the journal sequence number stored in the file (0 if none),
+    # or None in case of error
+    def read_snapshot(self, session_info):
+
+        try:
+            yaml_file = open(self.yaml_file_name, "r")
+            try:
+                info = yaml.load(yaml_file)
+            finally:
+                yaml_file.close()
+            if not session_info.parse_info(info):
+                return None
+        except (IOError, yaml.YAMLError, AssertionError, AttributeError, TypeError, NameError):
+            return None
+
+        sequence = 0
+        for data in info:
+            sequence = data.get(JOURNAL_SEQUENCE_KEY, sequence)
+
+        return sequence
+
+    # Apply the journal records newer than the given sequence number to a
+    # SessionInfo object; an incomplete last record (due to a crash while
+    # writing it) is ignored
+    # Return the sequence number of the last applied record, or None in
+    # case of error
+    def replay_journal(self, session_info, sequence):
+
+        try:
+            journal_file = open(self.journal_file_name, "r")
+        except IOError:
+            print "* ERROR: sessinfo: Cannot open journal file '%s' for read." % (self.journal_file_name)
+            return None
+
+        record_count = 0
+        try:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print "* WARNING: sessinfo: Ignored incomplete journal record in file '%s'." % (self.journal_file_name)
+                    break
+                if record["seq"] <= sequence:
+                    continue
+                self.apply_record(session_info, record)
+                sequence = record["seq"]
+                record_count += 1
+        finally:
+            journal_file.close()
+
+        print "* INFO: sessinfo: Replayed %d journal record(s) from file '%s'." % (
+            record_count, self.journal_file_name)
+
+        return sequence
+
+    # Apply a journal record to a SessionInfo object
+    def apply_record(self, session_info, record):
+
+        operation = record["op"]
+        if operation == "add":
+            session_info.append_session(Session(record["session"]))
+        elif operation == "add_all":
+            for session_repr in record["sessions"]:
+                session_info.append_session(Session(session_repr))
+        elif operation == "remove":
+            session_info.remove_session(record[Keys.ID], record[Keys.USER])
+        elif operation == "remove_variation":
+            session_info.remove_session_variation(record[Keys.ID], record[Keys.USER],
+                                                  record[Keys.ACTIVITY_ID])
+        elif operation == "remove_variations":
+            for activity_id in record["activity_ids"]:
+                session_info.remove_session_variation(record[Keys.ID], record[Keys.USER],
+                                                      activity_id)
+        else:
+            print "* WARNING: sessinfo: Unknown journal operation: %s." % (operation)
+
+    # Append a record to the journal file, and make sure it reaches the disk
+    # Note: Requires synchronization for the sessions
+    def append_record(self, record):
+
+        self.sequence += 1
+        record["seq"] = self.sequence
+
+        # The journal file is missing if it could not be reopened after a
+        # compaction; the change is then persisted via a snapshot, and the
+        # journal is reopened by the next compaction
+        if not self.journal_file:
+            print "* ERROR: sessinfo: Journal file '%s' is not open => save all sessions instead." % (
+                self.journal_file_name)
+            self.compaction_event.set()
+            return self.write_snapshot()
+
+        try:
+            self.journal_file.write(json.dumps(record) + "\n")
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+        except (IOError, OSError) as error:
+            print "* ERROR: sessinfo: Cannot write journal file '%s': %s." % (self.journal_file_name, error)
+            return False
+
+        self.journal_records += 1
+        if self.journal_records >= JOURNAL_COMPACTION_THRESHOLD:
+            self.compaction_event.set()
+
+        return True
+
+    # Persist a change, either as journal record, or by saving all sessions
+    # Note: Requires synchronization for the sessions
+    def persist(self, record):
+
+        if self.use_journal:
+            return self.append_record(record)
+
+        return self.save()
+
+    # Save the sessions to file
+    # Note: Requires synchronization for the sessions
+    def save(self):
+
+        if not self.session_info.write_YAML_file(self.yaml_file_name):
+            print "* ERROR: sessinfo: Cannot save sessions to file '%s'." % (self.yaml_file_name)
+            return False
+
+        return True
+
+    # Write a snapshot of the sessions that includes the sequence number of
+    # the last change to the session file
+    # Note: Requires synchronization for the sessions
+    def write_snapshot(self):
+
+        representation = self.session_info.get_representation_all()
+        representation.append({JOURNAL_SEQUENCE_KEY: self.sequence})
+        return write_file_atomically(self.yaml_file_name, json.dumps(representation))
+
+    # Fold the journal into the session file: a snapshot is written, then
+    # a new journal is started; if a crash occurs before the journal is
+    # emptied, the records already in the snapshot are skipped at replay time
+    def compact(self):
+
+        self.lock.acquire()
+        try:
+            if not self.write_snapshot():
+                return False
+
+            try:
+                if self.journal_file:
+                    self.journal_file.close()
+                self.journal_file = open(self.journal_file_name, "w")
+            except IOError:
+                print "* ERROR: sessinfo: Cannot open journal file '%s' for write." % (self.journal_file_name)
+                self.journal_file = None
+                return False
+
+            if DO_DEBUG:
+                print "* DEBUG: sessinfo: Compacted %d journal record(s) (sequence: %d)." % (
+                    self.journal_records, self.sequence)
+            self.journal_records = 0
+
+            return True
+        finally:
+            self.lock.release()
+
+    # Start the background thread that compacts the journal
+    def start_compaction_thread(self):
+
+        if self.compaction_thread:
+            return
+
+        self.compaction_thread = threading.Thread(target=self.run_compaction)
+        self.compaction_thread.daemon = True
+        self.compaction_thread.start()
+
+    # Compact the journal when enough records are accumulated, or after
+    # a given interval
+    def run_compaction(self):
+
+        while True:
+            self.compaction_event.wait(JOURNAL_COMPACTION_INTERVAL)
+            self.compaction_event.clear()
+            self.lock.acquire()
+            try:
+                if self.journal_records > 0 or not self.journal_file:
+                    self.compact()
+            finally:
+                self.lock.release()
+
+    # Fold the journal into the session file before shutting down
+    def close(self):
+
+        self.lock.acquire()
+        try:
+            if self.use_journal and self.journal_file:
+                self.compact()
+                self.journal_file.close()
+                self.journal_file = None
+        finally:
+            self.lock.release()
+
+    # Add a session with the corresponding parameters, and persist the change
+    def add_session(self, session_name, cyber_range_id, user_id, crt_time,
+                    ttype, scenarios, levels, language, count, activity_id, shards=None):
+
+        self.lock.acquire()
+        try:
+            session = self.session_info.add_session(session_name, cyber_range_id, user_id, crt_time,
+                                                    ttype, scenarios, levels, language, count, activity_id,
+                                                    shards)
+            return self.persist({"op": "add", "session": session.get_JSON_representation_all()})
+        finally:
+            self.lock.release()
+
+    # Add sessions with the corresponding parameters, one for each of the
+    # given activity ids, and persist the change via a single write
+    def add_sessions(self, session_name, cyber_range_id, user_id, crt_time,
+                     ttype, scenarios, levels, language, count, activity_ids, shards=None):
+
+        self.lock.acquire()
+        try:
+            sessions_repr = []
+            for activity_id in activity_ids:
+                session = self.session_info.add_session(session_name, cyber_range_id, user_id, crt_time,
+                                                        ttype, scenarios, levels, language, count, activity_id,
+                                                        shards)
+                sessions_repr.append(session.get_JSON_representation_all())
+            return self.persist({"op": "add_all", "sessions": sessions_repr})
+        finally:
+            self.lock.release()
+
+    # Remove a session with the corresponding parameters, and persist the change
+    def remove_session(self, cyber_range_id, user_id):
+
+        self.lock.acquire()
+        try:
+            if not self.session_info.remove_session(cyber_range_id, user_id):
+                return False
+            return self.persist({"op": "remove", Keys.ID: cyber_range_id, Keys.USER: user_id})
+        finally:
+            self.lock.release()
+
+    # Remove a session with the corresponding parameters, and persist the change
+    def remove_session_variation(self, cyber_range_id, user_id, activity_id):
+
+        self.lock.acquire()
+        try:
+            if not self.session_info.remove_session_variation(cyber_range_id, user_id, activity_id):
+                return False
+            return self.persist({"op": "remove_variation", Keys.ID: cyber_range_id,
+                                 Keys.USER: user_id, Keys.ACTIVITY_ID: activity_id})
+        finally:
+            self.lock.release()
+
+    # Remove the sessions with the corresponding parameters, one for each
+    # of the given activity ids, and persist the change via a single write;
+    # return False if any of the sessions doesn't exist, or if the change
+    # cannot be persisted
+    def remove_sessions_variation(self, cyber_range_id, user_id, activity_ids):
+
+        self.lock.acquire()
+        try:
+            removed_activity_ids = []
+            for activity_id in activity_ids:
+                if self.session_info.remove_session_variation(cyber_range_id, user_id, activity_id):
+                    removed_activity_ids.append(activity_id)
+            is_persisted = True
+            if removed_activity_ids:
+                is_persisted = self.persist({"op": "remove_variations", Keys.ID: cyber_range_id,
+                                             Keys.USER: user_id, "activity_ids": removed_activity_ids})
+            return is_persisted and len(removed_activity_ids) == len(activity_ids)
+        finally:
+            self.lock.release()
+
+    # Build a list of active session ids
+    def get_id_list_int(self):
+
+        self.lock.acquire()
+        try:
+            return self.session_info.get_id_list_int()
+        finally:
+            self.lock.release()
+
+    # Determine whether a session with the given id exists
+    def is_session_id(self, cyber_range_id):
+
+        self.lock.acquire()
+        try:
+            return self.session_info.is_session_id(cyber_range_id)
+        finally:
+            self.lock.release()
+
+    # Get the activity id for a session with given id and a specified
+    # user, or None if there is no such session
+    def get_activity_id(self, cyber_range_id, user_id):
+
+        self.lock.acquire()
+        try:
+            if self.session_info.is_session_id_user(cyber_range_id, user_id):
+                return self.session_info.get_activity_id(cyber_range_id, user_id)
+            return None
+        finally:
+            self.lock.release()
+
+    # Get the list of activity ids for a session with given id and a
+    # specified user, or None if there is no such session
+    def get_activity_id_list(self, cyber_range_id, user_id):
+
+        self.lock.acquire()
+        try:
+            if self.session_info.is_session_id_user(cyber_range_id, user_id):
+                return self.session_info.get_activity_id_list(cyber_range_id, user_id)
+            return None
+        finally:
+            self.lock.release()
+
+    # Get the shards for a session with given id and a specified user, or
+    # None if there is no such session, or it has no shards
+    def get_shards(self, cyber_range_id, user_id):
+
+        self.lock.acquire()
+        try:
+            return self.session_info.get_shards(cyber_range_id, user_id)
+        finally:
+            self.lock.release()
+
+    # Build a dictionary of the shards of the active ranges, with the
+    # range id as key
+    def get_range_shards(self):
+
+        self.lock.acquire()
+        try:
+            return self.session_info.get_range_shards()
+        finally:
+            self.lock.release()
+
+    # Create an external JSON representation of the sessions of a user
+    def get_JSON_representation(self, user_id):
+
+        self.lock.acquire()
+        try:
+            return self.session_info.get_JSON_representation(user_id)
+        finally:
+            self.lock.release()
+
+
+#############################################################################
+# Allocate cyber range ids between 1 and a maximum value; the next id after
+# the largest one in use is preferred, and when it exceeds the maximum value
+# the lowest free id is used instead
+#
+# Note: The largest id in use is tracked via a max-heap, and the free ids
+# below it via a min-heap; both heaps are cleaned lazily, so that each
+# operation takes amortized logarithmic time regardless of the number of
+# active ranges
+#############################################################################
+class RangeIdAllocator:
+
+    # Initialize object for a given maximum id value
+    def __init__(self, max_id):
+
+        # Lock for synchronizing access to the allocator state
+        self.lock = threading.Lock()
+
+        self.initialize(max_id, [])
+
+    # Set the maximum id value and the list of ids (as integers) that are
+    # already in use, for instance by the active sessions loaded at startup
+    def initialize(self, max_id, used_ids):
+
+        self.lock.acquire()
+        try:
+            self.max_id = max_id
+            self.used_ids = set(used_ids)
+
+            # Heap of negated used ids, and the set of ids in it
+            self.used_heap = [-used_id for used_id in self.used_ids]
+            heapq.heapify(self.used_heap)
+            self.used_heap_ids = set(self.used_ids)
+
+            # Heap of free ids lower than the largest id in use, and the
+            # set of ids in it
+            largest_id = self.get_largest_id()
+            self.free_heap = [free_id for free_id in range(1, min(largest_id, max_id+1))
+                              if free_id not in self.used_ids]
+            self.free_heap_ids = set(self.free_heap)
+        finally:
+            self.lock.release()
+
+    # Get the largest id in use, or 0 if no id is used
+    # Note: Requires synchronization
+    def get_largest_id(self):
+
+        # Drop the ids that were released since they were pushed
+        while self.used_heap and -self.used_heap[0] not in self.used_ids:
+            self.used_heap_ids.remove(-heapq.heappop(self.used_heap))
+
+        if self.used_heap:
+            return -self.used_heap[0]
+
+        return 0
+
+    # Mark an id as used
+    # Note: Requires synchronization
+    def mark_used(self, range_id):
+
+        self.used_ids.add(range_id)
+        if range_id not in self.used_heap_ids:
+            heapq.heappush(self.used_heap, -range_id)
+            self.used_heap_ids.add(range_id)
+
+    # Allocate an id and return it as integer, or None if all ids are used
+    def allocate(self):
+
+        self.lock.acquire()
+        try:
+            range_id = self.get_largest_id() + 1
+            if range_id > self.max_id:
+                range_id = None
+                # Drop the ids that were used again since they were pushed
+                while self.free_heap:
+                    free_id = heapq.heappop(self.free_heap)
+                    self.free_heap_ids.remove(free_id)
+                    if free_id not in self.used_ids:
+                        range_id = free_id
+                        break
+                if range_id == None:
+                    return None
+
+            self.mark_used(range_id)
+            return range_id
+        finally:
+            self.lock.release()
+
+    # Release an id (given as integer or string) so that it can be allocated again
+    def release(self, range_id):
+
+        range_id = int(range_id)
+        self.lock.acquire()
+        try:
+            if range_id not in self.used_ids:
+                print "* WARNING: sessinfo: Range id %d is not allocated => ignore release." % (range_id)
+                return
+            self.used_ids.remove(range_id)
+
+            # Only free ids lower than the largest id in use must be
+            # tracked, the higher ones are implicitly free
+            if range_id < self.get_largest_id() and range_id not in self.free_heap_ids:
+                heapq.heappush(self.free_heap, range_id)
+                self.free_heap_ids.add(range_id)
+        finally:
+            self.lock.release()
+
+    # Reserve an id; return a RangeIdReservation object, or None if all
+    # ids are used
+    def reserve(self):
+
+        range_id = self.allocate()
+        if range_id == None:
+            return None
+
+        return RangeIdReservation(self, range_id)
+
+    # Get the number of ids in use
+    def get_used_count(self):
+
+        self.lock.acquire()
+        try:
+            return len(self.used_ids)
+        finally:
+            self.lock.release()
+
+
+#############################################################################
+# Manage an id reserved via a RangeIdAllocator object; the id is released
+# unless the reservation is committed, which is to be done once the id is
+# used by an active session; it can also be used in a 'with' statement, in
+# which case the id is released when the block is left without committing
+#############################################################################
+class RangeIdReservation:
+
+    # Initialize object for a given allocator and reserved id (integer)
+    def __init__(self, allocator, range_id):
+
+        self.allocator = allocator
+        # Store id as string for internal representation
+        self.range_id = str(range_id)
+        self.committed = False
+        self.released = False
+
+    # Keep the id allocated after the reservation ends; it must be released
+    # via the allocator when the corresponding sessions are removed
+    def commit(self):
+
+        self.committed = True
+
+    # Release the id if the reservation wasn't committed or released already
+    def release(self):
+
+        if not self.committed and not self.released:
+            self.allocator.release(self.range_id)
+            self.released = True
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.release()
+        return False
+
 
 
 #############################################################################
@@ -409,7 +1107,7 @@ class SessionInfo:
 if __name__ == '__main__':
     try:
 
-        enabled = [True, True]
+        enabled = [True, True, True, True, True]
 
         #####################################################################
         # TEST #1
@@ -436,6 +1134,113 @@ if __name__ == '__main__':
             session_info = SessionInfo()
             session_info.parse_JSON_data(TEST_STRING)
             session_info.pretty_print()
+
+        #####################################################################
+        # TEST #3
+        if enabled[2]:
+            RANGE_COUNT = 1000
+            INSTANCE_COUNT = 10
+            print "\n" + SEPARATO2
+            print "TEST #3: Benchmark session operations for %d sessions (%d ranges x %d activities)." % (
+                RANGE_COUNT * INSTANCE_COUNT, RANGE_COUNT, INSTANCE_COUNT)
+            print SEPARATO2
+            session_info = SessionInfo()
+
+            start_time = time.time()
+            for range_id in range(1, RANGE_COUNT+1):
+                for instance in range(1, INSTANCE_COUNT+1):
+                    session_info.add_session("Training Session #%d" % (range_id), str(range_id),
+                                             "user%d" % (range_id % 40), "N/A", "N/A", ["N/A"], ["N/A"],
+                                             "en", str(INSTANCE_COUNT), "%d-%d" % (range_id, instance))
+            print "Add sessions:     %.3f s" % (time.time() - start_time)
+
+            start_time = time.time()
+            for range_id in range(1, RANGE_COUNT+1):
+                user_id = "user%d" % (range_id % 40)
+                assert session_info.is_session_id(str(range_id))
+                assert session_info.is_session_id_user(str(range_id), user_id)
+                assert session_info.get_activity_id(str(range_id), user_id)
+                assert len(session_info.get_activity_id_list(str(range_id), user_id)) == INSTANCE_COUNT
+            print "Look up sessions: %.3f s" % (time.time() - start_time)
+
+            start_time = time.time()
+            for range_id in range(1, RANGE_COUNT+1):
+                user_id = "user%d" % (range_id % 40)
+                for activity_id in session_info.get_activity_id_list(str(range_id), user_id):
+                    assert session_info.remove_session_variation(str(range_id), user_id, activity_id)
+            assert len(session_info.sessions) == 0
+            print "Remove sessions:  %.3f s" % (time.time() - start_time)
+
+        #####################################################################
+        # TEST #4
+        if enabled[3]:
+            MAX_ID = 10000
+            print "\n" + SEPARATO2
+            print "TEST #4: Benchmark range id allocation for %d ids." % (MAX_ID)
+            print SEPARATO2
+            allocator = RangeIdAllocator(MAX_ID)
+            allocator.initialize(MAX_ID, [2, 5])
+            assert allocator.allocate() == 6
+            allocator.release(6)
+            assert allocator.allocate() == 6
+
+            start_time = time.time()
+            for range_id in range(7, MAX_ID+1):
+                assert allocator.allocate() == range_id
+            print "Allocate ids:     %.3f s" % (time.time() - start_time)
+
+            # When the maximum id is reached, the lowest free id is used
+            assert allocator.allocate() == 1
+            allocator.release(MAX_ID)
+            allocator.release(2)
+            assert allocator.allocate() == MAX_ID
+            assert allocator.allocate() == 2
+            assert allocator.allocate() == 3
+            assert allocator.allocate() == 4
+            assert allocator.allocate() == None
+
+            # Uncommitted reservations release their id
+            allocator.release(7)
+            with allocator.reserve() as reservation:
+                assert reservation.range_id == "7"
+            with allocator.reserve() as reservation:
+                reservation.commit()
+            assert allocator.reserve() == None
+
+            start_time = time.time()
+            for range_id in range(1, MAX_ID+1):
+                allocator.release(range_id)
+            print "Release ids:      %.3f s" % (time.time() - start_time)
+            assert allocator.get_used_count() == 0
+            assert allocator.allocate() == 1
+
+        #####################################################################
+        # TEST #5
+        if enabled[4]:
+            import tempfile
+            TEST_FILE = os.path.join(tempfile.mkdtemp(), "active_sessions.yml")
+            print "\n" + SEPARATO2
+            print "TEST #5: Persist changes when the journal file cannot be reopened."
+            print SEPARATO2
+            store = SessionStore(TEST_FILE, use_journal=True)
+            assert store.journal_file == None
+            assert store.add_session("Training Session #1", "1", "john_doe", "N/A", "N/A", ["N/A"], ["N/A"],
+                                     "en", "1", "N/A")
+            assert store.compact() and store.journal_file
+            assert store.add_session("Training Session #2", "2", "john_doe", "N/A", "N/A", ["N/A"], ["N/A"],
+                                     "en", "1", "N/A")
+            session_info = SessionInfo()
+            sequence = store.replay_journal(session_info, store.read_snapshot(session_info))
+            print "Saved sessions: %d (sequence: %d)" % (len(session_info.sessions), sequence)
+            assert session_info.is_session_id("1") and session_info.is_session_id("2") and sequence == 2
+
+            # Removals report the changes that cannot be persisted
+            store.journal_file.close()
+            store.journal_file = None
+            store.yaml_file_name = os.path.join(TEST_FILE + ".missing", "active_sessions.yml")
+            assert not store.remove_session("1", "john_doe") and not store.session_info.is_session_id("1")
+            assert not store.remove_sessions_variation("2", "john_doe", ["N/A"])
+
     
     except IOError as error:
         print "* ERROR: sessinfo: %s." % (error)
@@ -0,0 +1,329 @@
+
+#############################################################################
+# Classes for distributing cyber ranges over several instantiation servers
+# (shards), each of which manages its own KVM hosts via CyRIS
+#############################################################################
+
+# External imports
+import threading
+import yaml
+
+#############################################################################
+# Constants
+#############################################################################
+
+# Keys used in the shards file
+SHARDS_KEY = "shards"
+URL_KEY = "url"
+WEIGHT_KEY = "weight"
+HOSTS_KEY = "hosts"
+
+# Placement policies: the shard with the fewest active ranges, the shard
+# that manages the host of the user (falling back to the fewest active
+# ranges), or weighted round-robin
+LEAST_ACTIVE_POLICY = "least-active"
+HOST_AFFINITY_POLICY = "host-affinity"
+WEIGHTED_ROUND_ROBIN_POLICY = "weighted-round-robin"
+PLACEMENT_POLICIES = [LEAST_ACTIVE_POLICY, HOST_AFFINITY_POLICY, WEIGHTED_ROUND_ROBIN_POLICY]
+
+# Debugging constants
+DO_DEBUG = False
+
+
+#############################################################################
+# Manage the information about an instantiation server
+#############################################################################
+class Shard:
+
+    # Initialize object with the server URL, its weight for round-robin
+    # placement, and the management addresses of the hosts it manages
+    def __init__(self, url, weight=1, hosts=[]):
+
+        self.url = url
+        self.weight = weight
+        self.hosts = list(hosts)
+
+        # Number of active ranges, including those being instantiated
+        self.active_count = 0
+
+        # Current weight for smooth weighted round-robin placement
+        self.current_weight = 0
+
+    # Determine whether the shard manages the host with a given management
+    # address; a shard without listed hosts manages all hosts
+    def manages_host(self, host_address):
+
+        return not self.hosts or host_address in self.hosts
+
+    # Get the management address of the host on which a range of a user
+    # whose host has a given address is created: the address of the user
+    # host if the shard manages it, otherwise the address of the first host
+    # of the shard, for the parts of ranges split over several shards
+    def get_host_address(self, host_address):
+
+        if self.manages_host(host_address):
+            return host_address
+        return self.hosts[0]
+
+    # Create a string representation of the shard
+    def __str__(self):
+
+        return "%s (weight: %d, active ranges: %d)" % (self.url, self.weight, self.active_count)
+
+
+# Load the shards from a YAML file
+# Return a list of Shard objects, or None in case of error
+def load_shards(yaml_file_name):
+
+    try:
+        with open(yaml_file_name, "r") as yaml_file:
+            info = yaml.load(yaml_file)
+    except (IOError, yaml.YAMLError) as error:
+        print "* ERROR: shardpool: Cannot load shards file '%s': %s." % (yaml_file_name, error)
+        return None
+
+    shards = []
+    try:
+        for data in info:
+            for shard_info in data.get(SHARDS_KEY, []):
+                weight = int(shard_info.get(WEIGHT_KEY, 1))
+                if weight < 1:
+                    raise ValueError("invalid weight: %d" % (weight))
+                hosts = [str(host) for host in shard_info.get(HOSTS_KEY, [])]
+                shards.append(Shard(shard_info[URL_KEY], weight, hosts))
+    except (AttributeError, KeyError, TypeError, ValueError) as error:
+        print "* ERROR: shardpool: Invalid shards file '%s': %s." % (yaml_file_name, error)
+        return None
+
+    if not shards:
+        print "* ERROR: shardpool: No shards defined in file '%s'." % (yaml_file_name)
+        return None
+
+    return shards
+
+# Split a number of instances into parts of at most a given size, but into
+# no more than a given number of parts; the parts have sizes that differ by
+# at most one
+# Return a list of tuples (first instance number, instance count)
+def split_instances(instance_count, max_part_size, max_part_count):
+
+    part_count = max(1, min(max_part_count, -(-instance_count // max_part_size)))
+    (part_size, remainder) = divmod(instance_count, part_count)
+
+    parts = []
+    first_instance = 1
+    for index in range(part_count):
+        count = part_size + (1 if index < remainder else 0)
+        parts.append((first_instance, count))
+        first_instance += count
+    return parts
+
+
+#############################################################################
+# Place cyber ranges on a pool of instantiation servers according to a
+# placement policy; only servers that are available are considered, and
+# the number of active ranges of each server is tracked
+#############################################################################
+class ShardPool:
+
+    # Initialize object with a list of Shard objects and a placement policy
+    def __init__(self, shards, policy=LEAST_ACTIVE_POLICY):
+
+        self.shards = shards
+        self.policy = policy
+
+        # Lock for synchronizing access to the shard counters
+        self.lock = threading.Lock()
+
+    # Get the shard with a given URL, or None if there is no such shard
+    def get_shard(self, url):
+
+        for shard in self.shards:
+            if shard.url == url:
+                return shard
+        return None
+
+    # Get the URL of the default shard, which is used for sessions created
+    # before sharding was configured
+    def get_default_url(self):
+
+        return self.shards[0].url
+
+    # Determine whether some shard manages the host with a given management
+    # address
+    def manages_host(self, host_address):
+
+        return any([shard.manages_host(host_address) for shard in self.shards])
+
+    # Choose a shard among candidate shards for a range of a user whose host
+    # has the given management address, and count the range as active; the
+    # lock must be held by the caller
+    def choose(self, candidates, host_address):
+
+        if self.policy == WEIGHTED_ROUND_ROBIN_POLICY:
+            # Smooth weighted round-robin: each shard gains its weight,
+            # and the chosen shard loses the total weight
+            total_weight = sum([shard.weight for shard in candidates])
+            for shard in candidates:
+                shard.current_weight += shard.weight
+            chosen_shard = max(candidates, key=lambda shard: shard.current_weight)
+            chosen_shard.current_weight -= total_weight
+        else:
+            if self.policy == HOST_AFFINITY_POLICY:
+                affine_candidates = [shard for shard in candidates if shard.manages_host(host_address)]
+                if affine_candidates:
+                    candidates = affine_candidates
+            # Note: The first shard is chosen in case of ties
+            chosen_shard = min(candidates, key=lambda shard: shard.active_count)
+
+        chosen_shard.active_count += 1
+        if DO_DEBUG:
+            print "* DEBUG: shardpool: Placed range on shard %s." % (chosen_shard)
+        return chosen_shard
+
+    # Choose a shard for a new range of a user whose host has the given
+    # management address, among the shards for which the function
+    # is_available (if provided) returns true, and count the range as active
+    # Return the chosen Shard object, or None if no shard is available
+    def acquire(self, host_address=None, is_available=None):
+
+        shards = self.acquire_many(1, host_address, is_available)
+        if not shards:
+            return None
+        return shards[0]
+
+    # Choose up to a given number of distinct shards for the parts of a new
+    # range, in the same way as acquire(), and count a range as active on
+    # each of them
+    # Return a list of Shard objects, which is empty if no shard is available
+    def acquire_many(self, shard_count, host_address=None, is_available=None):
+
+        self.lock.acquire()
+        try:
+            candidates = [shard for shard in self.shards if not is_available or is_available(shard.url)]
+            chosen_shards = []
+            while candidates and len(chosen_shards) < shard_count:
+                chosen_shard = self.choose(candidates, host_address)
+                candidates.remove(chosen_shard)
+                chosen_shards.append(chosen_shard)
+            return chosen_shards
+        finally:
+            self.lock.release()
+
+    # Count a range on the shard with a given URL as active, for instance
+    # for the ranges of sessions loaded at startup
+    def add_range(self, url):
+
+        self.lock.acquire()
+        try:
+            shard = self.get_shard(url)
+            if shard:
+                shard.active_count += 1
+        finally:
+            self.lock.release()
+
+    # Stop counting a range on the shard with a given URL as active
+    def release(self, url):
+
+        self.lock.acquire()
+        try:
+            shard = self.get_shard(url)
+            if shard and shard.active_count > 0:
+                shard.active_count -= 1
+        finally:
+            self.lock.release()
+
+    # Get the shard states as a list of dictionaries, for status output
+    def get_representation(self):
+
+        self.lock.acquire()
+        try:
+            return [{"url": shard.url, "weight": shard.weight, "hosts": shard.hosts,
+                     "active_ranges": shard.active_count} for shard in self.shards]
+        finally:
+            self.lock.release()
+
+    # Create a string representation of the pool
+    def __str__(self):
+
+        self.lock.acquire()
+        try:
+            return "%s placement on %s" % (self.policy, ", ".join([str(shard) for shard in self.shards]))
+        finally:
+            self.lock.release()
+
+
+#############################################################################
+# Testing code for the classes in this file
+#
+# This code will be executed _only_ when this module is called as the
+# main program
+#############################################################################
+if __name__ == '__main__':
+
+    enabled = [True, True, True, True, True]
+
+    def create_shards():
+        return [Shard("http://shard1", 1, ["172.16.1.7"]), Shard("http://shard2", 3, ["172.16.1.3"])]
+
+    #########################################################################
+    # TEST #1
+    if enabled[0]:
+        print "TEST #1: Place ranges on the shard with the fewest active ranges."
+        pool = ShardPool(create_shards(), LEAST_ACTIVE_POLICY)
+        urls = [pool.acquire().url for index in range(4)]
+        pool.release("http://shard1")
+        urls.append(pool.acquire(is_available=lambda url: url != "http://shard2").url)
+        print "Placement: %s => %s" % (urls, pool)
+        assert urls == ["http://shard1", "http://shard2", "http://shard1", "http://shard2", "http://shard1"]
+        assert pool.acquire(is_available=lambda url: False) == None
+
+    #########################################################################
+    # TEST #2
+    if enabled[1]:
+        print "TEST #2: Place ranges on the shard that manages the host of the user."
+        pool = ShardPool(create_shards(), HOST_AFFINITY_POLICY)
+        urls = [pool.acquire("172.16.1.3").url for index in range(3)]
+        urls.append(pool.acquire("10.0.0.1").url)
+        print "Placement: %s => %s" % (urls, pool)
+        assert urls == ["http://shard2"] * 3 + ["http://shard1"]
+        assert pool.manages_host("172.16.1.3") and not pool.manages_host("10.0.0.1")
+        assert ShardPool([Shard("http://shard1")]).manages_host("10.0.0.1")
+
+    #########################################################################
+    # TEST #3
+    if enabled[2]:
+        print "TEST #3: Place ranges via weighted round-robin."
+        pool = ShardPool(create_shards(), WEIGHTED_ROUND_ROBIN_POLICY)
+        urls = [pool.acquire().url for index in range(8)]
+        print "Placement: %s => %s" % (urls, pool)
+        assert urls.count("http://shard2") == 6 and urls[:4].count("http://shard1") == 1
+
+    #########################################################################
+    # TEST #4
+    if enabled[3]:
+        print "TEST #4: Split instances into parts placed on distinct shards."
+        pool = ShardPool(create_shards(), HOST_AFFINITY_POLICY)
+        shards = pool.acquire_many(3, "172.16.1.7")
+        parts = split_instances(41, 10, len(shards))
+        print "Parts: %s on %s" % (parts, [shard.url for shard in shards])
+        assert [shard.url for shard in shards] == ["http://shard1", "http://shard2"]
+        assert parts == [(1, 21), (22, 20)]
+        assert [shard.get_host_address("172.16.1.7") for shard in shards] == ["172.16.1.7", "172.16.1.3"]
+        assert split_instances(5, 10, 2) == [(1, 5)]
+
+    #########################################################################
+    # TEST #5
+    if enabled[4]:
+        print "TEST #5: Spread the instances of a range over the shards of the example shards file."
+        pool = ShardPool(load_shards("../database/shards-example.yml"), LEAST_ACTIVE_POLICY)
+        instance_count = 25
+        shards = pool.acquire_many(-(-instance_count // 10), "172.16.1.7")
+        parts = split_instances(instance_count, 10, len(shards))
+        placement = [(shard.url, shard.get_host_address("172.16.1.7"), first_instance, count)
+                     for (shard, (first_instance, count)) in zip(shards, parts)]
+        print "Placement: %s => %s" % (placement, pool)
+        assert len(set([url for (url, host_address, first_instance, count) in placement])) == 2
+        assert sum([count for (url, host_address, first_instance, count) in placement]) == instance_count
+        assert [host_address for (url, host_address, first_instance, count) in placement] == ["172.16.1.7",
+                                                                                             "172.16.1.3"]
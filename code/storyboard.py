@@ -23,6 +23,9 @@ class Storyboard:
     SERVER_STATUS_ERROR = "ERROR"
     SERVER_ACTIVITY_ID_KEY = "activity_id"
     SERVER_MESSAGE_KEY = "message"
+    SERVER_TOKEN_KEY = "token"
+    SERVER_JOB_ID_KEY = "job_id"
+    SERVER_RANGE_ID_KEY = "range_id"
 
     # Server status messages
     USER_SETTINGS_LOADING_ERROR = "Server could not load the user information database"
@@ -31,6 +34,7 @@ class Storyboard:
     USER_PASSWORD_MISSING_ERROR = "User password is missing"
     USER_PASSWORD_NOT_IN_DATABASE_ERROR = "User password not in database"
     USER_ID_PASSWORD_INVALID_ERROR = "User id and/or password are invalid"
+    USER_TOKEN_INVALID_ERROR = "User token is invalid or expired"
 
     ACTION_MISSING_ERROR = "Action is missing"
     ACTION_INVALID_ERROR = "Action is invalid"
@@ -38,6 +42,8 @@ class Storyboard:
     LANGUAGE_MISSING_ERROR = "Language is missing"
     LANGUAGE_INVALID_ERROR = "Language is invalid"
 
+    PRIORITY_INVALID_ERROR = "Priority is invalid"
+
     TRAINING_SETTINGS_LOADING_ERROR = "Server could not load the training settings database"
 
     INSTANCE_COUNT_MISSING_ERROR = "Instance count is missing"
@@ -65,6 +71,7 @@ class Storyboard:
     INSTANTIATION_STATUS_FILE_NOT_FOUND = "Instantiation status file could not be found"
     INSTANTIATION_CYRIS_IO_ERROR = "CyRIS execution I/O error"
     INSTANTIATION_SIMULATED_ERROR = "Simulated range instantiation error"
+    INSTANTIATION_QUEUED_STATUS = "Cyber range instantiation is waiting in the queue"
 
     DESTRUCTION_ERROR = "Cyber range manager could not destroy the cyber range"
     DESTRUCTION_SIMULATED_ERROR = "Simulated range destruction error"
@@ -73,3 +80,13 @@ class Storyboard:
     SESSION_ID_MISSING_ERROR = "Session id is missing"
     SESSION_ID_INVALID_ERROR = "Session id is invalid"
     SESSION_INFO_CONSISTENCY_ERROR = "Server encountered a session information consistency issue"
+
+    JOB_ID_MISSING_ERROR = "Job id is missing"
+    JOB_ID_INVALID_ERROR = "Job id is invalid"
+    JOB_EXECUTION_ERROR = "Server encountered an error while executing the job"
+    PIPELINE_STEP_ERROR = "Server encountered an error while executing the action"
+    SERVER_OVERLOAD_ERROR = "Server is overloaded, retry later"
+    DEADLINE_EXPIRED_ERROR = "Server could not complete the action before its deadline"
+    CONTENT_SERVER_UNAVAILABLE_ERROR = "LMS content manager is unavailable, retry later"
+    INSTANTIATION_SERVER_UNAVAILABLE_ERROR = "Cyber range manager is unavailable, retry later"
+    USER_HOST_UNMANAGED_ERROR = "No cyber range manager manages the host of the user"
@@ -108,7 +108,17 @@ try:
 
     # Display detailed response data differently for each action
     # Handle training server actions
-    if action == query.Parameters.FETCH_CONTENT:
+    if action == query.Parameters.LOGIN:
+        logging.info("Training server action '{0}' done => {1}.".format(action, status))
+
+        # Display token or error message
+        if message:
+            logging.info("Showing login information (use the token instead of the password)... ")
+            print SEPARATOR
+            print message
+            print SEPARATOR
+
+    elif action == query.Parameters.FETCH_CONTENT:
         logging.info("Training server action '{0}' done => {1}.".format(action, status))
 
         if status == Storyboard.SERVER_STATUS_SUCCESS:
@@ -194,6 +204,18 @@ try:
             print message
             print SEPARATOR
 
+    elif action == query.Parameters.GET_JOB_STATUS:
+        logging.info("Training server action '{0}' done => {1}.".format(action, status))
+
+        # Display job status, or error message
+        logging.info("Showing job status information... ")
+        print SEPARATOR
+        if status == Storyboard.SERVER_STATUS_SUCCESS:
+            print data
+        else:
+            print message
+        print SEPARATOR
+
     elif action == query.Parameters.GET_CR_NOTIFICATION:
         logging.info("Instantiation server action '{0}' done => {1}.".format(action, status))
 
@@ -6,7 +6,9 @@
 # External imports
 import yaml
 import json
-import types
+
+# Internal imports
+import filecache
 
 # Various constants
 SEPARATOR = "-----------------------------------------------------------------"
@@ -143,13 +145,36 @@ class Level:
         return level_repr
 
     
+#############################################################################
+# Normalize a scenario or level name so that it can be used as index key;
+# names are converted to Unicode, since YAML files may contain both byte
+# strings and Unicode strings
+#############################################################################
+def normalize_name(name):
+
+    if isinstance(name, str):
+        return unicode(name, 'utf-8') # convert to UTF-8
+
+    return name
+
+
 #############################################################################
 # Manage overall information about training
 #############################################################################
 class TrainingInfo:
 
-    # List of scenarios (as Scenario objects)
-    scenarios = []
+    # Initialize object
+    def __init__(self):
+
+        # List of training types (as TrainingType objects)
+        self.types = []
+
+        # List of scenarios (as Scenario objects)
+        self.scenarios = []
+
+        # Index of levels (as Level objects) by normalized
+        # (scenario name, level name) pairs
+        self.level_index = {}
 
     # Parse a YAML information in a file and store values into the
     # object fields
@@ -203,8 +228,9 @@ class TrainingInfo:
         # Initialize the types list
         self.types = []
 
-        # Initialize the scenario list
+        # Initialize the scenario list and level index
         self.scenarios = []
+        self.level_index = {}
         
         # Get data for all training types from info
         for data in info:
@@ -253,6 +279,12 @@ class TrainingInfo:
             scenario = Scenario(scenario_info)
             self.scenarios.append(scenario)
 
+            # Add the scenario levels to the index; if a (scenario, level)
+            # pair is duplicated, the last one is used
+            scenario_name = normalize_name(scenario.name)
+            for level in scenario.levels:
+                self.level_index[(scenario_name, normalize_name(level.name))] = level
+
             if DO_DEBUG:
                 print "SCENARIO:\n%s" % (scenario)
 
@@ -307,103 +339,53 @@ class TrainingInfo:
         return json.dumps(representation)
 
 
+    # Get the training content file name, range file name and progression
+    # scenario name for the scenario and level provided as arguments
+    # Return a tuple with the three values, which are None if no such
+    # scenario and level exist
+    def get_level_files(self, scenario_name, level_name):
+
+        level = self.level_index.get((normalize_name(scenario_name),
+                                      normalize_name(level_name)), None)
+        if level:
+            return (level.content_file, level.range_file, level.progression_scenario)
+
+        return (None, None, None)
+
     # Get the name of the file that contains the training content for the
     # scenario and level provided as arguments
     def get_content_file_name(self, scenario_name, level_name):
 
-        scenario_name_utf = unicode(scenario_name, 'utf-8') # convert to UTF-8
-        level_name_utf = unicode(level_name, 'utf-8') # convert to UTF-8
-        
-        content_file = None
-        #print "DEBUG: Search for scenario=%s level=%s... (type=%s)" % (scenario_name.__str__(), level_name, type(scenario_name))
-
-        for scenario in self.scenarios:
-            
-            if type(scenario.name) == types.UnicodeType:
-                # Printing Unicode doesn't work on development servers,
-                # so I commented out the debug message
-                #print "DEBUG: scenario name=%s (type=%s)" % (scenario.name, type(scenario.name))
-                scenario_name_cmp = scenario_name_utf
-            else:
-                scenario_name_cmp = scenario_name
-            if scenario.name == scenario_name_cmp:
-                for level in scenario.levels:
-                    if type(level.name) == types.UnicodeType:
-                        # Printing Unicode doesn't work on development servers,
-                        # so I commented out the debug message
-                        #print "DEBUG: level name=%s (type=%s)" % (level.name, type(level.name))
-                        level_name_cmp = level_name_utf
-                    else:
-                        level_name_cmp = level_name
-                    if level.name == level_name_cmp:
-                        content_file = level.content_file
-
-        return content_file
+        return self.get_level_files(scenario_name, level_name)[0]
 
     # Get the name of the file that contains the range specification for the
     # scenario and level provided as arguments
     def get_range_file_name(self, scenario_name, level_name):
 
-        scenario_name_utf = unicode(scenario_name, 'utf-8') # convert to UTF-8
-        level_name_utf = unicode(level_name, 'utf-8') # convert to UTF-8
-        
-        range_file = None
-        #print "DEBUG: Search for scenario=%s level=%s... (type=%s)" % (scenario_name.__str__(), level_name, type(scenario_name))
-
-        for scenario in self.scenarios:
-            
-            if type(scenario.name) == types.UnicodeType:
-                # Printing Unicode doesn't work on development servers,
-                # so I commented out the debug message
-                #print "DEBUG: scenario name=%s (type=%s)" % (scenario.name, type(scenario.name))
-                scenario_name_cmp = scenario_name_utf
-            else:
-                scenario_name_cmp = scenario_name
-            if scenario.name == scenario_name_cmp:
-                for level in scenario.levels:
-                    if type(level.name) == types.UnicodeType:
-                        # Printing Unicode doesn't work on development servers,
-                        # so I commented out the debug message
-                        #print "DEBUG: level name=%s (type=%s)" % (level.name, type(level.name))
-                        level_name_cmp = level_name_utf
-                    else:
-                        level_name_cmp = level_name
-                    if level.name == level_name_cmp:
-                        range_file = level.range_file
-
-        return range_file
+        return self.get_level_files(scenario_name, level_name)[1]
 
     # Get the name of the file that contains the progression details
     # for the scenario and level provided as arguments
     def get_progression_scenario_name(self, scenario_name, level_name):
 
-        scenario_name_utf = unicode(scenario_name, 'utf-8') # convert to UTF-8
-        level_name_utf = unicode(level_name, 'utf-8') # convert to UTF-8
+        return self.get_level_files(scenario_name, level_name)[2]
 
-        progression_scenario = None
 
-        for scenario in self.scenarios:
+#############################################################################
+# Load training information from a YAML file
+# Return a TrainingInfo object, or None in case of error
+#############################################################################
+def load_training_info(yaml_file_name):
+
+    training_info = TrainingInfo()
+    try:
+        if training_info.parse_YAML_file(yaml_file_name):
+            return training_info
+    except (AssertionError, AttributeError, TypeError, NameError):
+        print "ERROR: Invalid training information in file %s." % (yaml_file_name)
+
+    return None
 
-            if type(scenario.name) == types.UnicodeType:
-                # Printing Unicode doesn't work on development servers,
-                # so I commented out the debug message
-                #print "DEBUG: scenario name=%s (type=%s)" % (scenario.name, type(scenario.name))
-                scenario_name_cmp = scenario_name_utf
-            else:
-                scenario_name_cmp = scenario_name
-            if scenario.name == scenario_name_cmp:
-                for level in scenario.levels:
-                    if type(level.name) == types.UnicodeType:
-                        # Printing Unicode doesn't work on development servers,
-                        # so I commented out the debug message
-                        #print "DEBUG: level name=%s (type=%s)" % (level.name, type(level.name))
-                        level_name_cmp = level_name_utf
-                    else:
-                        level_name_cmp = level_name
-                    if level.name == level_name_cmp:
-                        progression_scenario = level.progression_scenario
-
-        return progression_scenario
 
 #############################################################################
 # Testing code for the classes in this file
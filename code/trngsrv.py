@@ -12,21 +12,32 @@ import time
 import random
 import sys
 import getopt
-from SocketServer import ThreadingMixIn
 import threading
 from string import Template
 import yaml
 import logging
 import re
 import os
+import json
 
 # Internal imports
+import asyncsrv
+import connpool
+import deadline
+import httpsrv
+import filecache
+import health
+import idempotency
+import jobinfo
+import parallel
+import pipeline
 import userinfo
 import trnginfo
 import sessinfo
 import query
+import shardpool
 from storyboard import Storyboard
-from password import Password
+from password import Password, TokenManager, VerificationCache
 
 #############################################################################
 # Constants
@@ -43,9 +54,36 @@ SERVER_ERROR  = 500
 LOCAL_SERVER  = False
 SERVE_FOREVER = True # Use serve count if not using local server?!
 CONTENT_SERVER_URL = "http://127.0.0.1:8084"
-INSTANTIATION_SERVER_URL = "http://127.0.0.1:8083"
+INSTANTIATION_SERVER_URL = "http://127.0.0.1:8083" # Used if no shards file is given
+PLACEMENT_POLICY = shardpool.LEAST_ACTIVE_POLICY # Policy for choosing the instantiation server of a range
+MAX_PART_INSTANCES = 10 # Ranges with more instances are split over several instantiation servers
 MAX_SESSIONS = 100
+CONTENT_PARALLELISM = 8 # Maximum number of concurrent content server requests
+JOB_WORKERS = 16 # Maximum number of background jobs executed at the same time
+DOWNSTREAM_CONNECTIONS = 32 # Maximum number of connections to the content or instantiation server
+DOWNSTREAM_CONNECT_TIMEOUT = 10 # Timeout for connecting to the content or instantiation server (seconds)
+DOWNSTREAM_READ_TIMEOUT = 3600 # Timeout for their responses, which includes range instantiation (seconds)
+REQUEST_TIMEOUT = 3600 # Time available for handling a request or background job (seconds)
+HEALTH_PROBE_INTERVAL = 5 # Interval between health probes of the content and instantiation servers (seconds)
+HEALTH_PROBE_TIMEOUT = 2 # Time within which a health probe must be answered (seconds)
+BREAKER_FAILURE_THRESHOLD = 3 # Consecutive failures after which requests to a server fail fast
+BREAKER_RESET_TIMEOUT = 30 # Time after which a trial request is sent to a failing server (seconds)
+DOWNSTREAM_RETRIES = 3 # Number of times a request that failed because of a transient error is retried
+RETRY_BASE_DELAY = 0.5 # Upper limit of the delay before the first retry; doubled for each retry (seconds)
+RETRY_MAX_DELAY = 8 # Maximum upper limit of the delay before a retry (seconds)
 ENABLE_THREADS = True
+WORKER_POOL_SIZE = 32 # Number of worker threads in multi-threading mode
+ACCEPT_QUEUE_SIZE = 64 # Number of connections that can wait for a worker
+KEEP_ALIVE_TIMEOUT = 2 # Time after which persistent connections that wait for a request are closed (seconds)
+CONNECTION_TIMEOUT = 15 # Time after which connections that stop sending or receiving data are closed (seconds)
+
+# Serving engines: "threads" uses a worker pool that also handles the
+# connection I/O, "async" uses an event loop for all connections, and
+# the worker pool only for executing actions
+THREADS_ENGINE = "threads"
+ASYNC_ENGINE = "async"
+SERVER_ENGINES = [THREADS_ENGINE, ASYNC_ENGINE]
+SERVER_ENGINE = THREADS_ENGINE
 
 # Names of files containing training-related information
 USERS_FILE  = "users.yml"
@@ -53,40 +91,982 @@ SCENARIOS_FILE_EN = "training-en.yml"
 SCENARIOS_FILE_JA = "training-ja.yml"
 DATABASE_DIR = "../database/"
 
+# Name of file containing the instantiation servers (shards), if any
+# (see database/shards-example.yml)
+SHARDS_FILE = None
+
 # Name of file containing saved training configurations
 SAVED_CONFIGURATIONS_FILE = "saved_configurations.yml"
 
 # Name of file containing active training sessions info
 ACTIVE_SESSIONS_FILE = "active_sessions.yml"
 
+# Use a journal for persisting changes to active training sessions
+USE_SESSION_JOURNAL = False
+
 # Debugging constants
 DEBUG = False
 EMULATE_DELAY = False
 
+#############################################################################
+# Build the body of a successful response given the response data
+#############################################################################
+def build_success_response(response_data):
+
+    # Prepare success status
+    response_status = '"{0}": "{1}"'.format(Storyboard.SERVER_STATUS_KEY, Storyboard.SERVER_STATUS_SUCCESS)
+
+    # If response data exists, we prepend the success status to dictionary,
+    # otherwise we make a dictionary containing only the status
+    if response_data:
+        # NOTE: We assume the response data is an array containing
+        # a dictionary, hence of the form '[{"key": "value"...}]';
+        # in order to merge it with the response status, we must
+        # skip the first 2 characters
+        response_body = '[{' + response_status + ", " + response_data[2:]
+    else:
+        response_body = '[{' + response_status + '}]'
+
+    return response_body
+
+#############################################################################
+# Manage the training information for one language, together with the
+# response to the fetch content action, which is prepared only once
+#############################################################################
+class TrainingCatalogue:
+
+    # Initialize object based on the training information
+    def __init__(self, training_info):
+
+        self.training_info = training_info
+        self.fetch_content_response = build_success_response(training_info.get_JSON_representation())
+
+# Load the training catalogue from a YAML file
+# Return a TrainingCatalogue object, or None in case of error
+def load_training_catalogue(yaml_file_name):
+
+    training_info = trnginfo.load_training_info(yaml_file_name)
+    if training_info:
+        return TrainingCatalogue(training_info)
+
+    return None
+
+#############################################################################
+# Send a POST request with given parameters to another server (the content
+# or instantiation server), and return the response body; if a deadline is
+# provided, the time remaining is passed to the server, which enforces it
+# Requests that fail because of transient errors (communication errors and
+# server overload) are retried up to DOWNSTREAM_RETRIES times, with jittered
+# exponential backoff; this is safe since requests either only read data,
+# or modify it with an idempotency key, so that the server executes the
+# action only once
+# Note: IOError is raised in case of communication errors, if the
+# deadline expired, and right away if the circuit breaker of the server
+# is open
+#############################################################################
+def post_request(server_url, query_tuples, request_deadline=None):
+
+    return health.send_with_retries(server_url,
+                                    lambda: send_request(server_url, query_tuples, request_deadline),
+                                    downstream_breakers.get(server_url), request_deadline,
+                                    DOWNSTREAM_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY)
+
+# Send a POST request to a server, via the pool of downstream connections
+def send_request(server_url, query_tuples, request_deadline=None):
+
+    # Note: Creating a dictionary for the parameters does not preserve
+    # their order, but this has no negative influence in our implementation
+    query_params = urllib.urlencode(query_tuples)
+    if DEBUG:
+        print "* DEBUG: trngsrv: POST parameters: %s" % (query_params)
+    if request_deadline:
+        if request_deadline.is_expired():
+            raise IOError("Deadline expired before sending request to %s" % (server_url))
+        data = downstream_pool.post(server_url, query_params,
+                                    headers={deadline.DEADLINE_HEADER: request_deadline.get_header_value()},
+                                    timeout=request_deadline.get_remaining())
+    else:
+        data = downstream_pool.post(server_url, query_params)
+
+    # Servers that are overloaded reject requests without handling them
+    if Storyboard.SERVER_OVERLOAD_ERROR in data:
+        raise health.ServerOverloadError("Server %s is overloaded" % (server_url))
+    if DEBUG:
+        print "* DEBUG: trngsrv: Server %s response body: %s" % (server_url, data)
+        print "* DEBUG: trngsrv: Downstream connections: %s" % (downstream_pool)
+
+    return data
+
+# Upload training content for a given range to the content server
+# Return a tuple (error message, activity id); the error message is None on success
+def upload_content(user_id, cyber_range_id, content_description, request_deadline=None):
+
+    query_tuples = {
+        query.Parameters.USER: user_id,
+        query.Parameters.ACTION: query.Parameters.UPLOAD_CONTENT,
+        query.Parameters.DESCRIPTION_FILE: content_description,
+        query.Parameters.RANGE_ID: cyber_range_id,
+        query.Parameters.IDEMPOTENCY_KEY: idempotency.generate_key()
+    }
+
+    print "* INFO: trngsrv: Send upload request to content server %s." % (CONTENT_SERVER_URL)
+    try:
+        data = post_request(CONTENT_SERVER_URL, query_tuples, request_deadline)
+    except IOError as error:
+        print "* ERROR: trngsrv: URL error: %s." % (error)
+        return (Storyboard.CONTENT_SERVER_ERROR, None)
+
+    (status, activity_id) = query.Response.parse_server_response(data)
+    if status != Storyboard.SERVER_STATUS_SUCCESS:
+        print "* ERROR: trngsrv: Content upload error."
+        return (Storyboard.CONTENT_UPLOAD_ERROR, None)
+
+    return (None, activity_id)
+
+# Instantiate a range with a given description via an instantiation server
+# Return a tuple (error message, notification message); the error message
+# is None on success
+def instantiate_range(server_url, user_id, cyber_range_id, range_description, progression_scenario_name=None,
+                      request_deadline=None, priority=query.Parameters.NORMAL):
+
+    query_tuples = {
+        query.Parameters.USER: user_id,
+        query.Parameters.ACTION: query.Parameters.INSTANTIATE_RANGE,
+        query.Parameters.DESCRIPTION_FILE: range_description,
+        query.Parameters.RANGE_ID: cyber_range_id,
+        query.Parameters.PRIORITY: priority,
+        query.Parameters.IDEMPOTENCY_KEY: idempotency.generate_key()
+    }
+
+    # If we have a progression scenario defined, we add its name to the query
+    if progression_scenario_name:
+        query_tuples[query.Parameters.PROGRESSION_SCENARIO] = progression_scenario_name
+
+    print "* INFO: trngsrv: Send instantiate request to instantiation server %s." % (server_url)
+    try:
+        data = post_request(server_url, query_tuples, request_deadline)
+    except IOError as error:
+        print "* ERROR: trngsrv: URL error: %s." % (error)
+        return (Storyboard.INSTANTIATION_SERVER_ERROR, None)
+
+    (status, message) = query.Response.parse_server_response(data)
+    if status != Storyboard.SERVER_STATUS_SUCCESS:
+        print "* ERROR: trngsrv: Range instantiation error."
+        return (Storyboard.INSTANTIATION_ERROR, None)
+
+    return (None, message)
+
+# Remove the training content with a given activity id via the content server
+# Return an error message, or None on success
+def remove_content(user_id, cyber_range_id, activity_id, request_deadline=None):
+
+    query_tuples = {
+        query.Parameters.USER: user_id,
+        query.Parameters.ACTION: query.Parameters.REMOVE_CONTENT,
+        query.Parameters.RANGE_ID: cyber_range_id,
+        query.Parameters.ACTIVITY_ID: activity_id,
+        query.Parameters.IDEMPOTENCY_KEY: idempotency.generate_key()
+    }
+
+    print "* INFO: trngsrv: Send removal request to content server %s." % (CONTENT_SERVER_URL)
+    try:
+        data = post_request(CONTENT_SERVER_URL, query_tuples, request_deadline)
+    except IOError as error:
+        print "* ERROR: trngsrv: URL error: %s." % (error)
+        return Storyboard.CONTENT_SERVER_ERROR
+
+    # We don't parse the response since the content server does not provide
+    # a uniformly formatted one; instead we only check for SUCCESS key
+    if Storyboard.SERVER_STATUS_SUCCESS not in data:
+        print "* ERROR: trngsrv: Content removal error."
+        return Storyboard.CONTENT_REMOVAL_ERROR
+
+    return None
+
+# Destroy a range via the instantiation server that manages it
+# Return an error message, or None on success
+def destroy_range(server_url, user_id, cyber_range_id, request_deadline=None):
+
+    query_tuples = {
+        query.Parameters.USER: user_id,
+        query.Parameters.ACTION: query.Parameters.DESTROY_RANGE,
+        query.Parameters.RANGE_ID: cyber_range_id,
+        query.Parameters.IDEMPOTENCY_KEY: idempotency.generate_key()
+    }
+
+    print "* INFO: trngsrv: Send destroy request to instantiation server %s." % (server_url)
+    try:
+        data = post_request(server_url, query_tuples, request_deadline)
+    except IOError as error:
+        print "* ERROR: trngsrv: URL error: %s." % (error)
+        return Storyboard.INSTANTIATION_SERVER_ERROR
+
+    (status, message) = query.Response.parse_server_response(data)
+    if status != Storyboard.SERVER_STATUS_SUCCESS:
+        print "* ERROR: trngsrv: Range destruction error: %s." % (message)
+        return Storyboard.DESTRUCTION_ERROR
+
+    return None
+
+# Destroy the parts of a range concurrently, each via the instantiation
+# server that manages it
+# Return an error message, or None on success
+def destroy_range_parts(server_urls, user_id, cyber_range_id, request_deadline=None):
+
+    destruction_futures = [parallel.submit(destroy_range, server_url, user_id, cyber_range_id, request_deadline)
+                           for server_url in server_urls]
+    destruction_errors = [destruction_future.result() for destruction_future in destruction_futures]
+    for destruction_error in destruction_errors:
+        if destruction_error:
+            return destruction_error
+
+    return None
+
+# Merge the notification messages of the parts of a range into a single
+# message; since each part numbers its instances from #1, the notification
+# of each part is preceded by the instance numbers it corresponds to
+def merge_notifications(parts, messages):
+
+    if len(parts) == 1:
+        return messages[0]
+
+    notifications = []
+    for (part, message) in zip(parts, messages):
+        last_instance = part["first_instance"] + part["count"] - 1
+        notifications.append("===== Cyber range instances #%d to #%d (host %s, numbered from #1 below) =====\n\n%s"
+                             % (part["first_instance"], last_instance, part["host_mgmt_addr"],
+                                urllib.unquote(message or "")))
+    return urllib.quote("\n\n".join(notifications))
+
+# Get the state of each instantiation server, such as that of its
+# instantiation queue and warm pool, with the server URL as key; the state
+# of servers that cannot be reached is replaced by an error description
+def get_instantiation_server_states(user_id, request_deadline=None):
+
+    query_tuples = {
+        query.Parameters.USER: user_id,
+        query.Parameters.ACTION: query.Parameters.GET_SERVER_STATUS
+    }
+
+    server_states = {}
+    for shard in shard_pool.shards:
+        try:
+            data = post_request(shard.url, query_tuples, request_deadline)
+            server_state = json.loads(data)[0]
+            del server_state[Storyboard.SERVER_STATUS_KEY]
+            server_states[shard.url] = server_state
+        except (IOError, ValueError, KeyError, IndexError, TypeError) as error:
+            server_states[shard.url] = {"error": str(error)}
+
+    return server_states
+
+# Determine whether a downstream server is available, according to its
+# circuit breaker (if any)
+def is_server_available(server_url):
+
+    breaker = downstream_breakers.get(server_url)
+    return not breaker or breaker.is_available()
+
+# Check whether the given downstream servers are available, according to
+# their circuit breakers
+# Return an error message for the first unavailable server, or None
+def check_downstream_servers(server_urls):
+
+    for server_url in server_urls:
+        if not is_server_available(server_url):
+            print "* WARNING: trngsrv: Circuit breaker is open: %s." % (downstream_breakers[server_url])
+            return downstream_unavailable_errors.get(server_url, Storyboard.INSTANTIATION_SERVER_UNAVAILABLE_ERROR)
+    return None
+
+# Check whether the servers needed for creating a training session are
+# available: the content server, and at least one instantiation server
+# Return an error message, or None
+def check_creation_servers():
+
+    error_message = check_downstream_servers([CONTENT_SERVER_URL])
+    if not error_message and not filter(is_server_available, [shard.url for shard in shard_pool.shards]):
+        print "* WARNING: trngsrv: All instantiation servers are unavailable."
+        error_message = Storyboard.INSTANTIATION_SERVER_UNAVAILABLE_ERROR
+    return error_message
+
+#############################################################################
+# Steps of the training lifecycle actions, which are executed as pipelines;
+# each step receives the action context (a dictionary), and returns an
+# error message, or None on success
+#############################################################################
+
+# Read a file from the database directory
+# Return the file content, or None in case of error
+def read_database_file(file_name):
+
+    try:
+        database_file = open(DATABASE_DIR + file_name, "r")
+        try:
+            return database_file.read()
+        finally:
+            database_file.close()
+    except IOError as error:
+        print "* ERROR: trngsrv: File error: %s." % (error)
+        return None
+
+# Report the phase of the action to the corresponding job, if any
+def report_phase(context, phase):
+
+    job = context.get("job", None)
+    if job:
+        job_table.set_phase(job, phase)
+
+# Build the context for creating a training session for a range id
+# reserved for a given user
+def build_creation_context(reservation, user_obj, training_info, ttype, scenario, level,
+                           language, instance_count, job=None, request_deadline=None,
+                           priority=query.Parameters.NORMAL):
+
+    # Get the content file, range file and progression scenario
+    # for the requested scenario and level
+    (content_file_name, range_file_name,
+     progression_scenario_name) = training_info.get_level_files(scenario, level)
+
+    return {"reservation": reservation, "user_obj": user_obj, "user_id": user_obj.id,
+            "range_id": reservation.range_id, "type": ttype, "scenario": scenario,
+            "level": level, "language": language, "count": instance_count,
+            "content_file_name": content_file_name, "range_file_name": range_file_name,
+            "progression_scenario": progression_scenario_name, "job": job,
+            "deadline": request_deadline, "priority": priority}
+
+# Read the training content file
+def step_read_content(context):
+
+    if context["content_file_name"] == None:
+        return Storyboard.CONTENT_IDENTIFICATION_ERROR
+
+    if DEBUG:
+        print "* DEBUG: trngsrv: Training content file: %s" % (context["content_file_name"])
+
+    context["content_description"] = read_database_file(context["content_file_name"])
+    if context["content_description"] == None:
+        return Storyboard.CONTENT_LOADING_ERROR
+
+    return None
+
+# Read the cyber range file (template), and replace the variables in it
+def step_read_range(context):
+
+    if context["range_file_name"] == None:
+        return Storyboard.TEMPLATE_IDENTIFICATION_ERROR
+
+    if DEBUG:
+        print "* DEBUG: trngsrv: Cyber range file: %s" % (context["range_file_name"])
+        print "* DEBUG: trngsrv: Progression scenario: %s" % (context["progression_scenario"])
+
+    range_file_content = read_database_file(context["range_file_name"])
+    if range_file_content == None:
+        return Storyboard.TEMPLATE_LOADING_ERROR
+
+    # Each part of the range has its own instances and host settings
+    for part in context["parts"]:
+        part["range_description"] = context["user_obj"].replace_variables(
+            range_file_content, context["range_id"], part["count"],
+            {userinfo.Keys.HOST_MGMT_ADDR: part["host_mgmt_addr"]})
+
+    return None
+
+# Upload the training content
+def step_upload_content(context):
+
+    (error_message, context["activity_id"]) = upload_content(context["user_id"], context["range_id"],
+                                                             context["content_description"],
+                                                             context.get("deadline"))
+    if not error_message:
+        report_phase(context, jobinfo.Phases.CONTENT_UPLOADED)
+        report_phase(context, jobinfo.Phases.INSTANTIATING)
+
+    return error_message
+
+# Remove the uploaded training content
+def undo_upload_content(context):
+
+    remove_content(context["user_id"], context["range_id"], context["activity_id"], context.get("deadline"))
+
+# Choose the instantiation servers of the cyber range via the placement
+# policy, among the available servers; a range with more than
+# MAX_PART_INSTANCES instances is split into parts, each of which is
+# created on a different server, and on a host managed by that server
+def step_place_range(context):
+
+    instance_count = int(context["count"])
+    user_host_address = context["user_obj"].host_mgmt_addr
+    if not shard_pool.manages_host(user_host_address):
+        print "* ERROR: trngsrv: Host %s of user %s is not managed by any instantiation server." % (
+            user_host_address, context["user_id"])
+        return Storyboard.USER_HOST_UNMANAGED_ERROR
+    shards = shard_pool.acquire_many(-(-instance_count // MAX_PART_INSTANCES), user_host_address,
+                                     is_server_available)
+    if not shards:
+        return Storyboard.INSTANTIATION_SERVER_UNAVAILABLE_ERROR
+    context["instantiation_server_urls"] = [shard.url for shard in shards]
+
+    context["parts"] = []
+    instance_parts = shardpool.split_instances(instance_count, MAX_PART_INSTANCES, len(shards))
+    for (shard, (first_instance, count)) in zip(shards, instance_parts):
+        context["parts"].append({"url": shard.url, "first_instance": first_instance, "count": count,
+                                 "host_mgmt_addr": shard.get_host_address(user_host_address)})
+        print "* INFO: trngsrv: Place range #%s (%d instance(s)) on instantiation server %s (%s placement)." % (
+            context["range_id"], count, shard.url, shard_pool.policy)
+
+    return None
+
+# Stop counting the cyber range on its instantiation servers
+def undo_place_range(context):
+
+    for server_url in context["instantiation_server_urls"]:
+        shard_pool.release(server_url)
+
+# Instantiate the parts of the cyber range concurrently; if some parts
+# cannot be instantiated, the other parts are destroyed
+def step_instantiate_range(context):
+
+    instantiation_futures = [parallel.submit(instantiate_range, part["url"], context["user_id"],
+                                             context["range_id"], part["range_description"],
+                                             context["progression_scenario"], context.get("deadline"),
+                                             context["priority"])
+                             for part in context["parts"]]
+    instantiation_results = [instantiation_future.result() for instantiation_future in instantiation_futures]
+    instantiation_errors = [error_message for (error_message, message) in instantiation_results if error_message]
+
+    if instantiation_errors:
+        instantiated_urls = [part["url"] for (part, (error_message, message))
+                             in zip(context["parts"], instantiation_results) if not error_message]
+        if instantiated_urls:
+            print "* ERROR: trngsrv: Instantiation failed for %d part(s) => destroy the other part(s)." % (
+                len(instantiation_errors))
+            # The destruction gets its own deadline, since instantiation
+            # may have failed because the deadline of the action expired
+            cleanup_deadline = None
+            if context.get("deadline"):
+                cleanup_deadline = deadline.Deadline(deadline.CLEANUP_TIMEOUT)
+            destroy_range_parts(instantiated_urls, context["user_id"], context["range_id"], cleanup_deadline)
+        return instantiation_errors[0]
+
+    context["message"] = merge_notifications(context["parts"],
+                                             [message for (error_message, message) in instantiation_results])
+    return None
+
+# Destroy the instantiated cyber range
+def undo_instantiate_range(context):
+
+    destroy_range_parts(context["instantiation_server_urls"], context["user_id"], context["range_id"],
+                        context.get("deadline"))
+
+# Save the training session for the uploaded content
+def step_save_session(context):
+
+    session_name = "Training Session #%s" % (context["range_id"])
+    crt_time = time.asctime()
+    print "* INFO: trngsrv: Instantiation successful => save training session: %s (time: %s)." % (session_name, crt_time)
+
+    # Synchronize access to active sessions list
+    RequestHandler.lock_active_sessions.acquire()
+    try:
+        # Add new session and save to file
+        # Scenarios and levels should be given as arrays,
+        # so we convert values to arrays when passing arguments
+        if not session_store.add_session(session_name, context["range_id"], context["user_id"],
+                                         crt_time, context["type"], [context["scenario"]], [context["level"]],
+                                         context["language"], context["count"], context["activity_id"],
+                                         context["instantiation_server_urls"]):
+            # The session stays active, and is saved together with the next change
+            print "* ERROR: trngsrv: Cannot save training session %s to file." % (session_name)
+        # The range id now belongs to an active session
+        context["reservation"].commit()
+    finally:
+        RequestHandler.lock_active_sessions.release()
+
+    return None
+
+# Get the creation log of each part of the instantiated cyber range, and
+# extract the meta answers of each instance from it
+def step_get_creation_log(context):
+
+    context["meta_answer_dic"] = {}
+    for part in context["parts"]:
+        (error_message, meta_answer_dic) = get_meta_answers(part["url"], context["user_id"], context["range_id"],
+                                                            context.get("deadline"))
+        if error_message:
+            return error_message
+        # Instances are numbered from 1 in each part
+        for (instance_number, meta_answers) in meta_answer_dic.items():
+            context["meta_answer_dic"][part["first_instance"] + instance_number - 1] = meta_answers
+
+    return None
+
+# Get the creation log of a range via an instantiation server, and extract
+# the meta answers of each instance from it
+# Return a tuple (error message, meta answer dictionary); the error message
+# is None on success
+def get_meta_answers(server_url, user_id, cyber_range_id, request_deadline=None):
+
+    query_tuples = {
+        query.Parameters.USER: user_id,
+        query.Parameters.ACTION: query.Parameters.GET_CR_CREATION_LOG,
+        query.Parameters.RANGE_ID: cyber_range_id
+    }
+
+    print "* INFO: trngsrv: Send creation log request to instantiation server %s." % (server_url)
+    try:
+        query_result = post_request(server_url, query_tuples, request_deadline)
+    except IOError as error:
+        print "* ERROR: trngsrv: File error: %s." % (error)
+        return (Storyboard.CONTENT_LOADING_ERROR, None)
+
+    #############################################################################
+    # Start parse GET_CR_CREATION_LOG & store "exec-result:"
+    # meta_answer_dic :
+    # {1: [
+    #       {'desktop,1,eth_ip': '1.1.1.2'},
+    #       {'desktop,1,whoami': 'root'}
+    #     ],
+    # 2: [
+    #       {'desktop,1,eth_ip': '1.2.1.2'},
+    #       {'desktop,1,whoami': 'root'}
+    #    ]
+    # }
+    #############################################################################
+    creation_log_content = query_result
+    if (creation_log_content[0]=="[" )& \
+            (creation_log_content[1]=="{" )& \
+            (creation_log_content[(len(creation_log_content)-2)]=="}" )& \
+            (creation_log_content[(len(creation_log_content)-1)]=="]"):
+        creation_log_content=creation_log_content[2:]
+        creation_log_content=creation_log_content[:-2]
+    (status,creation_log_message)=creation_log_content.split(',')
+    (tag,body)=creation_log_message.split(':')
+    decode_mesage=urllib.unquote(body)
+    decode_mesage=decode_mesage.split("\n")
+    result_list=[]
+    for lines in decode_mesage :
+        if 'exec-result:' in lines:
+            result_list.append(lines.replace("exec-result: ", ""))
+    all_result = []
+    for instnum,result in enumerate(result_list):
+        tag,ans = result.split()
+        ans=urllib.unquote(ans)
+        ans=ans.replace("\n", "")
+        ins,guest,num,var=tag.split(",")
+        ins_num=ins.replace("ins", "")
+        user_def = guest+','+num+','+var
+        all_result.append({int(ins_num):{user_def:ans}})
+    meta_answer_dic={}
+    for inst in all_result:
+        for i in inst:
+            try:
+                meta_answer_dic[i].append(inst[i])
+            except:
+                meta_answer_dic[i]=[inst[i]]
+    #############################################################################
+    # End parse GET_CR_CREATION_LOG & store "exec-result:"
+    #############################################################################
+
+    return (None, meta_answer_dic)
+
+# Prepare the content description of each instance by using its meta answers
+def step_prepare_contents(context):
+
+    meta_answer_dic = context["meta_answer_dic"]
+    content_file_content = context["content_description"]
+
+    #############################################################################
+    # Loop for meta_answer
+    #############################################################################
+    # test code for New syntax as meta_answer by rive3
+    content_descriptions = []
+    try:
+        for inst in range(int(context["count"])):
+            meta_answers={}
+            for meta_answer_par_inst in meta_answer_dic[inst+1]:
+                meta_answers.update(meta_answer_par_inst)
+            content_template=Meta_answer_template(content_file_content)
+            if DEBUG:
+                print meta_answers
+            patched_content=content_template.safe_substitute(meta_answers)
+            content_list = yaml.load(patched_content)
+            try:
+                #change 2 dic type
+                for i in content_list:
+                    if type(i) != dict:
+                        logging.error("Incorrect format")
+                    for j in i:
+                        #top level tag (training)
+                        for k in i[j]:
+                            # training section
+                            for quest in k["questions"]:
+                                # search keys
+                                for keys in list(quest):
+                                    if(keys=="meta_answer"):
+                                        try:
+                                            del quest["answer"]
+                                        except:
+                                            pass
+                                        finally:
+                                            quest["answer"]=quest["meta_answer"]
+                                        del quest["meta_answer"]
+
+            except (IOError, yaml.YAMLError) as e:
+                logging.error("General error: " + str(e))
+                return Storyboard.INSTANTIATION_SERVER_ERROR
+            content_descriptions.append(yaml.dump(content_list, default_flow_style=False))
+    except Exception as e:
+        print "* ERROR: trngsrv: loop error: %s." % (e)
+        return Storyboard.CONTENT_SERVER_ERROR
+
+    context["content_descriptions"] = content_descriptions
+    return None
+
+# Upload the content of all instances via the bounded pool of content
+# workers; if any upload fails, the content uploaded for the other
+# instances is removed
+def step_upload_contents(context):
+
+    print "* INFO: trngsrv: Upload content for %d instance(s) (parallelism: %d)." % (
+        len(context["content_descriptions"]), content_executor.max_workers)
+    upload_futures = content_executor.map(upload_content,
+                                          [(context["user_id"], context["range_id"], content_description,
+                                            context.get("deadline"))
+                                           for content_description in context["content_descriptions"]])
+
+    # Gather the results in instance order
+    upload_results = [upload_future.result() for upload_future in upload_futures]
+    print "* INFO: trngsrv: Downstream connections: %s." % (downstream_pool)
+    upload_errors = [upload_error for (upload_error, activity_id) in upload_results if upload_error]
+    context["activity_ids"] = [activity_id for (upload_error, activity_id) in upload_results if not upload_error]
+
+    if upload_errors:
+        print "* ERROR: trngsrv: Content upload failed for %d instance(s)." % (len(upload_errors))
+        # The removal gets its own deadline, since uploads may have failed
+        # because the deadline of the action expired
+        cleanup_context = dict(context)
+        if context.get("deadline"):
+            cleanup_context["deadline"] = deadline.Deadline(deadline.CLEANUP_TIMEOUT)
+        undo_upload_contents(cleanup_context)
+        return upload_errors[0]
+
+    return None
+
+# Remove the content uploaded for all instances
+def undo_upload_contents(context):
+
+    removal_futures = content_executor.map(remove_content,
+                                           [(context["user_id"], context["range_id"], activity_id,
+                                             context.get("deadline"))
+                                            for activity_id in context["activity_ids"]])
+    parallel.wait_all(removal_futures)
+
+# Save the training sessions for the content of all instances
+def step_save_sessions(context):
+
+    session_name = "Training Session #%s" % (context["range_id"])
+    crt_time = time.asctime()
+    print "* INFO: trngsrv: Instantiation successful => save training session: %s (time: %s)." % (session_name, crt_time)
+
+    # Synchronize access to active sessions list
+    RequestHandler.lock_active_sessions.acquire()
+    try:
+        # Add one session per instance and save to file once
+        # Scenarios and levels should be given as arrays,
+        # so we convert values to arrays when passing arguments
+        if not session_store.add_sessions(session_name, context["range_id"], context["user_id"],
+                                          crt_time, context["type"], [context["scenario"]], [context["level"]],
+                                          context["language"], context["count"], context["activity_ids"],
+                                          context["instantiation_server_urls"]):
+            # The session stays active, and is saved together with the next change
+            print "* ERROR: trngsrv: Cannot save training session %s to file." % (session_name)
+        # The range id now belongs to the active sessions, if any
+        if context["activity_ids"]:
+            context["reservation"].commit()
+    finally:
+        RequestHandler.lock_active_sessions.release()
+
+    return None
+
+# Remove the training content of a session
+def step_remove_content(context):
+
+    return remove_content(context["user_id"], context["range_id"], context["activity_id"],
+                          context.get("deadline"))
+
+# Remove the training content of all instances of a session via the
+# bounded pool of content workers
+def step_remove_contents(context):
+
+    print "* INFO: trngsrv: Remove content for %d instance(s) (parallelism: %d)." % (
+        len(context["activity_ids"]), content_executor.max_workers)
+    removal_futures = content_executor.map(remove_content,
+                                           [(context["user_id"], context["range_id"], activity_id,
+                                             context.get("deadline"))
+                                            for activity_id in context["activity_ids"]])
+    removal_errors = []
+    for (activity_id, removal_future) in zip(context["activity_ids"], removal_futures):
+        removal_error = removal_future.result()
+        if removal_error:
+            print "* ERROR: trngsrv: Cannot remove content for activity %s." % (activity_id)
+            removal_errors.append(removal_error)
+    if removal_errors:
+        return removal_errors[0]
+
+    return None
+
+# Destroy the cyber range of a session
+def step_destroy_range(context):
+
+    return destroy_range_parts(context["instantiation_server_urls"], context["user_id"], context["range_id"],
+                               context.get("deadline"))
+
+# Remove the training session
+def step_remove_session(context):
+
+    RequestHandler.lock_active_sessions.acquire()
+    try:
+        # Remove session and save to file
+        was_used = session_store.is_session_id(context["range_id"])
+        is_removed = session_store.remove_session(context["range_id"], context["user_id"])
+        # Release the range id once no session uses it, and stop counting
+        # the range on its instantiation servers; this is done even if the
+        # change could not be saved, since the session is no longer active
+        if was_used and not session_store.is_session_id(context["range_id"]):
+            range_id_allocator.release(context["range_id"])
+            for server_url in context["instantiation_server_urls"]:
+                shard_pool.release(server_url)
+        if not is_removed:
+            print "* ERROR: Cannot remove training session %s." % (context["range_id"])
+            return Storyboard.SESSION_INFO_CONSISTENCY_ERROR
+    finally:
+        RequestHandler.lock_active_sessions.release()
+
+    return None
+
+# Remove the training sessions of all instances
+def step_remove_sessions(context):
+
+    RequestHandler.lock_active_sessions.acquire()
+    try:
+        # Remove the sessions of all instances and save to file once
+        was_used = session_store.is_session_id(context["range_id"])
+        is_removed = session_store.remove_sessions_variation(context["range_id"], context["user_id"],
+                                                             context["activity_ids"])
+        # Release the range id once no session uses it, and stop counting
+        # the range on its instantiation servers; this is done even if the
+        # change could not be saved, since the sessions are no longer active
+        if was_used and not session_store.is_session_id(context["range_id"]):
+            range_id_allocator.release(context["range_id"])
+            for server_url in context["instantiation_server_urls"]:
+                shard_pool.release(server_url)
+        if not is_removed:
+            print "* ERROR: Cannot remove training session %s." % (context["range_id"])
+            return Storyboard.SESSION_INFO_CONSISTENCY_ERROR
+    finally:
+        RequestHandler.lock_active_sessions.release()
+
+    return None
+
+
+#############################################################################
+# Pipelines of the training lifecycle actions; steps start as soon as the
+# steps they require succeed, and compensations undo the steps that
+# succeeded if a later step fails
+#############################################################################
+
+# Create a training session: content upload and instantiation are
+# independent, hence they are executed concurrently
+CREATE_TRAINING_PIPELINE = pipeline.Pipeline(query.Parameters.CREATE_TRAINING, [
+    pipeline.Step("read_content", step_read_content),
+    pipeline.Step("place_range", step_place_range, compensation=undo_place_range),
+    pipeline.Step("read_range", step_read_range, requires=["place_range"]),
+    pipeline.Step("upload_content", step_upload_content, requires=["read_content"],
+                  compensation=undo_upload_content),
+    pipeline.Step("instantiate_range", step_instantiate_range, requires=["read_range"],
+                  compensation=undo_instantiate_range),
+    pipeline.Step("save_session", step_save_session, requires=["upload_content", "instantiate_range"])])
+
+# Create a training session with variations: the content of each instance
+# depends on the creation log of the instantiated range
+CREATE_TRAINING_VARIATION_PIPELINE = pipeline.Pipeline(query.Parameters.CREATE_TRAINING_Variation, [
+    pipeline.Step("read_content", step_read_content),
+    pipeline.Step("place_range", step_place_range, compensation=undo_place_range),
+    pipeline.Step("read_range", step_read_range, requires=["place_range"]),
+    pipeline.Step("instantiate_range", step_instantiate_range, requires=["read_range"],
+                  compensation=undo_instantiate_range),
+    pipeline.Step("get_creation_log", step_get_creation_log, requires=["instantiate_range"]),
+    pipeline.Step("prepare_contents", step_prepare_contents, requires=["read_content", "get_creation_log"]),
+    pipeline.Step("upload_contents", step_upload_contents, requires=["prepare_contents"],
+                  compensation=undo_upload_contents),
+    pipeline.Step("save_sessions", step_save_sessions, requires=["upload_contents"])])
+
+# End a training session: the range is only destroyed after the content
+# was removed, so that a failed removal leaves the session intact
+END_TRAINING_PIPELINE = pipeline.Pipeline(query.Parameters.END_TRAINING, [
+    pipeline.Step("remove_content", step_remove_content),
+    pipeline.Step("destroy_range", step_destroy_range, requires=["remove_content"]),
+    pipeline.Step("remove_session", step_remove_session, requires=["destroy_range"])])
+
+# End a training session with variations
+END_TRAINING_VARIATION_PIPELINE = pipeline.Pipeline(query.Parameters.END_TRAINING_Variation, [
+    pipeline.Step("remove_contents", step_remove_contents),
+    pipeline.Step("destroy_range", step_destroy_range, requires=["remove_contents"]),
+    pipeline.Step("remove_sessions", step_remove_sessions, requires=["destroy_range"])])
+
+# Create a training session for a range id reserved for a given user; the
+# progress is reported via the job object, if provided, the action is
+# abandoned when the deadline, if provided, expires, and the range is
+# instantiated with the given priority
+# Return a tuple (error message, notification message); the error message
+# is None on success
+def create_training_session(reservation, user_obj, training_info, ttype, scenario, level,
+                            language, instance_count, job=None, request_deadline=None,
+                            priority=query.Parameters.NORMAL):
+
+    context = build_creation_context(reservation, user_obj, training_info, ttype, scenario, level,
+                                     language, instance_count, job, request_deadline, priority)
+    error_message = CREATE_TRAINING_PIPELINE.run(context)
+    if error_message:
+        return (error_message, None)
+
+    return (None, context["message"])
+
+# Create a training session with variations for a range id reserved for
+# a given user
+# Return a tuple (error message, notification message); the error message
+# is None on success
+def create_training_variation_session(reservation, user_obj, training_info, ttype, scenario, level,
+                                      language, instance_count, request_deadline=None,
+                                      priority=query.Parameters.NORMAL):
+
+    context = build_creation_context(reservation, user_obj, training_info, ttype, scenario, level,
+                                     language, instance_count, request_deadline=request_deadline,
+                                     priority=priority)
+    # Note: Progression scenarios are not used for variations
+    context["progression_scenario"] = None
+    error_message = CREATE_TRAINING_VARIATION_PIPELINE.run(context)
+    if error_message:
+        return (error_message, None)
+
+    return (None, context["message"])
+
+# Create a training session in the background, and report the outcome via
+# the job object; the reservation is released unless the session is created
+def run_training_job(job, reservation, user_obj, training_info, ttype, scenario, level,
+                     language, instance_count, job_deadline, priority):
+
+    with reservation:
+        try:
+            (error_message, message) = create_training_session(reservation, user_obj, training_info,
+                                                               ttype, scenario, level, language,
+                                                               instance_count, job, job_deadline, priority)
+        except Exception as error:
+            print "* ERROR: trngsrv: Training job error: %s." % (error)
+            error_message = Storyboard.JOB_EXECUTION_ERROR
+
+    if error_message:
+        job_table.set_phase(job, jobinfo.Phases.FAILED, error_message)
+    else:
+        job_table.set_phase(job, jobinfo.Phases.READY, message)
+
+
+#############################################################################
+# Shared objects
+#############################################################################
+
+# User information, which is reloaded only when the file changes
+user_info_cache = userinfo.UserInfoCache(DATABASE_DIR + USERS_FILE)
+
+# Training catalogues for each language, which are reloaded only when
+# the corresponding files change
+training_catalogues = {
+    query.Parameters.EN: filecache.FileCache(DATABASE_DIR + SCENARIOS_FILE_EN, load_training_catalogue),
+    query.Parameters.JA: filecache.FileCache(DATABASE_DIR + SCENARIOS_FILE_JA, load_training_catalogue)
+}
+
+# Active training sessions, which are kept in memory and only loaded from
+# file at startup
+session_store = sessinfo.SessionStore(ACTIVE_SESSIONS_FILE)
+
+# Session tokens and cache of successful password verifications, which
+# avoid hashing the user password again for each request
+token_manager = TokenManager()
+verification_cache = VerificationCache()
+
+# Bounded pool of workers for content server requests, which limits the
+# number of content operations that are executed at the same time
+content_executor = parallel.Executor(CONTENT_PARALLELISM)
+
+# Jobs for the actions executed in the background, and the bounded pool of
+# workers that executes them
+job_table = jobinfo.JobTable()
+job_executor = parallel.Executor(JOB_WORKERS)
+
+# Persistent connections to the content and instantiation servers, which
+# are reused by subsequent requests
+downstream_pool = connpool.ConnectionPool(DOWNSTREAM_CONNECTIONS, DOWNSTREAM_CONNECT_TIMEOUT,
+                                          DOWNSTREAM_READ_TIMEOUT)
+
+# Circuit breakers for the content and instantiation servers, which make
+# requests fail fast while a server is unavailable, and the monitor that
+# probes the health of the servers periodically
+# Note: The breakers of the instantiation servers are added at startup
+downstream_breakers = {
+    CONTENT_SERVER_URL: health.CircuitBreaker("content server", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+}
+downstream_unavailable_errors = {
+    CONTENT_SERVER_URL: Storyboard.CONTENT_SERVER_UNAVAILABLE_ERROR
+}
+health_monitor = health.HealthMonitor(downstream_breakers, HEALTH_PROBE_INTERVAL, HEALTH_PROBE_TIMEOUT)
+
+# Cyber range id allocator, which is initialized at startup with the ids
+# of the active training sessions
+range_id_allocator = sessinfo.RangeIdAllocator(MAX_SESSIONS)
+
+# Instantiation servers (shards) on which cyber ranges are placed; replaced
+# at startup by the servers in the shards file, if it exists
+shard_pool = shardpool.ShardPool([shardpool.Shard(INSTANTIATION_SERVER_URL)], PLACEMENT_POLICY)
+
 #############################################################################
 # Manage the training server functionality
 #############################################################################
-class RequestHandler(BaseHTTPRequestHandler):
+class RequestHandler(httpsrv.KeepAliveMixin, BaseHTTPRequestHandler):
+
+    # Use persistent connections; idle connections are closed after
+    # KEEP_ALIVE_TIMEOUT, or as soon as other clients wait for a worker,
+    # so that they do not occupy workers
+    protocol_version = "HTTP/1.1"
+    timeout = CONNECTION_TIMEOUT
+
+    # Headers are written separately, hence small writes must not be
+    # delayed on persistent connections
+    disable_nagle_algorithm = True
 
     # List of valid actions recognized by the training server
-    VALID_ACTIONS = [query.Parameters.FETCH_CONTENT,
+    VALID_ACTIONS = [query.Parameters.LOGIN,
+                     query.Parameters.FETCH_CONTENT,
                      query.Parameters.CREATE_TRAINING,
                      query.Parameters.GET_CONFIGURATIONS,
                      query.Parameters.GET_SESSIONS,
                      query.Parameters.END_TRAINING,
                      query.Parameters.CREATE_TRAINING_Variation,
                      query.Parameters.GET_CR_CREATION_LOG,
-                     query.Parameters.END_TRAINING_Variation]
+                     query.Parameters.END_TRAINING_Variation,
+                     query.Parameters.GET_JOB_STATUS,
+                     query.Parameters.GET_SERVER_STATUS]
 
     # List of valid languages recognized by the training server
     VALID_LANGUAGES = [query.Parameters.EN,
                      query.Parameters.JA]
 
-    # List of sessions which are pending (being instantiated, etc.)
-    pending_sessions = []
+    # List of actions that use the training information
+    TRAINING_INFO_ACTIONS = [query.Parameters.FETCH_CONTENT,
+                             query.Parameters.CREATE_TRAINING,
+                             query.Parameters.CREATE_TRAINING_Variation]
 
     # Locks for synchronizing access to shared resources, as follows:
-    # - lock_active_sessions: active sessions list (and related variables: pending_sessions, cyber_range_id)
+    # - lock_active_sessions: active sessions list
     # - lock_saved_configurations: saved configurations list
     lock_active_sessions = threading.Lock()
     lock_saved_configurations = threading.Lock()
@@ -123,54 +1103,6 @@ class RequestHandler(BaseHTTPRequestHandler):
                 done = True
         return cyber_range_id
 
-    ## Decimal id between 1 and MAX_SESSIONS with lowest available value [not in use]
-    ## (pending session ids are avoided)
-    ## NOTE: Requires synchronization for active sessions list
-    def generate_id_max_sessions_lowest(self, pending_sessions):
-        cyber_range_id = None
-        # Read current session info
-        session_info = sessinfo.SessionInfo()
-        session_info.parse_YAML_file(ACTIVE_SESSIONS_FILE)
-        for id in range(1,MAX_SESSIONS+1):
-            # Check that id (as string) is _not_ already used for an existing or pending session
-            if not (session_info.is_session_id(str(id))
-                    or str(id) in pending_sessions):
-                cyber_range_id = id
-                break
-        # Returned value should be an integer
-        return cyber_range_id
-
-    ## Decimal id between 1 and MAX_SESSIONS with next available value [in use]
-    ## (if next value is unavailable, use lowest; pending session ids are avoided)
-    ## NOTE: Requires synchronization for active sessions list
-    def generate_id_max_sessions_next(self, pending_sessions):
-        cyber_range_id = None
-        # Read current session info
-        session_info = sessinfo.SessionInfo()
-        session_info.parse_YAML_file(ACTIVE_SESSIONS_FILE)
-        # For set operations we need to represent ids as integer,
-        # not as string as stored internally
-        possible_set = set(range(MAX_SESSIONS+1)) # All possible values
-        invalid_set = set([0]) # Invalid values if any
-        unavailable_set = invalid_set.union(session_info.get_id_list_int()) # Union with active sessions
-        pending_set = set(map(int, pending_sessions))
-        unavailable_set = unavailable_set.union(pending_set) # Union with pending sessions
-        max_unavailable_value = max(unavailable_set)
-        available_set = possible_set.difference(unavailable_set) # Usable values
-        if (max_unavailable_value+1) in available_set:
-            cyber_range_id = (max_unavailable_value+1)
-        elif available_set:
-            cyber_range_id = min(available_set)
-            # Otherwise we'll return the None value set at the beginning
-        # Returned value should be an integer
-        return cyber_range_id
-
-    #########################################################################
-    # Generate a cyber range id
-    def generate_cyber_range_id(self, pending_sessions):
-
-        return self.generate_id_max_sessions_next(pending_sessions)
-
     #########################################################################
     # Check whether a range with the given id is active for the
     # specified user_id;
@@ -178,15 +1110,8 @@ class RequestHandler(BaseHTTPRequestHandler):
     # Note: Requires synchronization for active sessions list
     def check_range_id_exists(self, range_id, user_id):
 
-        # Read current session info
-        session_info = sessinfo.SessionInfo()
-        session_info.parse_YAML_file(ACTIVE_SESSIONS_FILE)
-
         # Check if the given range id (as string) is already used
-        if session_info.is_session_id_user(range_id, user_id):
-            return session_info.get_activity_id(range_id, user_id)
-        else:
-            return None
+        return session_store.get_activity_id(range_id, user_id)
 
     #########################################################################
     # Check whether a range with the given id is active for the
@@ -194,20 +1119,32 @@ class RequestHandler(BaseHTTPRequestHandler):
     # Return the activity id if session was found, None otherwise
     # Note: Requires synchronization for active sessions list
     def check_range_id_and_activity_id_exists(self, range_id, user_id):
-        # Read current session info
-        session_info = sessinfo.SessionInfo()
-        session_info.parse_YAML_file(ACTIVE_SESSIONS_FILE)
 
         # Check if the given range id (as string) is already used
-        if session_info.is_session_id_user(range_id, user_id):
-            return session_info.get_activity_id_list(range_id, user_id)
-        else:
-            return None
+        return session_store.get_activity_id_list(range_id, user_id)
 
     #########################################################################
     # Handle POST message
     def do_POST(self):
 
+        # Cyber range id reservations made while handling the request;
+        # those that were not committed are released whatever the outcome
+        self.reservations = []
+
+        # Deadline of the request, which is passed to the downstream servers;
+        # requests may provide a shorter deadline than REQUEST_TIMEOUT
+        self.deadline = deadline.from_header(self.headers.getheader(deadline.DEADLINE_HEADER),
+                                             REQUEST_TIMEOUT)
+        try:
+            self.handle_POST()
+        finally:
+            for reservation in self.reservations:
+                reservation.release()
+
+    #########################################################################
+    # Handle POST message parameters and actions
+    def handle_POST(self):
+
         # Get the parameters of the POST request
         params = query.Parameters(self)
 
@@ -221,6 +1158,7 @@ class RequestHandler(BaseHTTPRequestHandler):
         # Get the values of the parameters for given keys
         user_id = params.get(query.Parameters.USER)
         password = params.get(query.Parameters.PASSWORD)
+        token = params.get(query.Parameters.TOKEN)
         action = params.get(query.Parameters.ACTION)
         language = params.get(query.Parameters.LANG) 
         instance_count = params.get(query.Parameters.COUNT)
@@ -228,6 +1166,9 @@ class RequestHandler(BaseHTTPRequestHandler):
         scenario = params.get(query.Parameters.SCENARIO)
         level = params.get(query.Parameters.LEVEL)
         range_id = params.get(query.Parameters.RANGE_ID)
+        job_id = params.get(query.Parameters.JOB_ID)
+        is_async = params.get(query.Parameters.ASYNC) in query.Parameters.TRUE_VALUES
+        priority = params.get(query.Parameters.PRIORITY)
 
         if DEBUG:
             print Storyboard.SEPARATOR1
@@ -236,6 +1177,8 @@ class RequestHandler(BaseHTTPRequestHandler):
             print "USER: %s" % (user_id)
             if password:
                 print "PASSWORD: ******"
+            if token:
+                print "TOKEN: ******"
             print "ACTION: %s" % (action)
             print "LANGUAGE: %s" % (language)
             print "COUNT: %s" % (instance_count)
@@ -243,25 +1186,31 @@ class RequestHandler(BaseHTTPRequestHandler):
             print "SCENARIO: %s" % (scenario)
             print "LEVEL: %s" % (level)
             print "RANGE_ID: %s" % (range_id)
+            print "JOB_ID: %s" % (job_id)
+            print "ASYNC: %s" % (is_async)
+            print "PRIORITY: %s" % (priority)
             print Storyboard.SEPARATOR1
 
         ## Verify user information
 
-        # Get user information from YAML file
-        # Note: Only reading data that is (potentially) modified externally =>
-        #       no need for synchronization
-        user_info = userinfo.UserInfo()
-        if not user_info.parse_YAML_file(DATABASE_DIR + USERS_FILE):
+        # Get user information from the cache, which reloads the YAML
+        # file only if it was modified externally
+        # Note: The cache handles synchronization internally
+        user_info = user_info_cache.get()
+        if not user_info:
             self.respond_error(Storyboard.USER_SETTINGS_LOADING_ERROR)
             return
         if DEBUG:
             user_info.pretty_print()
+            print "* DEBUG: trngsrv: User information cache: %s" % (user_info_cache)
 
         # Check that user id is valid
         if not user_id:
             self.respond_error(Storyboard.USER_ID_MISSING_ERROR)
             return
-        user_obj = user_info.get_user(user_id) 
+        # Note: A copy is used, since the cached user information is
+        #       shared between requests
+        user_obj = user_info.get_user_copy(user_id)
         if not user_obj:
             self.respond_error(Storyboard.USER_ID_INVALID_ERROR)
             return
@@ -272,9 +1221,16 @@ class RequestHandler(BaseHTTPRequestHandler):
             if not user_obj.password:
                 self.respond_error(Storyboard.USER_PASSWORD_NOT_IN_DATABASE_ERROR)
                 return
+            # If a token was provided (except for login), verify that it was issued
+            # for the current user and password from the database
+            if token and action != query.Parameters.LOGIN:
+                if not token_manager.verify_token(token, user_id, user_obj.password):
+                    self.respond_error(Storyboard.USER_TOKEN_INVALID_ERROR)
+                    return
             # If a password was provided, verify that it matches the encrypted one from the database
-            if password:
-                if not Password.verify(password, user_obj.password):
+            # Note: The verification cache avoids hashing the password for each request
+            elif password:
+                if not verification_cache.verify(user_id, password, user_obj.password):
                     self.respond_error(Storyboard.USER_ID_PASSWORD_INVALID_ERROR)
                     return
             else:
@@ -291,9 +1247,6 @@ class RequestHandler(BaseHTTPRequestHandler):
             self.respond_error(Storyboard.ACTION_INVALID_ERROR)
             return
 
-        # Create training database content information object
-        training_info = trnginfo.TrainingInfo()
-
         # Check that language is valid
         if not language:
             self.respond_error(Storyboard.LANGUAGE_MISSING_ERROR)
@@ -302,39 +1255,44 @@ class RequestHandler(BaseHTTPRequestHandler):
             self.respond_error(Storyboard.LANGUAGE_INVALID_ERROR)
             return
 
-        # Select the scenario information file based on the
-        # requested language
-        if language == query.Parameters.JA:
-            training_settings_file = DATABASE_DIR + SCENARIOS_FILE_JA
-        else:
-            training_settings_file = DATABASE_DIR + SCENARIOS_FILE_EN
-
-        if DEBUG:
-            print "* DEBUG: trngsrv: Read training settings from '%s'..." % (training_settings_file)
-
-        # Note: Only reading data that is (potentially) modified externally =>
-        #       no need for synchronization
-        result = training_info.parse_YAML_file(training_settings_file)
-
-        if not result:
-            self.respond_error(Storyboard.TRAINING_SETTINGS_LOADING_ERROR)
+        # Check that priority is valid
+        if priority not in query.Parameters.PRIORITIES:
+            self.respond_error(Storyboard.PRIORITY_INVALID_ERROR)
             return
 
-        if DEBUG:
-            training_info.pretty_print()
+        # Get the training catalogue for the requested language, only
+        # for the actions that need it
+        # Note: The catalogue is reloaded only if the training settings
+        #       file was modified externally, and the cache handles
+        #       synchronization internally
+        training_catalogue = None
+        training_info = None
+        if action in self.TRAINING_INFO_ACTIONS:
+            training_catalogue = training_catalogues[language].get()
+            if not training_catalogue:
+                self.respond_error(Storyboard.TRAINING_SETTINGS_LOADING_ERROR)
+                return
+            training_info = training_catalogue.training_info
+
+            if DEBUG:
+                training_info.pretty_print()
+                print "* DEBUG: trngsrv: Training catalogue cache: %s" % (training_catalogues[language])
 
         # If we reached this point, it means processing was successful
         # => act according to each action
 
+        # Response body, if already prepared by the action
+        response_body = None
+
         ####################################################################
         # Fetch content action
         # Note: Only reading data that is (potentially) modified externally =>
         #       no need for synchronization
         if action == query.Parameters.FETCH_CONTENT: 
 
-            # Convert the training info to the external JSON
-            # representation that will be provided to the client
-            response_data = training_info.get_JSON_representation()
+            # Use the response containing the external JSON representation
+            # of the training info, which was prepared when loading it
+            response_body = training_catalogue.fetch_content_response
 
         ####################################################################
         # Original Create training action
@@ -363,188 +1321,46 @@ class RequestHandler(BaseHTTPRequestHandler):
                 self.respond_error(Storyboard.LEVEL_NAME_MISSING_ERROR)
                 return
 
-            # Synchronize access to active sessions list and related variables
-            self.lock_active_sessions.acquire()
-            try:
-                cyber_range_id = self.generate_cyber_range_id(self.pending_sessions)
-                if cyber_range_id:
-                     # Convert to string for internal representation
-                    cyber_range_id = str(cyber_range_id)
-                    self.pending_sessions.append(cyber_range_id)
-                    print "* INFO: trngsrv: Allocated session with ID #%s." % (cyber_range_id)
-                else:
-                    self.respond_error(Storyboard.SESSION_ALLOCATION_ERROR)
-                    return
-            finally:
-                self.lock_active_sessions.release()
-
-            ########################################
-            # Handle content upload
-            content_file_name = training_info.get_content_file_name(scenario, level)
-            if content_file_name == None:
-                self.removePendingSession(cyber_range_id)
-                self.respond_error(Storyboard.CONTENT_IDENTIFICATION_ERROR)
+            # Fail fast if a downstream server is unavailable, before
+            # reserving a cyber range id and reading the templates
+            error_message = check_creation_servers()
+            if error_message:
+                self.respond_error(error_message)
                 return
 
-            content_file_name = DATABASE_DIR + content_file_name
-
-            if DEBUG:
-                print "* DEBUG: trngsrv: Training content file: %s" % (content_file_name)
-
-            # Open the content file
-            try:
-                content_file = open(content_file_name, "r")
-                content_file_content = content_file.read()
-                content_file.close()
-
-            except IOError as error:
-                print "* ERROR: trngsrv: File error: %s." % (error)
-                self.removePendingSession(cyber_range_id)
-                self.respond_error(Storyboard.CONTENT_LOADING_ERROR)
-                return
-
-            try:
-                # Note: creating a dictionary as below does not
-                # preserve the order of the parameters, but this has
-                # no negative influence in our implementation
-                query_tuples = {
-                    query.Parameters.USER: user_id,
-                    query.Parameters.ACTION: query.Parameters.UPLOAD_CONTENT,
-                    query.Parameters.DESCRIPTION_FILE: content_file_content,
-                    query.Parameters.RANGE_ID: cyber_range_id
-                }
-
-                query_params = urllib.urlencode(query_tuples)
-                print "* INFO: trngsrv: Send upload request to content server %s." % (CONTENT_SERVER_URL)
-                if DEBUG:
-                    print "* DEBUG: trngsrv: POST parameters: %s" % (query_params)
-                data_stream = urllib.urlopen(CONTENT_SERVER_URL, query_params)
-                data = data_stream.read()
-                if DEBUG:
-                    print "* DEBUG: trngsrv: Content server response body: %s" % (data)
-
-                (status, activity_id) = query.Response.parse_server_response(data)
-
-                if DEBUG:
-                    print("* DEBUG: trngsrv: Response status: {}".format(status))
-                    print("* DEBUG: trngsrv: Response activity_id: {}".format(activity_id))
-
-                if status == Storyboard.SERVER_STATUS_SUCCESS:
-                    # Store activity id in session description
-                    pass
-                else:
-                    print "* ERROR: trngsrv: Content upload error."
-                    self.removePendingSession(cyber_range_id)
-                    self.respond_error(Storyboard.CONTENT_UPLOAD_ERROR)
-                    return
-
-                # Save the response data
-                contsrv_response = data
-
-            except IOError as error:
-                print "* ERROR: trngsrv: URL error: %s." % (error)
-                self.removePendingSession(cyber_range_id)
-                self.respond_error(Storyboard.CONTENT_SERVER_ERROR)
-                return
-
-            ########################################
-            # Handle instantiation
-            range_file_name = training_info.get_range_file_name(scenario, level)
-            if range_file_name == None:
-                self.removePendingSession(cyber_range_id)
-                self.respond_error(Storyboard.TEMPLATE_IDENTIFICATION_ERROR)
-                # TODO: Should delete the content uploaded above before returning
+            # Reserve a cyber range id; the id is released automatically
+            # when request handling ends, unless the reservation is committed
+            reservation = self.reserve_range_id()
+            if not reservation:
+                self.respond_error(Storyboard.SESSION_ALLOCATION_ERROR)
                 return
-
-            range_file_name = DATABASE_DIR + range_file_name
-            progression_scenario_name = training_info.get_progression_scenario_name(scenario, level)
-
-            if DEBUG:
-                print "* DEBUG: trngsrv: Cyber range file: %s" % (range_file_name)
-                print "* DEBUG: trngsrv: Progression scenario: %s" % (progression_scenario_name)
-
-            # Open the cyber range file (template)
-            try:
-                range_file = open(range_file_name, "r")
-                range_file_content = range_file.read()
-                range_file.close()
-
-            except IOError as error:
-                print "* ERROR: trngsrv: File error: %s." % (error)
-                self.removePendingSession(cyber_range_id)
-                self.respond_error(Storyboard.TEMPLATE_LOADING_ERROR)
-                return
-
-            # Do instantiation
-            try:
-                # Replace variables in the range file
-                range_file_content = user_obj.replace_variables(range_file_content, cyber_range_id, instance_count_value)
-
-                # NOTE: creating a dictionary as below does not
-                # preserve the order of the parameters, but this has
-                # no negative influence in our implementation
-                query_tuples = {
-                    query.Parameters.USER: user_id,
-                    query.Parameters.ACTION: query.Parameters.INSTANTIATE_RANGE,
-                    query.Parameters.DESCRIPTION_FILE: range_file_content,
-                    query.Parameters.RANGE_ID: cyber_range_id
-                }
-
-                # If we have a progression scenario defined, we add its name to the query
-                if progression_scenario_name:
-                    query_tuples[query.Parameters.PROGRESSION_SCENARIO] = progression_scenario_name
-
-                query_params = urllib.urlencode(query_tuples)
-                print "* INFO: trngsrv: Send instantiate request to instantiation server %s." % (INSTANTIATION_SERVER_URL)
-                if DEBUG:
-                    print "* DEBUG: trngsrv: POST parameters: %s" % (query_params)
-                data_stream = urllib.urlopen(INSTANTIATION_SERVER_URL, query_params)
-                data = data_stream.read()
-                if DEBUG:
-                    print "* DEBUG: trngsrv: Instantiation server response body: %s" % (data)
-
-                # Remove pending session
-                self.removePendingSession(cyber_range_id)
-
-                (status, message) = query.Response.parse_server_response(data)
-
-                if DEBUG:
-                    print "* DEBUG: trngsrv: Response status:", status
-                    print "* DEBUG: trngsrv: Response message:", message
-
-                if status == Storyboard.SERVER_STATUS_SUCCESS:
-                    session_name = "Training Session #%s" % (cyber_range_id)
-                    crt_time = time.asctime()
-                    print "* INFO: trngsrv: Instantiation successful => save training session: %s (time: %s)." % (session_name, crt_time)
-
-                    # Synchronize access to active sessions list
-                    self.lock_active_sessions.acquire()
-                    try:
-                        # Read session info
-                        session_info = sessinfo.SessionInfo()
-                        session_info.parse_YAML_file(ACTIVE_SESSIONS_FILE)
-
-                        # Add new session and save to file
-                        # Scenarios and levels should be given as arrays,
-                        # so we convert values to arrays when passing arguments
-                        session_info.add_session(session_name, cyber_range_id, user_id,
-                                                 crt_time, ttype, [scenario], [level],
-                                                 language, instance_count, activity_id)
-                        session_info.write_YAML_file(ACTIVE_SESSIONS_FILE)
-                    finally:
-                        self.lock_active_sessions.release()
-                else:
-                    print "* ERROR: trngsrv: Range instantiation error."
-                    self.respond_error(Storyboard.INSTANTIATION_ERROR)
+            cyber_range_id = reservation.range_id
+            print "* INFO: trngsrv: Allocated session with ID #%s." % (cyber_range_id)
+
+            # In asynchronous mode, the training session is created in the
+            # background, and the job id is returned right away
+            if is_async:
+                # The job takes over the reservation from the request
+                self.reservations.remove(reservation)
+                job = job_table.create_job(user_id, cyber_range_id)
+                # Background jobs have their own deadline, since the request
+                # finishes right away; queued jobs consume it as well, and
+                # are executed in priority order
+                job_executor.submit_with_priority(query.Parameters.PRIORITIES.index(priority),
+                                                  run_training_job, job, reservation, user_obj, training_info,
+                                                  ttype, scenario, level, language, instance_count,
+                                                  deadline.Deadline(REQUEST_TIMEOUT), priority)
+                response_data = json.dumps([{Storyboard.SERVER_JOB_ID_KEY: job.job_id,
+                                             Storyboard.SERVER_RANGE_ID_KEY: cyber_range_id}])
+            else:
+                (error_message, message) = create_training_session(reservation, user_obj, training_info,
+                                                                   ttype, scenario, level, language,
+                                                                   instance_count, request_deadline=self.deadline,
+                                                                   priority=priority)
+                if error_message:
+                    self.respond_error(error_message)
                     return
 
-                # Save the response data
-                instsrv_response = data
-
-                if DEBUG:
-                    print "* DEBUG: trngsrv: contsrv response: %s" %(contsrv_response)
-                    print "* DEBUG: trngsrv: instsrv response: %s" %(instsrv_response)
-
                 # Prepare the response as a message
                 # TODO: Should create a function to handle this
                 if message:
@@ -552,12 +1368,6 @@ class RequestHandler(BaseHTTPRequestHandler):
                 else:
                     response_data = None
 
-            except IOError as error:
-                print "* ERROR: trngsrv: URL error: %s." % (error)
-                self.removePendingSession(cyber_range_id)
-                self.respond_error(Storyboard.INSTANTIATION_SERVER_ERROR)
-                return
-
         ####################################################################
         # Create training action
         # Note: Requires synchronized access to active sessions list
@@ -585,320 +1395,74 @@ class RequestHandler(BaseHTTPRequestHandler):
                 self.respond_error(Storyboard.LEVEL_NAME_MISSING_ERROR)
                 return
 
-            # Synchronize access to active sessions list and related variables
-            self.lock_active_sessions.acquire()
-            try:
-                cyber_range_id = self.generate_cyber_range_id(self.pending_sessions)
-                if cyber_range_id:
-                    # Convert to string for internal representation
-                    cyber_range_id = str(cyber_range_id)
-                    self.pending_sessions.append(cyber_range_id)
-                    print "* INFO: trngsrv: Allocated session with ID #%s." % (cyber_range_id)
-                else:
-                    self.respond_error(Storyboard.SESSION_ALLOCATION_ERROR)
-                    return
-            finally:
-                self.lock_active_sessions.release()
-
-            ########################################
-            # Handle instantiation
-            spec_file_name = training_info.get_range_file_name(scenario, level)
-            if spec_file_name == None:
-                self.removePendingSession(cyber_range_id)
-                self.respond_error(Storyboard.TEMPLATE_IDENTIFICATION_ERROR)
+            # Fail fast if a downstream server is unavailable, before
+            # reserving a cyber range id and reading the templates
+            error_message = check_creation_servers()
+            if error_message:
+                self.respond_error(error_message)
                 return
 
-            spec_file_name = DATABASE_DIR + spec_file_name
+            # Reserve a cyber range id; the id is released automatically
+            # when request handling ends, unless the reservation is committed
+            reservation = self.reserve_range_id()
+            if not reservation:
+                self.respond_error(Storyboard.SESSION_ALLOCATION_ERROR)
+                return
+            cyber_range_id = reservation.range_id
+            print "* INFO: trngsrv: Allocated session with ID #%s." % (cyber_range_id)
+
+            (error_message, message) = create_training_variation_session(reservation, user_obj, training_info,
+                                                                         ttype, scenario, level, language,
+                                                                         instance_count, self.deadline, priority)
+            if error_message:
+                self.respond_error(error_message)
+                return
 
-            if DEBUG:
-                print "* DEBUG: trngsrv: Scenario specification file: %s" % (spec_file_name)
+            # Prepare the response as a message
+            # TODO: Should create a function to handle this
+            if message:
+                response_data = '[{{"{0}": "{1}"}}]'.format(Storyboard.SERVER_MESSAGE_KEY, message)
+            else:
+                response_data = None
 
-            # Open the specification file (template)
-            try:
-                spec_file = open(spec_file_name, "r")
-                spec_file_content = spec_file.read()
-                spec_file.close()
-
-            except IOError as error:
-                print "* ERROR: trngsrv: File error: %s." % (error)
-                self.removePendingSession(cyber_range_id)
-                self.respond_error(Storyboard.TEMPLATE_LOADING_ERROR)
-                return
+        ####################################################################
+        # Login action: provide a token that can be used instead of
+        # the password for subsequent actions
+        elif action == query.Parameters.LOGIN:
 
-            # Do instantiation
-            try:
-                # Replace variables in the specification file
-                spec_file_content = user_obj.replace_variables(spec_file_content, cyber_range_id, instance_count_value)
-
-                # Note: creating a dictionary as below does not
-                # preserve the order of the parameters, but this has
-                # no negative influence in our implementation
-                query_tuples = {
-                    query.Parameters.USER: user_id,
-                    query.Parameters.ACTION: query.Parameters.INSTANTIATE_RANGE,
-                    query.Parameters.DESCRIPTION_FILE: spec_file_content,
-                    query.Parameters.RANGE_ID: cyber_range_id
-                }
-
-                query_params = urllib.urlencode(query_tuples)
-                print "* INFO: trngsrv: Send instantiate request to instantiation server %s." % (INSTANTIATION_SERVER_URL)
-                if DEBUG:
-                    print "* DEBUG: trngsrv: POST parameters: %s" % (query_params)
-                data_stream = urllib.urlopen(INSTANTIATION_SERVER_URL, query_params)
-                data=None
-                data = data_stream.read()
-                query_result = None
-                query_result = data_stream.read()
-                if DEBUG:
-                    print "* DEBUG: trngsrv: Instantiation server response body: %s" % (data)
-                    print "* DEBUG: trngsrv: Instantiation server response query_result: %s" % (query_result)
-
-                # Remove pending session
-                self.removePendingSession(cyber_range_id)
-
-                (status, message) = query.Response.parse_server_response(data)
-
-                if DEBUG:
-                    print "* DEBUG: trngsrv: Response status:", status
-                    print "* DEBUG: trngsrv: Response message:", message
-
-                if status == Storyboard.SERVER_STATUS_SUCCESS:
-                    pass
-                else:
-                    print "* ERROR: trngsrv: Range instantiation error."
-                    self.respond_error(Storyboard.INSTANTIATION_ERROR)
-                    return
+            token = token_manager.create_token(user_id, user_obj.password)
+            print "* INFO: trngsrv: Issued token for user %s (valid for %d s)." % (user_id, token_manager.lifetime)
+            response_data = '[{{"{0}": "{1}"}}]'.format(Storyboard.SERVER_TOKEN_KEY, token)
 
-                # Save the response data
-                instsrv_response = data
+        ####################################################################
+        # Retrieve the status of a job executed in the background
+        # Note: The job table handles synchronization internally
+        elif action == query.Parameters.GET_JOB_STATUS:
 
-            except IOError as error:
-                print "* ERROR: trngsrv: URL error: %s." % (error)
-                self.removePendingSession(cyber_range_id)
-                self.respond_error(Storyboard.INSTANTIATION_SERVER_ERROR)
-                return
-            ########################################
-            # Handle GET_CR_CREATION_LOG
-            try:
-                # Note: creating a dictionary as below does not
-                # preserve the order of the parameters, but this has
-                # no negative influence in our implementation
-                query_tuples = {
-                    query.Parameters.USER: user_id,
-                    query.Parameters.ACTION: query.Parameters.GET_CR_CREATION_LOG,
-                    query.Parameters.RANGE_ID: cyber_range_id
-                }
-
-                query_params = urllib.urlencode(query_tuples)
-                print "* INFO: trngsrv: Send instantiate request to instantiation server %s." % (INSTANTIATION_SERVER_URL)
-                if DEBUG:
-                    print "* DEBUG: trngsrv: POST parameters: %s" % (query_params)
-                data_stream = urllib.urlopen(INSTANTIATION_SERVER_URL, query_params)
-                query_result = None
-                query_result = data_stream.read()
-                if DEBUG:
-                    print "* DEBUG: trngsrv: Instantiation server response body: %s" % (query_result)
-
-                #############################################################################
-                # Start parse GET_CR_CREATION_LOG & store "exec-result:"
-                # meta_answer_dic :
-                # {1: [
-                #       {'desktop,1,eth_ip': '1.1.1.2'},
-                #       {'desktop,1,whoami': 'root'}
-                #     ],
-                # 2: [
-                #       {'desktop,1,eth_ip': '1.2.1.2'},
-                #       {'desktop,1,whoami': 'root'}
-                #    ]
-                # }
-                #############################################################################
-                creation_log_content = query_result
-                if (creation_log_content[0]=="[" )& \
-                        (creation_log_content[1]=="{" )& \
-                        (creation_log_content[(len(creation_log_content)-2)]=="}" )& \
-                        (creation_log_content[(len(creation_log_content)-1)]=="]"):
-                    creation_log_content=creation_log_content[2:]
-                    creation_log_content=creation_log_content[:-2]
-                (status,creation_log_message)=creation_log_content.split(',')
-                (tag,body)=creation_log_message.split(':')
-                decode_mesage=urllib.unquote(body)
-                decode_mesage=decode_mesage.split("\n")
-                result_list=[]
-                for lines in decode_mesage :
-                    if 'exec-result:' in lines:
-                        result_list.append(lines.replace("exec-result: ", ""))
-                all_result = []
-                for instnum,result in enumerate(result_list):
-                    tag,ans = result.split()
-                    ans=urllib.unquote(ans)
-                    ans=ans.replace("\n", "")
-                    ins,guest,num,var=tag.split(",")
-                    ins_num=ins.replace("ins", "")
-                    user_def = guest+','+num+','+var
-                    all_result.append({int(ins_num):{user_def:ans}})
-                meta_answer_dic={}
-                for inst in all_result:
-                    for i in inst:
-                        try:
-                            meta_answer_dic[i].append(inst[i])
-                        except:
-                            meta_answer_dic[i]=[inst[i]]
-                #############################################################################
-                # End parse GET_CR_CREATION_LOG & store "exec-result:"
-                #############################################################################
-
-            except IOError as error:
-                print "* ERROR: trngsrv: File error: %s." % (error)
-                self.removePendingSession(cyber_range_id)
-                self.respond_error(Storyboard.CONTENT_LOADING_ERROR)
+            if not job_id:
+                self.respond_error(Storyboard.JOB_ID_MISSING_ERROR)
                 return
 
-            ########################################
-            # Handle content upload
-            content_file_name = training_info.get_content_file_name(scenario, level)
-            if content_file_name == None:
-                self.removePendingSession(cyber_range_id)
-                self.respond_error(Storyboard.CONTENT_IDENTIFICATION_ERROR)
+            job_representation = job_table.get_job_representation(job_id, user_id)
+            if not job_representation:
+                self.respond_error(Storyboard.JOB_ID_INVALID_ERROR + ": " + job_id)
                 return
 
-            content_file_name = DATABASE_DIR + content_file_name
-
-            if DEBUG:
-                print "* DEBUG: trngsrv: Training content file: %s" % (content_file_name)
-
-            # Open the content file
-            try:
-                content_file = open(content_file_name, "r")
-                content_file_content = content_file.read()
-                content_file.close()
-
-            except IOError as error:
-                print "* ERROR: trngsrv: File error: %s." % (error)
-                self.removePendingSession(cyber_range_id)
-                self.respond_error(Storyboard.CONTENT_LOADING_ERROR)
-                return
+            response_data = json.dumps([job_representation])
 
-            #############################################################################
-            # Loop for meta_answer
-            #############################################################################
-            # test code for New syntax as meta_answer by rive3
-            try:
-                for inst in range(instance_count_value):
-                    meta_answers={}
-                    for meta_answer_par_inst in meta_answer_dic[inst+1]:
-                        meta_answers.update(meta_answer_par_inst)
-                    content_template=Meta_answer_template(content_file_content)
-                    if DEBUG:
-                        print meta_answers
-                    patched_content=content_template.safe_substitute(meta_answers)
-                    content_list = yaml.load(patched_content)
-                    try:
-                        #change 2 dic type
-                        for i in content_list:
-                            if type(i) != dict:
-                                logging.error("Incorrect format")
-                            for j in i:
-                                #top level tag (training)
-                                for k in i[j]:
-                                    # training section
-                                    for quest in k["questions"]:
-                                        # search keys
-                                        for keys in list(quest):
-                                            if(keys=="meta_answer"):
-                                                try:
-                                                    del quest["answer"]
-                                                except:
-                                                    pass
-                                                finally:
-                                                    quest["answer"]=quest["meta_answer"]
-                                                del quest["meta_answer"]
-
-                    except (IOError, yaml.YAMLError) as e:
-                        logging.error("General error: " + str(e))
-                        self.removePendingSession(cyber_range_id)
-                        self.respond_error(Storyboard.INSTANTIATION_SERVER_ERROR)
-                        return
-                    content_file_description=yaml.dump(content_list, default_flow_style=False)
-                    try:
-                        # Note: creating a dictionary as below does not
-                        # preserve the order of the parameters, but this has
-                        # no negative influence in our implementation
-                        query_tuples = {
-                            query.Parameters.USER: user_id,
-                            query.Parameters.ACTION: query.Parameters.UPLOAD_CONTENT,
-                            query.Parameters.DESCRIPTION_FILE: content_file_description,
-                            query.Parameters.RANGE_ID: cyber_range_id
-                        }
-
-                        query_params = urllib.urlencode(query_tuples)
-                        print "* INFO: trngsrv: Send upload request to content server %s." % (CONTENT_SERVER_URL)
-                        if DEBUG:
-                            print "* DEBUG: trngsrv: POST parameters: %s" % (query_params)
-                        data_stream = urllib.urlopen(CONTENT_SERVER_URL, query_params)
-                        data = None
-                        data = data_stream.read()
-                        if DEBUG:
-                            print "* DEBUG: trngsrv: Content server response body: %s" % (data)
-
-                        (status, activity_id) = query.Response.parse_server_response(data)
-
-                        if DEBUG:
-                            print("* DEBUG: trngsrv: Response status: {}".format(status))
-                            print("* DEBUG: trngsrv: Response activity_id: {}".format(activity_id))
-
-                        if status == Storyboard.SERVER_STATUS_SUCCESS:
-                            # Store activity id in session description
-                            session_name = "Training Session #%s" % (cyber_range_id)
-                            crt_time = time.asctime()
-                            print "* INFO: trngsrv: Instantiation successful => save training session: %s (time: %s)." % (session_name, crt_time)
-
-                            # Synchronize access to active sessions list
-                            self.lock_active_sessions.acquire()
-                            try:
-                                # Read session info
-                                session_info = sessinfo.SessionInfo()
-                                session_info.parse_YAML_file(ACTIVE_SESSIONS_FILE)
-
-                                # Add new session and save to file
-                                # Scenarios and levels should be given as arrays,
-                                # so we convert values to arrays when passing arguments
-                                session_info.add_session(session_name, cyber_range_id, user_id,
-                                                         crt_time, ttype, [scenario], [level],
-                                                         language, instance_count, activity_id)
-                                session_info.write_YAML_file(ACTIVE_SESSIONS_FILE)
-                            finally:
-                                self.lock_active_sessions.release()
-                                #pass
-                        else:
-                            print "* ERROR: trngsrv: Content upload error."
-                            self.removePendingSession(cyber_range_id)
-                            self.respond_error(Storyboard.CONTENT_UPLOAD_ERROR)
-                            return
-
-                        # Save the response data
-                        contsrv_response = data
-
-                        if DEBUG:
-                            print "* DEBUG: trngsrv: contsrv response: %s" %(contsrv_response)
-                            print "* DEBUG: trngsrv: instsrv response: %s" %(instsrv_response)
-
-                        # Prepare the response as a message
-                        # TODO: Should create a function to handle this
-                        if message:
-                            response_data = '[{{"{0}": "{1}"}}]'.format(Storyboard.SERVER_MESSAGE_KEY, message)
-                        else:
-                            response_data = None
-
-                    except IOError as error:
-                        print "* ERROR: trngsrv: URL error: %s." % (error)
-                        self.removePendingSession(cyber_range_id)
-                        self.respond_error(Storyboard.CONTENT_SERVER_ERROR)
-                        return
-            except Exception as e:
-                print "* ERROR: trngsrv: loop error: %s." % (e)
-                self.removePendingSession(cyber_range_id)
-                self.respond_error(Storyboard.CONTENT_SERVER_ERROR)
-                return
+        ####################################################################
+        # Retrieve the status of the server, including the state of the
+        # circuit breakers of the downstream servers
+        elif action == query.Parameters.GET_SERVER_STATUS:
+
+            server_status = {
+                "downstream_servers": [downstream_breakers[server_url].get_representation()
+                                       for server_url in sorted(downstream_breakers)],
+                "downstream_connections": downstream_pool.get_statistics(),
+                "instantiation_servers": shard_pool.get_representation(),
+                "instantiation_server_states": get_instantiation_server_states(user_id, self.deadline)
+            }
+            response_data = json.dumps([server_status])
 
         ####################################################################
         # Retrieve saved training configurations action
@@ -921,22 +1485,12 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         ####################################################################
         # Retrieve active training sessions action
-        # Note: Requires synchronized access to active sessions list        
+        # Note: The session store handles synchronization internally
         elif action == query.Parameters.GET_SESSIONS: 
 
-            self.lock_active_sessions.acquire()
-            try:
-                # Read session info
-                session_info = sessinfo.SessionInfo()
-                session_info.parse_YAML_file(ACTIVE_SESSIONS_FILE)
-
-                # TODO: Catch error in operation above 
-            finally:
-                self.lock_active_sessions.release()
-
             # Convert the training session info to the external JSON
             # representation that will be provided to the client
-            response_data = session_info.get_JSON_representation(user_id)
+            response_data = session_store.get_JSON_representation(user_id)
 
         ####################################################################
         # End training variation action
@@ -959,105 +1513,28 @@ class RequestHandler(BaseHTTPRequestHandler):
                      return
             finally:
                 self.lock_active_sessions.release()
-                ########################################
-            # Handle content removal
-            for aclist in activity_id_list:
-                try:
-                    # Note: Creating a dictionary as below does not
-                    # preserve the order of the parameters, but this has
-                    # no negative influence in our implementation
-                    query_tuples = {
-                        query.Parameters.USER: user_id,
-                        query.Parameters.ACTION: query.Parameters.REMOVE_CONTENT,
-                        query.Parameters.RANGE_ID: range_id,
-                        query.Parameters.ACTIVITY_ID: aclist
-                    }
-
-                    query_params = urllib.urlencode(query_tuples)
-                    print "* INFO: trngsrv: Send removal request to content server %s." % (CONTENT_SERVER_URL)
-                    print "* INFO: trngsrv: POST parameters: %s" % (query_params)
-                    data_stream = urllib.urlopen(CONTENT_SERVER_URL, query_params)
-                    data = data_stream.read()
-                    if DEBUG:
-                        print "* DEBUG: trngsrv: Content server response body: %s" % (data)
-
-                    # We don't parse the response since the content server does not provide
-                    # a uniformly formatted one; instead we only check for SUCCESS key
-                    if Storyboard.SERVER_STATUS_SUCCESS in data:
-                        # Nothing to do on success as there is no additional info provided
-                        pass
-                    else:
-                        print "* ERROR: trngsrv: Content removal error."
-                        self.respond_error(Storyboard.CONTENT_REMOVAL_ERROR)
-                        return
-
-                    # Save the response data
-                    contsrv_response = data
-
-                except IOError as error:
-                    print "* ERROR: trngsrv: URL error: %s." % (error)
-                    self.respond_error(Storyboard.CONTENT_SERVER_ERROR)
-                    return
-
-            ########################################
-            # Handle range destruction
-            try:
-                # Note: creating a dictionary as below does not
-                # preserve the order of the parameters, but this has
-                # no negative influence in our implementation
-                query_tuples = {
-                    query.Parameters.USER: user_id,
-                    query.Parameters.ACTION: query.Parameters.DESTROY_RANGE,
-                    query.Parameters.RANGE_ID: range_id
-                }
-
-                query_params = urllib.urlencode(query_tuples)
-                print "* INFO: trngsrv: Send destroy request to instantiation server %s." % (INSTANTIATION_SERVER_URL)
-                print "* INFO: trngsrv: POST parameters: %s" % (query_params)
-                data_stream = urllib.urlopen(INSTANTIATION_SERVER_URL, query_params)
-                data = data_stream.read()
-                if DEBUG:
-                    print "* DEBUG: trngsrv: Instantiation server response body: %s" % (data)
-
-                (status, message) = query.Response.parse_server_response(data)
-
-                if status == Storyboard.SERVER_STATUS_SUCCESS:
-
-                    self.lock_active_sessions.acquire()
-                    try:
-                        # Read session info
-                        session_info = sessinfo.SessionInfo()
-                        session_info.parse_YAML_file(ACTIVE_SESSIONS_FILE)
-                        for ac in activity_id_list:
-                            # Remove session and save to file
-                            if not session_info.remove_session_variation(range_id, user_id,ac):
-                                print "* ERROR: Cannot remove training session %s." % (range_id)
-                                self.respond_error(Storyboard.SESSION_INFO_CONSISTENCY_ERROR)
-                                return
-                            else:
-                                session_info.write_YAML_file(ACTIVE_SESSIONS_FILE)
-                    finally:
-                        self.lock_active_sessions.release()
-
-                else:
-                    print "* ERROR: trngsrv: Range destruction error: %s." % (message)
-                    self.respond_error(Storyboard.DESTRUCTION_ERROR)
-                    return
 
-                instsrv_response = data
+            # Fail fast if a downstream server is unavailable
+            instantiation_server_urls = self.get_instantiation_server_urls(range_id, user_id)
+            error_message = check_downstream_servers([CONTENT_SERVER_URL] + instantiation_server_urls)
+            if error_message:
+                self.respond_error(error_message)
+                return
 
-                if DEBUG:
-                    print "* DEBUG: trngsrv: contsrv response: %s" %(contsrv_response)
-                    print "* DEBUG: trngsrv: instsrv response: %s" %(instsrv_response)
+            # Remove the content of all instances, destroy the range and
+            # remove the sessions
+            error_message = END_TRAINING_VARIATION_PIPELINE.run({"user_id": user_id, "range_id": range_id,
+                                                                 "activity_ids": activity_id_list,
+                                                                 "instantiation_server_urls": instantiation_server_urls,
+                                                                 "deadline": self.deadline})
+            if error_message:
+                self.respond_error(error_message)
+                return
 
-                # Prepare the response: no data needs to be returned,
-                # hence we set the content to None
-                response_data = None
+            # Prepare the response: no data needs to be returned,
+            # hence we set the content to None
+            response_data = None
 
-            except IOError as error:
-                print "* ERROR: trngsrv: URL error: %s." % (error)
-                self.respond_error(Storyboard.INSTANTIATION_SERVER_ERROR)
-                return
         ####################################################################
         # End training action
         # Note: Requires synchronized access to active sessions list        
@@ -1080,106 +1557,27 @@ class RequestHandler(BaseHTTPRequestHandler):
             finally:
                 self.lock_active_sessions.release()
 
-
-            ########################################
-            # Handle content removal
-            try:
-                # Note: Creating a dictionary as below does not
-                # preserve the order of the parameters, but this has
-                # no negative influence in our implementation
-                query_tuples = {
-                    query.Parameters.USER: user_id,
-                    query.Parameters.ACTION: query.Parameters.REMOVE_CONTENT,
-                    query.Parameters.RANGE_ID: range_id,
-                    query.Parameters.ACTIVITY_ID: activity_id
-                }
-
-                query_params = urllib.urlencode(query_tuples)
-                print "* INFO: trngsrv: Send removal request to content server %s." % (CONTENT_SERVER_URL) 
-                print "* INFO: trngsrv: POST parameters: %s" % (query_params)
-                data_stream = urllib.urlopen(CONTENT_SERVER_URL, query_params)
-                data = data_stream.read()
-                if DEBUG:
-                    print "* DEBUG: trngsrv: Content server response body: %s" % (data)
-
-                # We don't parse the response since the content server does not provide
-                # a uniformly formatted one; instead we only check for SUCCESS key
-                if Storyboard.SERVER_STATUS_SUCCESS in data:
-                    # Nothing to do on success as there is no additional info provided
-                    pass
-                else:
-                    print "* ERROR: trngsrv: Content removal error."
-                    self.respond_error(Storyboard.CONTENT_REMOVAL_ERROR)
-                    return
-
-                # Save the response data
-                contsrv_response = data
-
-            except IOError as error:
-                print "* ERROR: trngsrv: URL error: %s." % (error)
-                self.respond_error(Storyboard.CONTENT_SERVER_ERROR)
+            # Fail fast if a downstream server is unavailable
+            instantiation_server_urls = self.get_instantiation_server_urls(range_id, user_id)
+            error_message = check_downstream_servers([CONTENT_SERVER_URL] + instantiation_server_urls)
+            if error_message:
+                self.respond_error(error_message)
                 return
 
-            ########################################
-            # Handle range destruction
-            try:
-                # Note: creating a dictionary as below does not
-                # preserve the order of the parameters, but this has
-                # no negative influence in our implementation
-                query_tuples = {
-                    query.Parameters.USER: user_id,
-                    query.Parameters.ACTION: query.Parameters.DESTROY_RANGE,
-                    query.Parameters.RANGE_ID: range_id
-                }
-
-                query_params = urllib.urlencode(query_tuples)
-                print "* INFO: trngsrv: Send destroy request to instantiation server %s." % (INSTANTIATION_SERVER_URL) 
-                print "* INFO: trngsrv: POST parameters: %s" % (query_params)
-                data_stream = urllib.urlopen(INSTANTIATION_SERVER_URL, query_params)
-                data = data_stream.read()
-                if DEBUG:
-                    print "* DEBUG: trngsrv: Instantiation server response body: %s" % (data)
-
-                (status, message) = query.Response.parse_server_response(data)
-
-                if status == Storyboard.SERVER_STATUS_SUCCESS:
-
-                    self.lock_active_sessions.acquire()
-                    try:
-                        # Read session info
-                        session_info = sessinfo.SessionInfo()
-                        session_info.parse_YAML_file(ACTIVE_SESSIONS_FILE)
-
-                        # Remove session and save to file
-                        if not session_info.remove_session(range_id, user_id):
-                            print "* ERROR: Cannot remove training session %s." % (range_id)
-                            self.respond_error(Storyboard.SESSION_INFO_CONSISTENCY_ERROR)
-                            return
-                        else:
-                            session_info.write_YAML_file(ACTIVE_SESSIONS_FILE)
-                    finally:
-                        self.lock_active_sessions.release()
-
-                else:
-                    print "* ERROR: trngsrv: Range destruction error: %s." % (message)
-                    self.respond_error(Storyboard.DESTRUCTION_ERROR)
-                    return
-
-                instsrv_response = data
 
-                if DEBUG:
-                    print "* DEBUG: trngsrv: contsrv response: %s" %(contsrv_response)
-                    print "* DEBUG: trngsrv: instsrv response: %s" %(instsrv_response)
-
-                # Prepare the response: no data needs to be returned,
-                # hence we set the content to None
-                response_data = None
-
-            except IOError as error:
-                print "* ERROR: trngsrv: URL error: %s." % (error)
-                self.respond_error(Storyboard.INSTANTIATION_SERVER_ERROR)
+            # Remove the content, destroy the range and remove the session
+            error_message = END_TRAINING_PIPELINE.run({"user_id": user_id, "range_id": range_id,
+                                                       "activity_id": activity_id,
+                                                       "instantiation_server_urls": instantiation_server_urls,
+                                                       "deadline": self.deadline})
+            if error_message:
+                self.respond_error(error_message)
                 return
 
+            # Prepare the response: no data needs to be returned,
+            # hence we set the content to None
+            response_data = None
+
         ####################################################################
         # Catch unknown actions
         else:
@@ -1192,38 +1590,41 @@ class RequestHandler(BaseHTTPRequestHandler):
             time.sleep(sleep_time)
 
         # Respond to requester with SUCCESS
-        self.respond_success(response_data)
+        if response_body:
+            self.respond_body(response_body)
+        else:
+            self.respond_success(response_data)
 
-    def removePendingSession(self, cyber_range_id):
-        # Synchronize access to active sessions list related variable
-        self.lock_active_sessions.acquire()
-        try:
-            self.pending_sessions.remove(cyber_range_id)
-        finally:
-            self.lock_active_sessions.release()
+    # Get the URLs of the instantiation servers that manage the parts of the
+    # range of a session; sessions created before sharding was used are
+    # managed by the default server
+    def get_instantiation_server_urls(self, range_id, user_id):
+
+        return session_store.get_shards(range_id, user_id) or [shard_pool.get_default_url()]
+
+    # Reserve a cyber range id for the current request; return a
+    # RangeIdReservation object, or None if all ids are in use
+    def reserve_range_id(self):
+
+        reservation = range_id_allocator.reserve()
+        if reservation:
+            self.reservations.append(reservation)
+        return reservation
 
     # Respond to requester that operation was successful
     def respond_success(self, response_data):
 
+        self.respond_body(build_success_response(response_data))
+
+    # Respond to requester with an already prepared response body
+    def respond_body(self, response_body):
+
         # Send response header to requester (triggers log_message())
         self.send_response(HTTP_STATUS_OK)
         self.send_header("Content-type", "text/html")
+        self.send_header("Content-Length", str(len(response_body)))
         self.end_headers()
 
-        # Prepare success status
-        response_status = '"{0}": "{1}"'.format(Storyboard.SERVER_STATUS_KEY, Storyboard.SERVER_STATUS_SUCCESS)
-
-        # If response data exists, we prepend the success status to dictionary,
-        # otherwise we make a dictionary containing only the status
-        if response_data:
-            # NOTE: We assume the response data is an array containing
-            # a dictionary, hence of the form '[{"key": "value"...}]';
-            # in order to merge it with the response status, we must
-            # skip the first 2 characters
-            response_body = '[{' + response_status + ", " + response_data[2:]
-        else:
-            response_body = '[{' + response_status + '}]'
-
         # Send response to requester
         self.wfile.write(response_body)
 
@@ -1234,12 +1635,6 @@ class RequestHandler(BaseHTTPRequestHandler):
     # Respond to requester that operation encountered an error
     def respond_error(self, message):
 
-        # Send response header to requester (triggers log_message())
-        # Note: Error information is included in standard successful responses
-        self.send_response(HTTP_STATUS_OK)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
-
         # Prepare error status
         response_status = '"{0}": "{1}"'.format(Storyboard.SERVER_STATUS_KEY, Storyboard.SERVER_STATUS_ERROR)
 
@@ -1251,6 +1646,13 @@ class RequestHandler(BaseHTTPRequestHandler):
         else:
             response_body = '[{' + response_status + '}]'
 
+        # Send response header to requester (triggers log_message())
+        # Note: Error information is included in standard successful responses
+        self.send_response(HTTP_STATUS_OK)
+        self.send_header("Content-type", "text/html")
+        self.send_header("Content-Length", str(len(response_body)))
+        self.end_headers()
+
         # Send response to requester
         self.wfile.write(response_body)
 
@@ -1258,12 +1660,6 @@ class RequestHandler(BaseHTTPRequestHandler):
         print "* INFO: trngsrv: Server response body: %s" % (response_body)
         print Storyboard.SEPARATOR2
 
-    #########################################################################
-    # POST request to another server (the instantiation server)
-    #def post_request():
-    #    # Initialize variables
-    #    POST_parameters = None
-
 
 # Print usage information
 def usage():
@@ -1271,14 +1667,44 @@ def usage():
     print "USAGE: trngsrv.py [options]\n"
 
     print "OPTIONS:"
-    print "-h, --help         Display help\n"
-
-
-# Use threads to handle multiple clients
-# Note: By using ForkingMixIn instead of ThreadingMixIn,
-# separate processes are used instead of threads
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread."""
+    print "-h, --help         Display help"
+    print "-e, --engine <NAME>"
+    print "                   Serving engine: %s (default: %s)" % (" or ".join(SERVER_ENGINES), SERVER_ENGINE)
+    print "-i, --part-size <NUMBER>"
+    print "                   Number of instances above which a range is split over instantiation servers (default: %d);" % (
+        MAX_PART_INSTANCES)
+    print "                   ranges are split only if several servers are defined via -s"
+    print "-j, --journal      Persist active session changes via an append-only journal"
+    print "-l, --placement <POLICY>"
+    print "                   Policy for choosing the instantiation server of a range: %s (default: %s)" % (
+        ", ".join(shardpool.PLACEMENT_POLICIES), PLACEMENT_POLICY)
+    print "-m, --max-sessions <NUMBER>"
+    print "                   Maximum number of active sessions (default: %d); must be lower than" % (MAX_SESSIONS)
+    print "                   the first warm range id of the instantiation servers (instsrv.py -f)"
+    print "-p, --parallelism <NUMBER>"
+    print "                   Maximum number of concurrent content server requests (default: %d)" % (CONTENT_PARALLELISM)
+    print "-q, --queue <NUMBER>"
+    print "                   Number of connections (threads engine) or requests (async engine) that can"
+    print "                   wait for a worker (default: %d)" % (ACCEPT_QUEUE_SIZE)
+    print "-s, --shards <FILE>"
+    print "                   File defining the instantiation servers (default: single server %s)" % (
+        INSTANTIATION_SERVER_URL)
+    print "-t, --timeout <SECONDS>"
+    print "                   Time available for handling a request or background job (default: %d)" % (REQUEST_TIMEOUT)
+    print "-w, --workers <NUMBER>"
+    print "                   Number of worker threads that handle requests (default: %d)\n" % (WORKER_POOL_SIZE)
+
+
+# Set up SSL for the web server, depending on the serving engine
+def set_up_ssl(server, keyfile, certfile, ca_certs):
+
+    if SERVER_ENGINE == ASYNC_ENGINE:
+        # Connections are wrapped when accepted, so that the SSL handshake
+        # does not block the event loop
+        server.set_ssl_files(keyfile, certfile, ca_certs)
+    else:
+        server.socket = ssl.wrap_socket(server.socket, keyfile=keyfile, certfile=certfile,
+                                        ca_certs=ca_certs, server_side=True)
 
 
 #############################################################################
@@ -1286,13 +1712,27 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
 #############################################################################
 def main(argv):
 
+    global USE_SESSION_JOURNAL
+    global MAX_SESSIONS
+    global MAX_PART_INSTANCES
+    global CONTENT_PARALLELISM
+    global WORKER_POOL_SIZE
+    global ACCEPT_QUEUE_SIZE
+    global SERVER_ENGINE
+    global REQUEST_TIMEOUT
+    global PLACEMENT_POLICY
+    global SHARDS_FILE
+    global shard_pool
+
     print Storyboard.SEPARATOR3
     print "CyTrONE v%s: Integrated cybersecurity training framework" % (CYTRONE_VERSION)
     print Storyboard.SEPARATOR3
 
     # Parse command line arguments
     try:
-        opts, args = getopt.getopt(argv, "h", ["help"])
+        opts, args = getopt.getopt(argv, "he:i:jl:m:p:s:t:w:q:", ["help", "engine=", "part-size=", "journal", "placement=",
+                                                             "max-sessions=", "parallelism=", "shards=",
+                                                             "timeout=", "workers=", "queue="])
     except getopt.GetoptError as err:
         print "* ERROR: trngsrv: Command-line argument error: %s" % (str(err))
         usage()
@@ -1301,6 +1741,114 @@ def main(argv):
         if opt in ("-h", "--help"):
             usage()
             sys.exit()
+        elif opt in ("-e", "--engine"):
+            if arg not in SERVER_ENGINES:
+                print "* ERROR: trngsrv: Invalid serving engine: %s" % (arg)
+                usage()
+                sys.exit(1)
+            SERVER_ENGINE = arg
+        elif opt in ("-j", "--journal"):
+            USE_SESSION_JOURNAL = True
+        elif opt in ("-l", "--placement"):
+            if arg not in shardpool.PLACEMENT_POLICIES:
+                print "* ERROR: trngsrv: Invalid placement policy: %s" % (arg)
+                usage()
+                sys.exit(1)
+            PLACEMENT_POLICY = arg
+        elif opt in ("-s", "--shards"):
+            SHARDS_FILE = arg
+        elif opt in ("-i", "--part-size"):
+            try:
+                MAX_PART_INSTANCES = int(arg)
+                if MAX_PART_INSTANCES < 1:
+                    raise ValueError
+            except ValueError:
+                print "* ERROR: trngsrv: Invalid number of instances: %s" % (arg)
+                usage()
+                sys.exit(1)
+        elif opt in ("-m", "--max-sessions"):
+            try:
+                MAX_SESSIONS = int(arg)
+                if MAX_SESSIONS < 1:
+                    raise ValueError
+            except ValueError:
+                print "* ERROR: trngsrv: Invalid maximum number of sessions: %s" % (arg)
+                usage()
+                sys.exit(1)
+        elif opt in ("-p", "--parallelism"):
+            try:
+                CONTENT_PARALLELISM = int(arg)
+                if CONTENT_PARALLELISM < 1:
+                    raise ValueError
+            except ValueError:
+                print "* ERROR: trngsrv: Invalid content parallelism: %s" % (arg)
+                usage()
+                sys.exit(1)
+        elif opt in ("-t", "--timeout"):
+            try:
+                REQUEST_TIMEOUT = float(arg)
+                if REQUEST_TIMEOUT <= 0:
+                    raise ValueError
+            except ValueError:
+                print "* ERROR: trngsrv: Invalid request timeout: %s" % (arg)
+                usage()
+                sys.exit(1)
+        elif opt in ("-w", "--workers"):
+            try:
+                WORKER_POOL_SIZE = int(arg)
+                if WORKER_POOL_SIZE < 1:
+                    raise ValueError
+            except ValueError:
+                print "* ERROR: trngsrv: Invalid number of workers: %s" % (arg)
+                usage()
+                sys.exit(1)
+        elif opt in ("-q", "--queue"):
+            try:
+                ACCEPT_QUEUE_SIZE = int(arg)
+                if ACCEPT_QUEUE_SIZE < 1:
+                    raise ValueError
+            except ValueError:
+                print "* ERROR: trngsrv: Invalid queue size: %s" % (arg)
+                usage()
+                sys.exit(1)
+
+    # Load the active training sessions; they are only read from file
+    # at startup, and kept in memory afterwards
+    session_store.use_journal = USE_SESSION_JOURNAL
+    if not session_store.load():
+        print "* ERROR: trngsrv: Cannot load active sessions => abort."
+        sys.exit(1)
+
+    content_executor.max_workers = CONTENT_PARALLELISM
+
+    # Cyber range ids of active sessions are unavailable for new sessions
+    range_id_allocator.initialize(MAX_SESSIONS, session_store.get_id_list_int())
+
+    # Load the instantiation servers, if a shards file is given, and count
+    # the ranges of the active sessions on each server
+    if SHARDS_FILE:
+        shards = shardpool.load_shards(SHARDS_FILE)
+        if not shards:
+            print "* ERROR: trngsrv: Cannot load instantiation servers => abort."
+            sys.exit(1)
+    else:
+        shards = [shardpool.Shard(INSTANTIATION_SERVER_URL)]
+    shard_pool = shardpool.ShardPool(shards, PLACEMENT_POLICY)
+    for shard_urls in session_store.get_range_shards().values():
+        for shard_url in shard_urls or [shard_pool.get_default_url()]:
+            shard_pool.add_range(shard_url)
+    print "* INFO: trngsrv: Instantiation servers: %s." % (shard_pool)
+
+    # Each instantiation server has its own circuit breaker
+    for shard in shard_pool.shards:
+        downstream_breakers[shard.url] = health.CircuitBreaker("instantiation server %s" % (shard.url),
+                                                               BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+        downstream_unavailable_errors[shard.url] = Storyboard.INSTANTIATION_SERVER_UNAVAILABLE_ERROR
+
+    # Probe the health of the content and instantiation servers in the
+    # background, so that their circuit breakers reflect outages even
+    # when no requests are sent
+    health_monitor.start()
 
     try:
 
@@ -1312,10 +1860,18 @@ def main(argv):
         server_port = SERVER_PORT
 
         multi_threading = ""
-        if ENABLE_THREADS:
-            server = ThreadedHTTPServer((server_address, server_port),
-                                        RequestHandler)
-            multi_threading = " (multi-threading mode)"
+        if SERVER_ENGINE == ASYNC_ENGINE:
+            server = asyncsrv.AsyncHTTPServer((server_address, server_port),
+                                              RequestHandler, WORKER_POOL_SIZE, KEEP_ALIVE_TIMEOUT,
+                                              ACCEPT_QUEUE_SIZE)
+            multi_threading = " (asynchronous mode: %d workers, queue size %d)" % (
+                WORKER_POOL_SIZE, ACCEPT_QUEUE_SIZE)
+        elif ENABLE_THREADS:
+            server = httpsrv.PooledHTTPServer((server_address, server_port),
+                                              RequestHandler, WORKER_POOL_SIZE, ACCEPT_QUEUE_SIZE,
+                                              idle_timeout=KEEP_ALIVE_TIMEOUT)
+            multi_threading = " (multi-threading mode: %d workers, queue size %d)" % (
+                WORKER_POOL_SIZE, ACCEPT_QUEUE_SIZE)
         else:
             server = HTTPServer((server_address, server_port), RequestHandler)
 
@@ -1334,11 +1890,11 @@ def main(argv):
             else:
                 ca_certs = None
             try:
-                server.socket = ssl.wrap_socket (server.socket, keyfile=key, certfile=crt, ca_certs=ca_certs, server_side=True)
+                set_up_ssl(server, key, crt, ca_certs)
             except:
                 print("* INFO: trngsrv: can't use keyfile , certfile , ca_certs => try to use default keyfile , certfile")
                 try:
-                    server.socket = ssl.wrap_socket (server.socket, keyfile="cytrone.key", certfile="cytrone.crt", ca_certs=None, server_side=True)
+                    set_up_ssl(server, "cytrone.key", "cytrone.crt", None)
                 except:
                     print("* INFO: trngsrv: can't set up SSL socket => set up SSL disable")
                     Storyboard.ENABLE_HTTPS = False
@@ -1359,6 +1915,9 @@ def main(argv):
         print '* INFO: trngsrv: Interrupted via ^C => shut down server.'
         server.socket.close()
 
+    # Make sure all session changes are folded into the session file
+    session_store.close()
+
     print "* INFO: trngsrv: CyTrONE training server ended execution."
 
 #############################################################################
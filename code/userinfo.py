@@ -5,8 +5,12 @@
 
 # External imports
 import yaml
+import copy
 #import string
 
+# Internal imports
+import filecache
+
 
 # Various constants
 SEPARATOR = "-----------------------------------------------------------------"
@@ -118,17 +122,25 @@ class User:
     
 
     # Replace variables in a range specification based on user information
-    def replace_variables(self, range_file_content, cyber_range_id, instance_count):
+    # The host settings of the user can be overridden via a dictionary of
+    # variable values, for instance when the range is created on another host
+    def replace_variables(self, range_file_content, cyber_range_id, instance_count, host_settings={}):
 
         return_string = range_file_content
 
         #ADDR_SUFFIX = "SFX"
 
+        # Values are collected locally, so that the user object itself is
+        # not modified, and it can be safely shared between requests
+        variable_values = {}
+        for variable in self.DEFINED_VARIABLES:
+            variable_values[variable] = host_settings.get(variable, getattr(self, variable))
+
         # Assign cyber range id to internal variable
-        setattr(self, Keys.CLONE_RANGE_ID, cyber_range_id)
+        variable_values[Keys.CLONE_RANGE_ID] = cyber_range_id
         
         # Derive internal variables that depend on instance_count
-        setattr(self, Keys.CLONE_INSTANCE_NUMBER, str(instance_count))
+        variable_values[Keys.CLONE_INSTANCE_NUMBER] = str(instance_count)
         #addr_list = ""
         #for i in range (1, instance_count+1):
         #    # Special handling of suffix
@@ -140,7 +152,7 @@ class User:
         # Do replace all variables with their values
         for variable in self.ALL_VARIABLES:
             variable_name = "{{ " + variable + " }}"
-            variable_value = getattr(self, variable)
+            variable_value = variable_values[variable]
 
             if DO_DEBUG:
                 print "* DEBUG: userinfo: name=%s value=%s" % (variable_name, variable_value)
@@ -168,8 +180,14 @@ class User:
 #############################################################################
 class UserInfo:
 
-    # List of users (User objects)
-    users = []
+    # Initialize object
+    def __init__(self):
+
+        # List of users (User objects)
+        self.users = []
+
+        # Index of users by id (dictionary of User objects)
+        self.user_index = {}
 
     
     # Parse a YAML information in a file and store values into the
@@ -211,6 +229,7 @@ class UserInfo:
     def parse_info(self, info):
 
         self.users = []
+        self.user_index = {}
         
         # Get data for all users from info
         for data in info:
@@ -232,6 +251,13 @@ class UserInfo:
             user = User(user_info)
             self.users.append(user)
 
+            # Only the first user with a given id is indexed, as it
+            # is the one that was used before the index was introduced
+            if user.id in self.user_index:
+                print "* WARNING: userinfo: Duplicate user id: %s." % (user.id)
+            else:
+                self.user_index[user.id] = user
+
             if DO_DEBUG:
                 print "* DEBUG: userinfo: USER: %s" % (user)
                 
@@ -243,9 +269,15 @@ class UserInfo:
  
     # Get a user identified by id if it exists
     def get_user(self, user_id):
-        for user in self.users:
-            if user.id == user_id:
-                return user
+        return self.user_index.get(user_id, None)
+
+
+    # Get a copy of the user identified by id if it exists; the copy can
+    # be modified during a request without affecting the shared object
+    def get_user_copy(self, user_id):
+        user = self.user_index.get(user_id, None)
+        if user:
+            return copy.copy(user)
             
         return None
 
@@ -264,6 +296,33 @@ class UserInfo:
         print SEPARATOR
 
 
+#############################################################################
+# Load user information from a YAML file
+# Return a UserInfo object, or None in case of error
+#############################################################################
+def load_user_info(yaml_file_name):
+
+    user_info = UserInfo()
+    try:
+        if user_info.parse_YAML_file(yaml_file_name):
+            return user_info
+    except (AssertionError, AttributeError, TypeError, NameError):
+        print "* ERROR: userinfo: Invalid user information in file %s." % (yaml_file_name)
+
+    return None
+
+
+#############################################################################
+# Manage a shared user information object that is loaded from file only
+# when the file changes
+#############################################################################
+class UserInfoCache(filecache.FileCache):
+
+    # Initialize object for the given user information file
+    def __init__(self, yaml_file_name):
+        filecache.FileCache.__init__(self, yaml_file_name, load_user_info)
+
+
 #############################################################################
 # Testing code for the classes in this file
 #
@@ -273,7 +332,7 @@ class UserInfo:
 if __name__ == '__main__':
     try:
 
-        enabled = [True]
+        enabled = [True, True]
         DATABASE_DIR = "../database/"
 
         #####################################################################
@@ -287,6 +346,20 @@ if __name__ == '__main__':
             user_info = UserInfo()
             user_info.parse_YAML_file(TEST_FILE)
             user_info.pretty_print()
+
+        #####################################################################
+        # TEST #2
+        if enabled[1]:
+            TEST_FILE = DATABASE_DIR + "users.yml"
+            print SEPARATO2
+            print "TEST #2: Get cached user information from YAML file: %s." % (
+                TEST_FILE)
+            print SEPARATO2
+            user_info_cache = UserInfoCache(TEST_FILE)
+            for index in range(10):
+                user_info = user_info_cache.get()
+            user_info.pretty_print()
+            print "Cache statistics: %s" % (user_info_cache)
     
     except IOError as error:
         print "* ERROR: userinfo: %s." % (error)
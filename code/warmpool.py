@@ -0,0 +1,514 @@
+
+#############################################################################
+# Classes for keeping a pool of cyber ranges that are instantiated in
+# advance (warm ranges), so that requests for the same range description
+# are answered without waiting for CyRIS
+#############################################################################
+
+# External imports
+from collections import deque
+import hashlib
+import threading
+import time
+import yaml
+
+# Internal imports
+import sessinfo
+
+#############################################################################
+# Constants
+#############################################################################
+
+# Keys used in the warm pool file
+WARM_POOL_KEY = "warm_pool"
+NAME_KEY = "name"
+RANGE_KEY = "range"
+USER_KEY = "user"
+INSTANCES_KEY = "instances"
+SIZE_KEY = "size"
+
+# Keys used in the warm pool state file
+READY_KEY = "ready"
+CREATING_KEY = "creating"
+CLAIMED_KEY = "claimed"
+SURPLUS_KEY = "surplus"
+
+# Keys used in range descriptions
+CLONE_SETTINGS_KEY = "clone_settings"
+RANGE_ID_KEY = "range_id"
+
+# Default id of the first warm range; warm range ids must not overlap with
+# the range ids assigned by the training server, hence its maximum number
+# of sessions must be lower than this id
+DEFAULT_FIRST_RANGE_ID = 200
+
+# Default interval between checks whether the pool needs refilling (seconds)
+DEFAULT_REFILL_INTERVAL = 5
+
+# Number of recent refill times used for computing percentiles
+REFILL_SAMPLE_COUNT = 100
+
+# Debugging constants
+DO_DEBUG = False
+
+
+# Compute the key of a range description, which is the same for all the
+# descriptions that differ only by range id
+# Return the key, or None if the description cannot be parsed
+def get_template_key(description_file):
+
+    try:
+        sections = yaml.load(description_file)
+        for section in sections:
+            for clone_settings in section.get(CLONE_SETTINGS_KEY) or []:
+                clone_settings[RANGE_ID_KEY] = None
+        return hashlib.sha1(yaml.safe_dump(sections)).hexdigest()
+    except (yaml.YAMLError, AttributeError, TypeError) as error:
+        if DO_DEBUG:
+            print "* DEBUG: warmpool: Cannot parse range description: %s." % (error)
+        return None
+
+
+#############################################################################
+# Manage the information about a range description for which warm ranges
+# are kept
+#############################################################################
+class Template:
+
+    # Initialize object with the template name, the content of the range
+    # description file, the user whose settings are used, the number of
+    # instances, and the number of warm ranges to keep
+    def __init__(self, name, range_file_content, user_obj, instance_count, size):
+
+        self.name = name
+        self.range_file_content = range_file_content
+        self.user_obj = user_obj
+        self.instance_count = instance_count
+        self.size = size
+        self.key = get_template_key(self.get_description(0))
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    # Get the range description of a warm range with a given id
+    def get_description(self, range_id):
+
+        return self.user_obj.replace_variables(self.range_file_content, str(range_id), self.instance_count)
+
+    # Create a string representation of the template
+    def __str__(self):
+
+        return "%s (user: %s, instances: %d, size: %d)" % (self.name, self.user_obj.id,
+                                                            self.instance_count, self.size)
+
+
+# Load the warm pool templates from a YAML file; range description files
+# are located in a given directory, and user settings are taken from the
+# given user information
+# Return a list of Template objects, or None in case of error
+def load_templates(yaml_file_name, user_info, database_dir):
+
+    try:
+        with open(yaml_file_name, "r") as yaml_file:
+            info = yaml.load(yaml_file)
+    except (IOError, yaml.YAMLError) as error:
+        print "* ERROR: warmpool: Cannot load warm pool file '%s': %s." % (yaml_file_name, error)
+        return None
+
+    templates = []
+    try:
+        for data in info:
+            for template_info in data.get(WARM_POOL_KEY, []):
+                name = template_info[NAME_KEY]
+                user_obj = user_info.get_user(template_info[USER_KEY])
+                if not user_obj:
+                    raise ValueError("unknown user: %s" % (template_info[USER_KEY]))
+                instance_count = int(template_info.get(INSTANCES_KEY, 1))
+                size = int(template_info.get(SIZE_KEY, 1))
+                if instance_count < 1 or size < 0:
+                    raise ValueError("invalid number of instances or ranges for template %s" % (name))
+                with open(database_dir + template_info[RANGE_KEY], "r") as range_file:
+                    range_file_content = range_file.read()
+                template = Template(name, range_file_content, user_obj, instance_count, size)
+                if not template.key:
+                    raise ValueError("invalid range description for template %s" % (name))
+                templates.append(template)
+    except (IOError, AttributeError, KeyError, TypeError, ValueError) as error:
+        print "* ERROR: warmpool: Invalid warm pool file '%s': %s." % (yaml_file_name, error)
+        return None
+
+    return templates
+
+
+#############################################################################
+# Keep a number of warm ranges for each template, and hand them out to the
+# instantiation requests whose range description matches a template; the
+# range id of the request becomes an alias of the warm range id, which is
+# the id known to CyRIS
+#
+# The pool is refilled in a background thread, one range at a time and
+# only while the function is_idle (if provided) returns true; ranges are
+# created and destroyed via the functions instantiate(template, range_id)
+# and destroy(range_id), which return true on success; the pool state is
+# saved to a file, so that warm ranges are not lost when the server restarts
+#############################################################################
+class WarmPool:
+
+    # Initialize object with the templates, the state file, the functions
+    # that create and destroy warm ranges, and the pool settings
+    def __init__(self, templates, state_file_name, instantiate, destroy, is_idle=None,
+                 first_range_id=DEFAULT_FIRST_RANGE_ID, refill_interval=DEFAULT_REFILL_INTERVAL):
+
+        self.templates = templates
+        self.state_file_name = state_file_name
+        self.instantiate = instantiate
+        self.destroy = destroy
+        self.is_idle = is_idle
+        self.first_range_id = first_range_id
+        self.refill_interval = refill_interval
+
+        # Ids of the warm ranges that are ready, with the template key as key
+        self.ready = dict([(template.key, []) for template in templates])
+
+        # Template keys of the warm ranges being created, with the range id as key
+        self.creating = {}
+
+        # Ids of the warm ranges handed out, with the range id of the
+        # request as key
+        self.aliases = {}
+
+        # Ids of the warm ranges that must be destroyed, for instance those
+        # of templates that are no longer used
+        self.surplus = []
+
+        # Statistics
+        self.unmatched = 0
+        self.refills = 0
+        self.refill_failures = 0
+        self.recent_refill_times = deque(maxlen=REFILL_SAMPLE_COUNT)
+
+        # Lock for synchronizing access to the pool state and statistics
+        self.lock = threading.Lock()
+
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.thread = None
+
+        self.load_state()
+
+    # Get the template with a given key, or None if there is no such template
+    def get_template(self, key):
+
+        for template in self.templates:
+            if template.key == key:
+                return template
+        return None
+
+    # Load the pool state from file; ranges whose creation was interrupted,
+    # or whose template is no longer used, are destroyed later
+    def load_state(self):
+
+        try:
+            with open(self.state_file_name, "r") as state_file:
+                state = yaml.load(state_file) or {}
+        except IOError:
+            return
+        except yaml.YAMLError as error:
+            print "* ERROR: warmpool: Cannot load warm pool state file '%s': %s." % (self.state_file_name, error)
+            return
+
+        for (key, range_ids) in state.get(READY_KEY, {}).items():
+            if key in self.ready:
+                self.ready[key].extend(range_ids)
+            else:
+                self.surplus.extend(range_ids)
+        self.surplus.extend(state.get(CREATING_KEY, []))
+        self.surplus.extend(state.get(SURPLUS_KEY, []))
+        self.aliases.update(state.get(CLAIMED_KEY, {}))
+        print "* INFO: warmpool: Loaded warm pool state: %d ready, %d claimed, %d surplus range(s)." % (
+            sum([len(range_ids) for range_ids in self.ready.values()]), len(self.aliases), len(self.surplus))
+
+    # Save the pool state to file; the lock must be held by the caller
+    def save_state(self):
+
+        state = {READY_KEY: self.ready, CREATING_KEY: self.creating.keys(),
+                 CLAIMED_KEY: self.aliases, SURPLUS_KEY: self.surplus}
+        if not sessinfo.write_file_atomically(self.state_file_name, yaml.safe_dump(state)):
+            print "* ERROR: warmpool: Cannot save warm pool state to file '%s'." % (self.state_file_name)
+
+    # Allocate the lowest warm range id that is not used; the lock must be
+    # held by the caller
+    def allocate_id(self):
+
+        used_ids = set(self.creating.keys() + self.aliases.values() + self.surplus)
+        for range_ids in self.ready.values():
+            used_ids.update(range_ids)
+        range_id = self.first_range_id
+        while range_id in used_ids:
+            range_id += 1
+        return range_id
+
+    # Take a warm range for an instantiation request with a given range id
+    # and description, and make the range id an alias of the warm range id
+    # Return the warm range id (as string), or None if no warm range matches
+    def claim(self, range_id, description_file):
+
+        key = get_template_key(description_file)
+        self.lock.acquire()
+        try:
+            # A range id that is still an alias belongs to a range that was
+            # not destroyed via this server, hence that range is discarded
+            if range_id in self.aliases:
+                self.surplus.append(self.aliases.pop(range_id))
+
+            template = self.get_template(key)
+            if not template:
+                self.unmatched += 1
+                return None
+            if not self.ready[key]:
+                template.misses += 1
+                return None
+
+            template.hits += 1
+            warm_range_id = self.ready[key].pop(0)
+            self.aliases[range_id] = warm_range_id
+            self.save_state()
+        finally:
+            self.lock.release()
+
+        # Start refilling as soon as the server is idle
+        self.wake_event.set()
+        return str(warm_range_id)
+
+    # Determine whether a range id is among those reserved for warm ranges
+    def is_reserved_id(self, range_id):
+
+        try:
+            return int(range_id) >= self.first_range_id
+        except ValueError:
+            return False
+
+    # Get the id known to CyRIS for a range with a given id
+    def resolve(self, range_id):
+
+        self.lock.acquire()
+        try:
+            return str(self.aliases.get(range_id, range_id))
+        finally:
+            self.lock.release()
+
+    # Forget the alias of a range with a given id after the range was
+    # destroyed, so that the warm range id can be reused
+    def release(self, range_id):
+
+        self.lock.acquire()
+        try:
+            if self.aliases.pop(range_id, None) != None:
+                self.save_state()
+        finally:
+            self.lock.release()
+
+    # Choose the next action of the refill thread: a surplus range to
+    # destroy, or a template that needs a new warm range while the server is
+    # idle; the lock must be held by the caller
+    # Return a tuple (template, range id), with None as template for
+    # surplus ranges, or None if there is nothing to do
+    def get_next_action(self):
+
+        for template in self.templates:
+            while len(self.ready[template.key]) > template.size:
+                self.surplus.append(self.ready[template.key].pop())
+        if self.surplus:
+            return (None, self.surplus[0])
+
+        if self.is_idle and not self.is_idle():
+            return None
+        for template in self.templates:
+            creating_count = self.creating.values().count(template.key)
+            if len(self.ready[template.key]) + creating_count < template.size:
+                range_id = self.allocate_id()
+                self.creating[range_id] = template.key
+                self.save_state()
+                return (template, range_id)
+        return None
+
+    # Execute the next action of the refill thread
+    # Return True if an action succeeded, False otherwise
+    def refill_once(self):
+
+        self.lock.acquire()
+        try:
+            action = self.get_next_action()
+        finally:
+            self.lock.release()
+        if not action:
+            return False
+
+        (template, range_id) = action
+        if not template:
+            print "* INFO: warmpool: Destroy surplus warm range %d." % (range_id)
+            success = self.destroy(range_id)
+            self.lock.acquire()
+            try:
+                if success:
+                    self.surplus.remove(range_id)
+                    self.save_state()
+            finally:
+                self.lock.release()
+            return success
+
+        print "* INFO: warmpool: Create warm range %d for template %s." % (range_id, template.name)
+        start_time = time.time()
+        success = self.instantiate(template, range_id)
+        refill_time = time.time() - start_time
+
+        self.lock.acquire()
+        try:
+            del self.creating[range_id]
+            if success:
+                self.ready[template.key].append(range_id)
+                self.refills += 1
+                self.recent_refill_times.append(refill_time)
+                print "* INFO: warmpool: Warm range %d is ready after %.3f s." % (range_id, refill_time)
+            else:
+                # The range may have been partially created
+                self.surplus.append(range_id)
+                self.refill_failures += 1
+                print "* WARNING: warmpool: Creation of warm range %d failed." % (range_id)
+            self.save_state()
+        finally:
+            self.lock.release()
+        return success
+
+    # Refill the pool until it is stopped
+    def run(self):
+
+        while not self.stop_event.is_set():
+            if not self.refill_once():
+                self.wake_event.wait(self.refill_interval)
+                self.wake_event.clear()
+
+    # Start refilling in a background thread
+    def start(self):
+
+        self.thread = threading.Thread(target=self.run, name="warm-pool")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Stop refilling, after the action in progress (if any) ends
+    def stop(self):
+
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread:
+            self.thread.join()
+
+    # Get a percentile of the recent refill times (seconds); the lock must
+    # be held by the caller
+    def get_refill_percentile(self, percentile):
+
+        if not self.recent_refill_times:
+            return 0.0
+        refill_times = sorted(self.recent_refill_times)
+        return refill_times[min(len(refill_times) - 1, int(len(refill_times) * percentile / 100.0))]
+
+    # Get the pool state and statistics as a dictionary, with times in
+    # seconds, for status output
+    def get_representation(self):
+
+        self.lock.acquire()
+        try:
+            templates = []
+            for template in self.templates:
+                requests = template.hits + template.misses
+                templates.append({"name": template.name, "size": template.size,
+                                  "ready": len(self.ready[template.key]),
+                                  "creating": self.creating.values().count(template.key),
+                                  "hits": template.hits, "misses": template.misses,
+                                  "hit_rate": round(float(template.hits) / requests, 3) if requests else 0.0})
+            hits = sum([template.hits for template in self.templates])
+            requests = hits + sum([template.misses for template in self.templates]) + self.unmatched
+            mean_refill_time = 0.0
+            if self.recent_refill_times:
+                mean_refill_time = sum(self.recent_refill_times) / len(self.recent_refill_times)
+            return {"templates": templates, "claimed": len(self.aliases), "surplus": len(self.surplus),
+                    "unmatched": self.unmatched,
+                    "hit_rate": round(float(hits) / requests, 3) if requests else 0.0,
+                    "refills": self.refills, "refill_failures": self.refill_failures,
+                    "mean_refill_time": round(mean_refill_time, 3),
+                    "p95_refill_time": round(self.get_refill_percentile(95), 3),
+                    "max_refill_time": round(max(self.recent_refill_times or [0.0]), 3)}
+        finally:
+            self.lock.release()
+
+    # Create a string representation of the pool state
+    def __str__(self):
+
+        representation = self.get_representation()
+        return ", ".join(["%s: %d/%d ready" % (template["name"], template["ready"], template["size"])
+                          for template in representation["templates"]]) + ", hit rate %.3f" % (
+                              representation["hit_rate"])
+
+
+#############################################################################
+# Testing code for the classes in this file
+#
+# This code will be executed _only_ when this module is called as the
+# main program
+#############################################################################
+if __name__ == '__main__':
+
+    import os
+    import tempfile
+    import userinfo
+
+    enabled = [True, True]
+
+    user_info = userinfo.UserInfoCache("../database/users.yml").get()
+    state_file_name = os.path.join(tempfile.mkdtemp(), "warm_pool_state.yml")
+
+    def create_pool(instantiate, destroy, is_idle=None):
+        templates = load_templates("../database/warm_pool.yml", user_info, "../database/")
+        return WarmPool(templates, state_file_name, instantiate, destroy, is_idle, refill_interval=0.1)
+
+    #########################################################################
+    # TEST #1
+    if enabled[0]:
+        print "TEST #1: Refill the pool while idle, and hand out warm ranges to matching requests."
+        idle = [False]
+        created = []
+        pool = create_pool(lambda template, range_id: created.append(range_id) or True,
+                           lambda range_id: True, lambda: idle[0])
+        template = pool.templates[0]
+        pool.start()
+        time.sleep(0.3)
+        assert not created
+        idle[0] = True
+        time.sleep(0.3)
+        print "Pool: %s" % (pool)
+        assert len(created) == template.size
+
+        other_user = user_info.get_user("jane_roe")
+        assert pool.claim("5", other_user.replace_variables(template.range_file_content, "5", 1)) == None
+        warm_range_id = pool.claim("6", template.get_description(6))
+        assert warm_range_id == str(created[0]) and pool.resolve("6") == warm_range_id
+        time.sleep(0.3)
+        pool.stop()
+        print "Pool: %s => %s" % (pool, pool.get_representation())
+        assert len(created) == template.size + 1 and pool.get_representation()["hit_rate"] == 0.5
+        assert pool.is_reserved_id(str(DEFAULT_FIRST_RANGE_ID)) and not pool.is_reserved_id("6")
+
+    #########################################################################
+    # TEST #2
+    if enabled[1]:
+        print "TEST #2: Restore the pool state, and destroy the ranges of interrupted refills."
+        destroyed = []
+        pool = create_pool(lambda template, range_id: False, lambda range_id: destroyed.append(range_id) or True)
+        pool.creating[299] = pool.templates[0].key
+        pool.save_state()
+        pool = create_pool(lambda template, range_id: False, lambda range_id: destroyed.append(range_id) or True)
+        assert pool.resolve("6") == warm_range_id and pool.surplus == [299]
+        pool.release("6")
+        assert pool.refill_once() and destroyed == [299]
+        print "Pool: %s => %s" % (pool, pool.get_representation())